@@ -1,23 +1,151 @@
 """
 This utility creates a time stamped zip backup of the file/directory
 specified by '-i' to the directory specified by'-o'
+
+Pass '--incremental' to only archive the files of a directory that changed
+since the last incremental backup to the same output directory; a change
+cache (see change_cache) kept in the output directory means only files whose
+size or modification time changed are read
+
+Pass '-w' followed by a number of worker processes to compress files in
+parallel
+
+Pass '--watch' to keep running and back up changes as they happen, as small
+incremental zips (or into the chunk store with '-s'); '--debounce' followed
+by a number of seconds sets how long a burst of changes must settle first
+
+Pass '-s' to back up into the deduplicating chunk store at '-o' (created if
+needed) instead of writing a zip
+
+Pass '-c' followed by one of zip, tar, tar.gz, tar.bz2, tar.xz or tar.zst to
+choose the archive format (zip by default)
+
+Pass '-o -' to stream the archive to stdout instead of writing a file
+
+Pass '--compress' followed by pattern=method[:level] (e.g. '*.log=bzip2:9')
+to choose how the zip members matching a glob pattern are compressed, method
+being one of stored, deflate, bzip2 or lzma; it may be given several times,
+the first matching pattern wins. Other already compressed or random looking
+files are stored and the rest deflated. The bytes each rule saved are part
+of the '--stats' output
+
+Pass '--keep-last', '--keep-daily', '--keep-weekly' and/or '--keep-monthly',
+each followed by a number, to prune older backups of the same input from the
+output directory afterwards: the given number of newest backups, and the
+newest backup of each of that many days, weeks and months are kept, along
+with every archive a kept incremental backup builds on (chunk stores only
+support '--keep-last')
+
+Run 'backup.py restore [-w N] [--include pattern]... [--skip-identical
+mtime|crc] [--no-preserve] archive output_dir' to restore an archive (with
+its whole increment chain), extracting members in parallel. Run 'backup.py
+restore store snapshot output_dir' to restore a snapshot of a chunk store,
+and 'backup.py list store' to print the store's snapshots, oldest first
+
+Pass '--checksums' to also write a checksum manifest next to the archive;
+this reads the whole archive back once it is written. Run 'backup.py verify
+[-w N] archive ...' to check any number of archives against their manifests
+without extracting them; the exit status is 1 if any archive is damaged
+
+Pass '--stats' to any of the above to print where the time went (wall and
+CPU time per phase, files and bytes processed, cache hit rates) to stderr as
+JSON
 """
 __author__ = 'Dwight Trollinger'
 
 
 import sys
 import zipfile
+import tarfile
 import os
 import datetime
+import json
+import hashlib
+import multiprocessing
+import fnmatch
+import shutil
+import errno
+import time
+import zlib
+import re
+import sqlite3
+import collections
 import file_sys_manip
+import chunk_store
+import file_watch
+import instrumentation
+import change_cache
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Name of the archive member that links an incremental backup to its parent and records deleted files
+INCREMENT_MEMBER_NAME = '.backup_increment.json'
+# Extension of the file (kept in the output directory) which records the state of the last incremental backup
+MANIFEST_EXTENSION = '.manifest.json'
+# Archive formats backups can be written in; 'tar.xz' needs a tarfile with lzma support, 'tar.zst' the zstandard package
+CONTAINERS = ('zip', 'tar', 'tar.gz', 'tar.bz2', 'tar.xz', 'tar.zst')
+# Output path which streams the archive to stdout
+STDOUT_PATH = '-'
+# Extension appended to an archive's path to name its checksum manifest
+CHECKSUMS_EXTENSION = '.sha256.json'
+# First command line argument which verifies archives instead of creating one
+VERIFY_COMMAND = 'verify'
+# Name of the catalog of the backups in an output directory, see BackupCatalog
+CATALOG_FILE_NAME = '.backup_catalog.sqlite'
+# Retention options, and the number of backups of each kind they keep
+RETENTION_OPTIONS = ('--keep-last', '--keep-daily', '--keep-weekly', '--keep-monthly')
+# <source>_<Y_M_D_h_m_s>[_n]<extension>; older backups have unpadded timestamps, and a uniqueness suffix may have
+# been inserted before the last extension (e.g. '.tar_1.gz')
+_BACKUP_FILE_NAME_PATTERN = re.compile(
+    r'^(?P<source>.+)_(?P<time>[0-9]{4}(?:_[0-9]{1,2}){5})(?P<extension>(?:_[0-9]+)?\.[\w.]+)$')
+# Seconds watch mode waits for a burst of changes to settle, and at most after a batch's first change, before backing up
+DEFAULT_DEBOUNCE = 2.0
+DEFAULT_MAX_DELAY = 60.0
+# First command line argument which restores an archive instead of creating one
+RESTORE_COMMAND = 'restore'
+# First command line argument which lists the snapshots of a chunk store
+LIST_COMMAND = 'list'
+# Ways restore can tell a file on disk already holds an archive member's contents
+SKIP_IDENTICAL_MODES = ('mtime', 'crc')
+# Option (of any command) which prints the time spent in each phase, files and bytes processed and cache hit rates to
+# stderr as JSON, see instrumentation
+STATS_OPTION = '--stats'
+# Archive members are handed to verification and restore workers in batches of about this many bytes
+ARCHIVE_BATCH_SIZE = 32 * 1024 * 1024
+ARCHIVE_READ_SIZE = 1024 * 1024
 
 
 def main(args):
+    stats = STATS_OPTION in args
+    if stats:
+        args = [arg for arg in args if arg != STATS_OPTION]
+        instrumentation.enable()
     try:
-        command_line_backup(args)
+        if len(args) > 1 and args[1] == VERIFY_COMMAND:
+            with instrumentation.phase(VERIFY_COMMAND):
+                intact = command_line_verify(args[1:])
+            if not intact:
+                exit(1)
+        elif len(args) > 1 and args[1] == RESTORE_COMMAND:
+            with instrumentation.phase(RESTORE_COMMAND):
+                command_line_restore(args[1:])
+        elif len(args) > 1 and args[1] == LIST_COMMAND:
+            with instrumentation.phase(LIST_COMMAND):
+                command_line_list(args[1:])
+        else:
+            with instrumentation.phase('backup'):
+                command_line_backup(args)
     except ArgumentException as e:
         print e.message
         exit(1)
+    finally:
+        if stats:
+            # stdout may be carrying the archive
+            sys.stderr.write(instrumentation.get_stats().to_json() + '\n')
 
 
 def command_line_backup(args):
@@ -25,25 +153,234 @@ def command_line_backup(args):
         raise ArgumentException(__doc__)
     input_path = None
     output_dir_path = None
+    incremental = False
+    watch = False
+    checksums = False
+    debounce = DEFAULT_DEBOUNCE
+    workers = None
+    store = False
+    container = 'zip'
+    retention = {}
+    compression_rules = []
     for index, arg in enumerate(args):
-        if arg == '-i' or arg == '-o':
+        if arg == '--incremental':
+            incremental = True
+        elif arg == '--watch':
+            watch = True
+        elif arg == '--checksums':
+            checksums = True
+        elif arg == '--debounce':
+            try:
+                debounce = float(args[index+1])
+            except (IndexError, ValueError):
+                raise ArgumentException("Missing number of seconds after '{}'".format(arg))
+        elif arg in RETENTION_OPTIONS:
+            if index + 1 == len(args) or not args[index+1].isdigit():
+                raise ArgumentException("Missing number of backups to keep after '{}'".format(arg))
+            retention[arg[len('--keep-'):]] = int(args[index+1])
+        elif arg == '--compress':
+            compression_rules.append(_parse_compression_rule(args[index+1] if index + 1 < len(args) else ''))
+        elif arg == '-s':
+            store = True
+        elif arg == '-w':
+            if index + 1 == len(args) or not args[index+1].isdigit():
+                raise ArgumentException("Missing number of workers after '{}'".format(arg))
+            workers = int(args[index+1])
+        elif arg == '-c':
+            if index + 1 == len(args) or args[index+1] not in CONTAINERS:
+                raise ArgumentException("Missing archive format ({}) after '{}'".format(', '.join(CONTAINERS), arg))
+            container = args[index+1]
+        elif arg == '-i' or arg == '-o':
             if index + 1 == len(args):
                 raise ArgumentException("Missing input directory path after '{}'".format(arg))
             elif arg == '-i':
                 input_path = os.path.abspath(args[index+1])
             elif arg == '-o':
-                output_dir_path = os.path.abspath(args[index+1])
+                output_dir_path = args[index+1]
+                if output_dir_path != STDOUT_PATH:
+                    output_dir_path = os.path.abspath(output_dir_path)
     if input_path is None:
         raise ArgumentException("You must specify directory/file to back up (-i)")
     if output_dir_path is None:
         output_dir_path = os.path.dirname(input_path)
+    if store and incremental:
+        raise ArgumentException("'-s' and '--incremental' cannot be combined, chunk stores are always incremental")
+    if compression_rules and (store or container != 'zip'):
+        raise ArgumentException("'--compress' only applies to zip archives")
+    try:
+        policy = file_sys_manip.CompressionPolicy(compression_rules) if compression_rules else None
+    except ValueError as e:
+        # A method this Python's zipfile module can't write
+        raise ArgumentException(str(e))
+    if retention and output_dir_path == STDOUT_PATH:
+        raise ArgumentException("Backups streamed to stdout can't be pruned")
+    if retention and store and set(retention) != {'last'}:
+        raise ArgumentException("Chunk stores only support '--keep-last'")
+    if watch:
+        if incremental or container != 'zip' or output_dir_path == STDOUT_PATH:
+            raise ArgumentException("'--watch' always writes incremental zips (or updates a chunk store with '-s')")
+        print "Watching {} and backing up changes to {}, press Ctrl+C to stop ...".format(input_path, output_dir_path)
+        try:
+            watch_backup(input_path, output_dir_path, store, workers, debounce, on_batch=_print_watch_batch,
+                         checksums=checksums, policy=policy)
+        except KeyboardInterrupt:
+            pass
+        return None
+    if output_dir_path == STDOUT_PATH:
+        if store or incremental:
+            raise ArgumentException("Only full backups can be streamed to stdout")
+        # stdout carries the archive, so progress goes to stderr
+        print >> sys.stderr, "Streaming backup of {} to stdout ...".format(input_path)
+        if sys.platform == 'win32':
+            import msvcrt
+            msvcrt.setmode(sys.stdout.fileno(), os.O_BINARY)
+        backup_to_stream(input_path, sys.stdout, container, workers, policy)
+        return STDOUT_PATH
     print "Backing up {} to {} ...".format(input_path, output_dir_path)
-    output_file_path = backup(input_path, output_dir_path)
+    output_file_path = backup(input_path, output_dir_path, incremental, workers, store, container, checksums, policy)
     print "Output to {} complete.".format(output_file_path)
+    if retention:
+        if store:
+            pruned_count = len(chunk_store.prune(output_dir_path, retention['last'])[0])
+        else:
+            pruned_count = len(prune_backups(output_dir_path, source=os.path.basename(input_path), **dict(
+                ('keep_' + kind, count) for kind, count in retention.iteritems())))
+        print "Pruned {} old backups.".format(pruned_count)
     return output_file_path
 
 
-def backup(input_path, output_dir_path):
+def _parse_compression_rule(arg):
+    """
+    Parses a '--compress' argument of the form pattern=method[:level]
+    @return: (pattern, method, level), as accepted by file_sys_manip.CompressionPolicy
+    """
+    pattern, separator, method = arg.rpartition('=')
+    method, separator, level = method.partition(':')
+    if not pattern or method not in file_sys_manip.COMPRESSION_METHODS or (separator and not level.isdigit()):
+        raise ArgumentException("Expected pattern=method[:level] after '--compress', method being one of {}".format(
+            ', '.join(sorted(file_sys_manip.COMPRESSION_METHODS))))
+    return pattern, method, int(level) if level else None
+
+
+def _print_watch_batch(backup_path, metrics):
+    print "{} changed paths -> {} (backup {:.2f}s, latency {:.2f}s, max latency {:.2f}s, queued {})".format(
+        metrics.last_batch_size, backup_path or "no changes", metrics.last_backup_seconds, metrics.last_latency,
+        metrics.max_latency, metrics.queue_depth)
+    sys.stdout.flush()
+
+
+def command_line_verify(args):
+    """
+    Verifies the archives given on the command line, printing one line per archive
+    @param args: the arguments following the script name, starting with VERIFY_COMMAND
+    @return: True if every archive is intact, False otherwise
+    """
+    workers = None
+    archive_paths = []
+    index = 1
+    while index < len(args):
+        if args[index] == '-w':
+            if index + 1 == len(args) or not args[index+1].isdigit():
+                raise ArgumentException("Missing number of workers after '-w'")
+            workers = int(args[index+1])
+            index += 2
+        else:
+            archive_paths.append(args[index])
+            index += 1
+    if not archive_paths:
+        raise ArgumentException("You must specify the archives to verify")
+    results = verify(archive_paths, workers)
+    intact = True
+    for archive_path in archive_paths:
+        problems = results[archive_path]
+        if any(problems.itervalues()):
+            intact = False
+            print "FAILED {}".format(archive_path)
+            for kind, names in sorted(problems.iteritems()):
+                for name in names:
+                    print "  {}: {}".format(kind, name)
+        else:
+            print "OK {}".format(archive_path)
+    return intact
+
+
+def command_line_restore(args):
+    """
+    Restores the archive, or chunk store snapshot, given on the command line
+    @param args: the arguments following the script name, starting with RESTORE_COMMAND
+    @return: the statistics returned by restore, or the number of files restored from a chunk store snapshot
+    """
+    workers = None
+    include = None
+    skip_identical = None
+    preserve = True
+    paths = []
+    index = 1
+    while index < len(args):
+        arg = args[index]
+        if arg in ('-w', '--include', '--skip-identical'):
+            if index + 1 == len(args):
+                raise ArgumentException("Missing value after '{}'".format(arg))
+            value = args[index+1]
+            if arg == '-w':
+                if not value.isdigit():
+                    raise ArgumentException("Missing number of workers after '-w'")
+                workers = int(value)
+            elif arg == '--include':
+                include = (include or []) + [value]
+            elif value in SKIP_IDENTICAL_MODES:
+                skip_identical = value
+            else:
+                raise ArgumentException("Expected one of {} after '{}'".format(', '.join(SKIP_IDENTICAL_MODES), arg))
+            index += 2
+        elif arg == '--no-preserve':
+            preserve = False
+            index += 1
+        else:
+            paths.append(arg)
+            index += 1
+    if paths and chunk_store.is_store(paths[0]):
+        if workers is not None or include is not None or skip_identical is not None or not preserve:
+            raise ArgumentException("Chunk store snapshots are always restored whole, without options")
+        if len(paths) != 3:
+            raise ArgumentException(
+                "You must specify the store, the snapshot to restore and the directory to restore it to")
+        store_path, snapshot_name, output_dir_path = paths
+        if snapshot_name not in chunk_store.list_snapshots(store_path):
+            raise ArgumentException("There is no snapshot {} in {}".format(snapshot_name, store_path))
+        print "Restoring snapshot {} of {} to {} ...".format(snapshot_name, store_path, output_dir_path)
+        restored_count = chunk_store.restore(store_path, snapshot_name, output_dir_path)
+        print "Restored {} files.".format(restored_count)
+        return restored_count
+    if len(paths) != 2:
+        raise ArgumentException("You must specify the archive to restore and the directory to restore it to")
+    archive_path, output_dir_path = paths
+    print "Restoring {} to {} ...".format(archive_path, output_dir_path)
+    stats = restore(archive_path, output_dir_path, workers, include, skip_identical, preserve)
+    print "Restored {restored} files, skipped {skipped} identical files and deleted {deleted} files.".format(**stats)
+    return stats
+
+
+def command_line_list(args):
+    """
+    Prints the snapshots of the chunk store given on the command line, oldest first
+    @param args: the arguments following the script name, starting with LIST_COMMAND
+    @return: list of the snapshot names
+    """
+    if len(args) != 2:
+        raise ArgumentException("You must specify the chunk store to list")
+    store_path = args[1]
+    if not chunk_store.is_store(store_path):
+        raise ArgumentException("{} is not a chunk store".format(store_path))
+    snapshot_names = chunk_store.list_snapshots(store_path)
+    for snapshot_name in snapshot_names:
+        snapshot = chunk_store.read_snapshot(store_path, snapshot_name)
+        print "{}  {}  {} files".format(snapshot_name, snapshot['created'], len(snapshot['files']))
+    return snapshot_names
+
+
+def backup(input_path, output_dir_path, incremental=False, workers=None, store=False, container='zip',
+           checksums=False, policy=None):
     """
     Creates a timestamped zipped copy of the file/directory with the given input_path in the directory with the given
         output_dir_path
@@ -52,31 +389,1091 @@ def backup(input_path, output_dir_path):
     @param input_path: the path of the file/directory to back up
     @type output_dir_path: str
     @param output_dir_path: the path of the directory to place to backup in
-    @return: the path the the created backup file
+    @type incremental: bool
+    @param incremental: if True, only the files which changed since the last incremental backup are archived (see
+        incremental_backup)
+    @type workers: int
+    @param workers: number of processes compressing files concurrently, None or 1 compresses them one at a time
+    @type store: bool
+    @param store: if True, output_dir_path is a deduplicating chunk store (see chunk_store) rather than a directory
+        of zips
+    @type container: str
+    @param container: archive format, one of CONTAINERS; only 'zip' supports incremental backups
+    @type checksums: bool
+    @param checksums: if True, a checksum manifest is written next to the archive (see write_checksums), which
+        means reading and decompressing the whole archive once more
+    @type policy: file_sys_manip.CompressionPolicy
+    @param policy: how each zip member is compressed, file_sys_manip.DEFAULT_COMPRESSION_POLICY if None; the bytes
+        each of its rules saved are recorded in the instrumentation counters (see file_sys_manip.write_files_to_zip)
+    @return: the path the the created backup file (the snapshot file when backing up to a chunk store)
     """
-    if not os.path.exists(input_path):
-        raise IOError("{} does not exist.".format(input_path))
     # Default output to the parent directory of input
     if output_dir_path is None:
         output_dir_path = os.path.dirname(input_path)
+    dir_mtime = _get_dir_mtime(output_dir_path)
+    with instrumentation.phase('archive'):
+        output_file_path = _backup(input_path, output_dir_path, incremental, workers, store, container,
+                                   policy or file_sys_manip.DEFAULT_COMPRESSION_POLICY)
+    if not store:
+        if checksums:
+            with instrumentation.phase('checksums'):
+                write_checksums(output_file_path, workers)
+        _add_to_catalog(output_file_path, dir_mtime)
+    return output_file_path
 
-    # Get the time stamp
-    now = datetime.datetime.now()
-    time_stamp = [now.year, now.month, now.day, now.hour, now.minute, now.second]
-    time_stamp = [str(entry) for entry in time_stamp]
-    time_stamp = '_'.join(time_stamp)
-    output_file_name = os.path.basename(input_path) + '_' + time_stamp
-    output_file_path = os.path.join(output_dir_path, output_file_name) + '.zip'
+
+def _backup(input_path, output_dir_path, incremental, workers, store, container, policy):
+    if not os.path.exists(input_path):
+        raise IOError("{} does not exist.".format(input_path))
+    if store:
+        return chunk_store.backup(input_path, output_dir_path)
+    if container != 'zip':
+        if incremental:
+            raise ArgumentException("Incremental backups can only be written as zip files")
+        output_file_path = get_output_file_path(input_path, output_dir_path, '.' + container)
+        with open(output_file_path, 'wb') as f:
+            backup_to_stream(input_path, f, container, workers)
+        return output_file_path
+    if incremental:
+        return incremental_backup(input_path, output_dir_path, workers, policy=policy)
+
+    output_file_path = get_output_file_path(input_path, output_dir_path)
     if os.path.isdir(input_path):
-        file_sys_manip.zip_dir(input_path, output_file_path)
+        file_sys_manip.zip_dir(input_path, output_file_path, workers, policy, change_cache.CACHE_FILE_PATTERN)
     elif os.path.isfile(input_path):
         with zipfile.ZipFile(output_file_path, 'w', zipfile.ZIP_DEFLATED) as z:
-            z.write(input_path)
+            file_sys_manip.write_files_to_zip(z, [(input_path, None)], policy=policy)
     else:
         raise ArgumentException("{} does not exist".format(input_path))
     return output_file_path
 
 
+def backup_to_stream(input_path, stream, container='zip', workers=None, policy=None):
+    """
+    Writes an archive of the file/directory with the given input_path to a writable file-like object. The stream is
+        never read back or seeked, so stdout, pipes and upload streams work, and no temporary file is needed. Zip
+        members carry their sizes and CRCs in data descriptors (see file_sys_manip.StreamingZipFile).
+
+    @type input_path: str
+    @param input_path: the path of the file/directory to back up
+    @param stream: writable file-like object the archive is written to; it is left open
+    @type container: str
+    @param container: archive format, one of CONTAINERS
+    @type workers: int
+    @param workers: number of processes compressing zip members concurrently, None or 1 compresses them one at a time
+    @type policy: file_sys_manip.CompressionPolicy
+    @param policy: how each zip member is compressed, file_sys_manip.DEFAULT_COMPRESSION_POLICY if None
+    @return: None
+    """
+    if not os.path.exists(input_path):
+        raise IOError("{} does not exist.".format(input_path))
+    if container == 'zip':
+        if os.path.isdir(input_path):
+            file_sys_manip.zip_dir_to_stream(input_path, stream, workers, policy, change_cache.CACHE_FILE_PATTERN)
+        else:
+            with file_sys_manip.StreamingZipFile(stream) as z:
+                file_sys_manip.write_files_to_zip(
+                    z, [(input_path, None)], policy=policy or file_sys_manip.DEFAULT_COMPRESSION_POLICY)
+    elif container in CONTAINERS:
+        _write_tar(input_path, stream, container)
+    else:
+        raise ArgumentException("Unknown archive format '{}', expected one of {}".format(container, CONTAINERS))
+
+
+def _write_tar(input_path, stream, container):
+    compression = container[len('tar.'):] if container != 'tar' else ''
+    zstd_writer = None
+    if compression == 'zst':
+        if zstandard is None:
+            raise ArgumentException("tar.zst backups require the 'zstandard' package")
+        zstd_writer = zstandard.ZstdCompressor().stream_writer(stream)
+        stream = zstd_writer
+        compression = ''
+    elif compression and compression not in tarfile.TarFile.OPEN_METH:
+        raise ArgumentException("This Python's tarfile module can't write {} archives".format(container))
+    # The '|' modes write a pure stream, without ever seeking
+    tar = tarfile.open(fileobj=stream, mode='w|' + compression)
+    try:
+        tar.add(input_path, filter=_exclude_cache_files)
+    finally:
+        tar.close()
+    if zstd_writer is not None:
+        zstd_writer.flush(zstandard.FLUSH_FRAME)
+
+
+def _exclude_cache_files(tar_info):
+    """
+    tarfile filter leaving change cache databases out of archives, they change whenever anything else does
+    """
+    return None if change_cache.is_cache_file(os.path.basename(tar_info.name)) else tar_info
+
+
+def get_output_file_path(input_path, output_dir_path, extension='.zip'):
+    """
+    Returns an available timestamped path for a backup of input_path in the directory with the given output_dir_path
+
+    @type input_path: str
+    @param input_path: the path of the file/directory being backed up
+    @type output_dir_path: str
+    @param output_dir_path: the path of the directory the backup will be placed in
+    @type extension: str
+    @param extension: extension of the backup file
+    @return: an available timestamped path for the backup
+    """
+    # Zero padded, so backups of the same source sort by name in the order they were made
+    time_stamp = datetime.datetime.now().strftime('%Y_%m_%d_%H_%M_%S')
+    output_file_name = os.path.basename(input_path) + '_' + time_stamp + extension
+    # Two backups started within the same second must not overwrite each other
+    return file_sys_manip.generate_unique_path(output_file_name, output_dir_path)
+
+
+def incremental_backup(input_path, output_dir_path, workers=None, changed_paths=None, policy=None):
+    """
+    Creates a timestamped zip of only the files in the directory with the given input_path which were added or changed
+        since the last incremental backup to output_dir_path. The tree is scanned through a change cache kept in
+        output_dir_path (see change_cache and get_change_cache_path), so files are only hashed when their size or
+        modification time differ from the last run, and the cost of a backup scales with the amount of change rather
+        than the size of the tree. The first backup (or one whose parent archive has gone missing) contains every
+        file.
+
+    @type input_path: str
+    @param input_path: the path of the directory to back up
+    @type output_dir_path: str
+    @param output_dir_path: the path of the directory to place to backup in
+    @type workers: int
+    @param workers: number of processes compressing files concurrently, None or 1 compresses them one at a time
+    @type changed_paths: iterable
+    @param changed_paths: if given, only these paths (files, or directories standing for everything below them) are
+        checked for changes and every other file is assumed unchanged since the last backup, e.g. the paths reported
+        by a file_watch watcher
+    @type policy: file_sys_manip.CompressionPolicy
+    @param policy: how each zip member is compressed, file_sys_manip.DEFAULT_COMPRESSION_POLICY if None
+    @return: the path the the created backup file, None if changed_paths were given and none of them had changed
+    """
+    if not os.path.isdir(input_path):
+        raise ArgumentException("Incremental backups require a directory, {} is not one".format(input_path))
+    manifest_path = os.path.join(output_dir_path, os.path.basename(input_path) + MANIFEST_EXTENSION)
+    previous_manifest = read_manifest(manifest_path)
+    if previous_manifest is not None and \
+            not os.path.isfile(os.path.join(output_dir_path, previous_manifest['archive'])):
+        previous_manifest = None
+    previous_files = {} if previous_manifest is None else previous_manifest['files']
+
+    if changed_paths is None or previous_manifest is None:
+        with change_cache.ChangeCache(input_path, get_change_cache_path(input_path, output_dir_path)) as cache:
+            cache.update(workers=workers)
+            files = cache.get_records()
+            output_file_path = _write_increment(
+                input_path, output_dir_path, workers, policy, manifest_path, previous_manifest, files)
+            # Only once the increment is written, so the changes of a failed backup are reported again by the next one
+            cache.save()
+        return output_file_path
+
+    files = dict(previous_files)
+    for path in changed_paths:
+        member_prefix = os.path.relpath(path, input_path).replace(os.sep, '/')
+        if member_prefix == '.':
+            files = _scan_incremental_files(input_path, input_path, previous_files)
+            break
+        if member_prefix.startswith('../'):
+            continue
+        if not os.path.isfile(path):
+            # A directory, or something that is gone: forget everything that was below it, then rescan it
+            for member_name in [name for name in files if name.startswith(member_prefix + '/')]:
+                del files[member_name]
+        files.pop(member_prefix, None)
+        files.update(_scan_incremental_files(input_path, path, previous_files))
+    return _write_increment(
+        input_path, output_dir_path, workers, policy, manifest_path, previous_manifest, files, True)
+
+
+def get_change_cache_path(input_path, output_dir_path):
+    """
+    Returns the path of the change cache incremental_backup keeps for input_path in output_dir_path. It is kept with
+        the backups rather than in the tree, so other tools using the tree's own cache (e.g. file_search) can't make
+        it skip changes.
+    """
+    return os.path.join(output_dir_path, os.path.basename(input_path) + change_cache.CACHE_FILE_NAME)
+
+
+def _write_increment(input_path, output_dir_path, workers, policy, manifest_path, previous_manifest, files,
+                     skip_empty=False):
+    """
+    Archives the files of the given manifest entries which differ from the previous manifest, along with the list of
+        the deleted ones, then writes the new manifest
+    @param files: dict of the form { member_name: [size, mtime, hash] } describing the whole tree
+    @type skip_empty: bool
+    @param skip_empty: if True, nothing is written when nothing changed
+    @return: the path the the created backup file, None if skip_empty and nothing changed
+    """
+    previous_files = {} if previous_manifest is None else previous_manifest['files']
+    # Compared against the manifest rather than the change cache, which may have missed increments written since
+    # (e.g. by watch_backup), so the increment always holds what changed since its parent
+    changed = [member_name for member_name, entry in files.iteritems()
+               if member_name not in previous_files or previous_files[member_name][2] != entry[2]]
+    deleted = sorted(set(previous_files) - set(files))
+    if skip_empty and not changed and not deleted:
+        return None
+
+    output_file_path = get_output_file_path(input_path, output_dir_path)
+    increment = {
+        'parent': None if previous_manifest is None else previous_manifest['archive'],
+        'deleted': deleted,
+    }
+    members = [
+        (os.path.join(input_path, member_name.replace('/', os.sep)), member_name) for member_name in sorted(changed)]
+    with zipfile.ZipFile(output_file_path, 'w', zipfile.ZIP_DEFLATED) as z:
+        file_sys_manip.write_files_to_zip(z, members, workers, policy or file_sys_manip.DEFAULT_COMPRESSION_POLICY)
+        z.writestr(INCREMENT_MEMBER_NAME, json.dumps(increment))
+
+    write_manifest(manifest_path, {'archive': os.path.basename(output_file_path), 'files': files})
+    return output_file_path
+
+
+def _scan_incremental_files(input_path, path, previous_files):
+    """
+    Returns the manifest entries of the files at or below path, only hashing files whose size or modification time
+        differ from their previous entry
+    @return: dict of the form { member_name: [size, mtime, hash] }
+    """
+    if change_cache.is_cache_file(os.path.basename(path)):
+        file_paths = []
+    elif os.path.isfile(path):
+        file_paths = [path]
+    else:
+        file_paths = [os.path.join(root, file_name) for root, dirs, file_names in os.walk(path)
+                      for file_name in file_names if not change_cache.is_cache_file(file_name)]
+    files = {}
+    for file_path in file_paths:
+        # Archive names always use '/' so manifests are portable
+        member_name = os.path.relpath(file_path, input_path).replace(os.sep, '/')
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            # Deleted since it was listed
+            continue
+        entry = previous_files.get(member_name)
+        if entry is None or entry[0] != stat.st_size or entry[1] != stat.st_mtime:
+            entry = [stat.st_size, stat.st_mtime, file_sys_manip.get_file_hash(file_path)]
+        files[member_name] = entry
+    return files
+
+
+def watch_backup(input_path, output_dir_path, store=False, workers=None, debounce=DEFAULT_DEBOUNCE,
+                 max_delay=DEFAULT_MAX_DELAY, watcher=None, on_batch=None, max_batches=None, checksums=False,
+                 policy=None):
+    """
+    Watches the directory with the given input_path and backs up whatever changes, until interrupted. Bursts of
+        changes are debounced into one batch: a batch is backed up once no change has been seen for debounce seconds,
+        or max_delay seconds after its first change. Each batch writes a small incremental archive holding only the
+        touched files (or adds a snapshot to the chunk store at output_dir_path, which only looks at the touched
+        files).
+
+    @type input_path: str
+    @param input_path: the path of the directory to watch
+    @type output_dir_path: str
+    @param output_dir_path: the path of the directory to place the backups in, or of the chunk store if store is True
+    @type store: bool
+    @param store: if True, output_dir_path is a chunk store (see chunk_store)
+    @type workers: int
+    @param workers: number of processes compressing files concurrently, None or 1 compresses them one at a time
+    @type debounce: float
+    @param debounce: seconds without changes after which a batch is backed up
+    @type max_delay: float
+    @param max_delay: most seconds a change waits before being backed up, however busy the tree is
+    @param watcher: watcher of input_path, see file_watch; one is created (and closed) if None
+    @param on_batch: function called with (backup_path, WatchMetrics) after every batch; backup_path is None when
+        the touched files turned out not to have changed
+    @type max_batches: int
+    @param max_batches: if given, return after this many batches
+    @type checksums: bool
+    @param checksums: if True, a checksum manifest is written next to every archive (see write_checksums)
+    @type policy: file_sys_manip.CompressionPolicy
+    @param policy: how each zip member is compressed, file_sys_manip.DEFAULT_COMPRESSION_POLICY if None
+    @return: the WatchMetrics of the run
+    """
+    if not os.path.isdir(input_path):
+        raise ArgumentException("Watching requires a directory, {} is not one".format(input_path))
+    input_path = os.path.abspath(input_path)
+    ignored_prefix = os.path.join(os.path.abspath(output_dir_path), '')
+    owned_watcher = watcher is None
+    if owned_watcher:
+        watcher = file_watch.create_watcher(input_path)
+    metrics = WatchMetrics()
+    pending = set()
+    first_change_time = last_change_time = None
+    try:
+        while max_batches is None or metrics.batches < max_batches:
+            if watcher.exhausted:
+                # The tree outgrew the watcher, every change since may have been missed
+                watcher.close()
+                watcher = file_watch.PollingWatcher(input_path)
+                owned_watcher = True
+                now = time.time()
+                if not pending:
+                    first_change_time = now
+                last_change_time = now
+                pending.add(input_path)
+            now = time.time()
+            if pending:
+                timeout = max(0, min(last_change_time + debounce, first_change_time + max_delay) - now)
+            else:
+                timeout = None
+            touched = [path for path in watcher.read(timeout)
+                       if not os.path.join(path, '').startswith(ignored_prefix)]
+            now = time.time()
+            if touched:
+                metrics.events += len(touched)
+                if not pending:
+                    first_change_time = now
+                last_change_time = now
+                pending.update(touched)
+                metrics.queue_depth = len(pending)
+                metrics.max_queue_depth = max(metrics.max_queue_depth, metrics.queue_depth)
+            if not pending or (now - last_change_time < debounce and now - first_change_time < max_delay):
+                continue
+            batch = pending
+            pending = set()
+            metrics.queue_depth = 0
+            start_time = time.time()
+            if store:
+                backup_path = chunk_store.backup(input_path, output_dir_path, batch)
+            else:
+                dir_mtime = _get_dir_mtime(output_dir_path)
+                backup_path = incremental_backup(input_path, output_dir_path, workers, batch, policy)
+                if backup_path is not None:
+                    if checksums:
+                        write_checksums(backup_path, workers)
+                    _add_to_catalog(backup_path, dir_mtime)
+            end_time = time.time()
+            metrics.add_batch(len(batch), end_time - start_time, end_time - first_change_time)
+            if on_batch is not None:
+                on_batch(backup_path, metrics)
+    finally:
+        if owned_watcher:
+            watcher.close()
+    return metrics
+
+
+class WatchMetrics(object):
+    """
+    Statistics of a watch_backup run; latencies are measured from a batch's first change to the end of its backup
+    """
+
+    def __init__(self):
+        self.events = 0
+        self.batches = 0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.last_batch_size = 0
+        self.last_backup_seconds = 0.0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.total_backup_seconds = 0.0
+
+    def add_batch(self, batch_size, backup_seconds, latency):
+        self.batches += 1
+        self.last_batch_size = batch_size
+        self.last_backup_seconds = backup_seconds
+        self.total_backup_seconds += backup_seconds
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+def read_manifest(manifest_path):
+    """
+    Returns the contents of the incremental backup manifest at the given path, None if there is no such manifest
+
+    @type manifest_path: str
+    @param manifest_path: the path of the manifest file
+    @return: dict of the form { 'archive': archive_file_name, 'files': { member_name: [size, mtime, hash] } }
+    """
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def write_manifest(manifest_path, manifest):
+    """
+    Writes the given incremental backup manifest, replacing the previous one only once the new one is complete
+
+    @type manifest_path: str
+    @param manifest_path: the path of the manifest file
+    @type manifest: dict
+    @param manifest: the manifest, as returned by read_manifest
+    """
+    temp_path = manifest_path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    os.rename(temp_path, manifest_path)
+
+
+def get_increment_chain(archive_path):
+    """
+    Returns the list of archive paths needed to restore the given archive, starting with its full base archive and
+        ending with archive_path itself. Archives that were not created by incremental_backup are their own base.
+
+    @type archive_path: str
+    @param archive_path: the path of a backup archive
+    @return: the list of archive paths, oldest first
+    """
+    chain = []
+    while archive_path is not None:
+        chain.append(archive_path)
+        with zipfile.ZipFile(archive_path, 'r') as z:
+            if INCREMENT_MEMBER_NAME not in z.namelist():
+                break
+            parent = json.loads(z.read(INCREMENT_MEMBER_NAME))['parent']
+        if parent is None:
+            archive_path = None
+        else:
+            archive_path = os.path.join(os.path.dirname(archive_path), parent)
+            if not os.path.isfile(archive_path):
+                raise IOError("{} is missing from the increment chain of {}".format(archive_path, chain[0]))
+    chain.reverse()
+    return chain
+
+
+def restore(archive_path, output_dir_path, workers=None, include=None, skip_identical=None, preserve=True):
+    """
+    Rebuilds the full snapshot captured by the given backup archive in the directory with the given output_dir_path,
+        applying its base archive and then each increment (including deletions) in order. The chain is resolved
+        first, so each file is extracted once, from the newest archive holding it, and members are extracted in
+        batches by a process pool.
+
+    @type archive_path: str
+    @param archive_path: the path of the backup archive to restore
+    @type output_dir_path: str
+    @param output_dir_path: the path of the directory the snapshot will be restored to
+    @type workers: int
+    @param workers: number of processes extracting members concurrently, None or 1 extracts them one at a time
+    @type include: list
+    @param include: glob patterns (see fnmatch) of the member names to restore, matched against the whole '/'
+        separated name or, for patterns without a '/', against the file name; None restores every member
+    @type skip_identical: str
+    @param skip_identical: one of SKIP_IDENTICAL_MODES: 'mtime' leaves files whose size and modification time match
+        the member untouched, 'crc' those whose size and CRC-32 match; None always extracts
+    @type preserve: bool
+    @param preserve: if True, restored files get the permissions and modification times recorded in the archive
+    @return: dict with the keys 'restored', 'skipped' and 'deleted' (file counts)
+    """
+    if not os.path.isfile(archive_path):
+        raise IOError("{} does not exist.".format(archive_path))
+    if skip_identical is not None and skip_identical not in SKIP_IDENTICAL_MODES:
+        raise ArgumentException("Unknown skip_identical mode '{}', expected one of {}".format(
+            skip_identical, SKIP_IDENTICAL_MODES))
+    # { member_name: (archive_path, file_size) } of the newest archive holding each member
+    plan = {}
+    deleted = set()
+    for chain_archive_path in get_increment_chain(archive_path):
+        with zipfile.ZipFile(chain_archive_path, 'r') as z:
+            infos = z.infolist()
+            if INCREMENT_MEMBER_NAME in z.NameToInfo:
+                for name in json.loads(z.read(INCREMENT_MEMBER_NAME))['deleted']:
+                    plan.pop(name, None)
+                    deleted.add(name)
+        for info in infos:
+            if info.filename != INCREMENT_MEMBER_NAME and _is_included(info.filename, include):
+                plan[info.filename] = (chain_archive_path, info.file_size)
+                deleted.discard(info.filename)
+
+    stats = {'restored': 0, 'skipped': 0, 'deleted': 0}
+    for name in sorted(deleted):
+        deleted_path = _get_restore_path(output_dir_path, name)
+        if _is_included(name, include) and os.path.isfile(deleted_path):
+            os.remove(deleted_path)
+            stats['deleted'] += 1
+
+    members_by_archive = {}
+    for name, (member_archive_path, file_size) in sorted(plan.iteritems()):
+        members_by_archive.setdefault(member_archive_path, []).append((name, file_size))
+    tasks = [(member_archive_path, batch, output_dir_path, skip_identical, preserve)
+             for member_archive_path, members in sorted(members_by_archive.iteritems())
+             for batch in _batch_members(members)]
+    if workers is None or workers <= 1 or len(tasks) < 2:
+        results = (_restore_members(task) for task in tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap_unordered(_restore_members, tasks)
+    errors = []
+    try:
+        for restored, skipped, task_errors in results:
+            stats['restored'] += restored
+            stats['skipped'] += skipped
+            errors.extend(task_errors)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    if errors:
+        raise IOError("Restoring {} failed: {}".format(archive_path, '; '.join(errors)))
+    return stats
+
+
+def _is_included(member_name, include):
+    if include is None:
+        return True
+    base_name = member_name.rstrip('/').rsplit('/', 1)[-1]
+    for pattern in include:
+        if fnmatch.fnmatch(member_name, pattern) or ('/' not in pattern and fnmatch.fnmatch(base_name, pattern)):
+            return True
+    return False
+
+
+def _get_restore_path(output_dir_path, member_name):
+    """
+    Returns the path a member is restored to, dropping drive letters, leading separators and '..' components as
+        zipfile.ZipFile.extract does, so no member can be written outside output_dir_path
+    """
+    member_name = os.path.splitdrive(member_name.replace('\\', '/'))[1]
+    parts = [part for part in member_name.split('/') if part not in ('', '.', '..')]
+    return os.path.join(output_dir_path, *parts)
+
+
+def _batch_members(members):
+    """
+    Splits [ (member_name, file_size) ] into lists of member names of about ARCHIVE_BATCH_SIZE bytes each
+    """
+    batches = []
+    batch = []
+    batch_size = 0
+    for name, file_size in members:
+        batch.append(name)
+        batch_size += file_size
+        if batch_size >= ARCHIVE_BATCH_SIZE:
+            batches.append(batch)
+            batch = []
+            batch_size = 0
+    if batch or not batches:
+        batches.append(batch)
+    return batches
+
+
+def _restore_members(task):
+    """
+    Extracts a batch of members of one zip archive
+    @return: (restored count, skipped count, [error messages])
+    """
+    archive_path, member_names, output_dir_path, skip_identical, preserve = task
+    restored = 0
+    skipped = 0
+    errors = []
+    with zipfile.ZipFile(archive_path, 'r') as z:
+        for name in member_names:
+            info = z.getinfo(name)
+            path = _get_restore_path(output_dir_path, name)
+            try:
+                if name.endswith('/'):
+                    if not os.path.isdir(path):
+                        os.makedirs(path)
+                    continue
+                if skip_identical is not None and _is_identical(path, info, skip_identical):
+                    skipped += 1
+                    continue
+                dir_path = os.path.dirname(path)
+                if not os.path.isdir(dir_path):
+                    try:
+                        os.makedirs(dir_path)
+                    except OSError as e:
+                        # Another worker may have created it in the meantime
+                        if e.errno != errno.EEXIST:
+                            raise
+                source = z.open(info)
+                try:
+                    with open(path, 'wb') as f:
+                        shutil.copyfileobj(source, f, ARCHIVE_READ_SIZE)
+                finally:
+                    source.close()
+                if preserve:
+                    mode = (info.external_attr >> 16) & 0o7777
+                    if mode:
+                        os.chmod(path, mode)
+                    mtime = _get_member_mtime(info)
+                    os.utime(path, (mtime, mtime))
+                restored += 1
+            except Exception as e:
+                # A damaged member can fail in many ways (bad CRC, bad deflate data, truncation, ...)
+                errors.append("{}: {}".format(name, e))
+    return restored, skipped, errors
+
+
+def _get_member_mtime(info):
+    # Zip timestamps are in local time
+    return time.mktime(info.date_time + (0, 0, -1))
+
+
+def _is_identical(path, info, mode):
+    """
+    Returns True if the file at path already holds the given zip member's contents, as far as mode can tell
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    if stat.st_size != info.file_size:
+        return False
+    if mode == 'mtime':
+        # Zip timestamps only have a two second resolution
+        return abs(stat.st_mtime - _get_member_mtime(info)) < 2
+    crc = 0
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(ARCHIVE_READ_SIZE)
+            if not data:
+                break
+            crc = zlib.crc32(data, crc)
+    return crc & 0xffffffff == info.CRC
+
+
+def get_checksums_path(archive_path):
+    """
+    Returns the path of the checksum manifest of the archive with the given path
+    """
+    return archive_path + CHECKSUMS_EXTENSION
+
+
+def write_checksums(archive_path, workers=None):
+    """
+    Writes the checksum manifest of an archive, recording the size and SHA-256 of every member. Members are read back
+        from the archive itself, so the manifest describes exactly what was stored.
+
+    @type archive_path: str
+    @param archive_path: the path of a zip or tar archive
+    @type workers: int
+    @param workers: number of processes reading members concurrently, None or 1 reads them one at a time
+    @return: the path of the checksum manifest
+    """
+    members, errors = _hash_archives([archive_path], workers)[archive_path]
+    if errors:
+        raise IOError("{} could not be read: {}".format(archive_path, '; '.join(errors)))
+    checksums_path = get_checksums_path(archive_path)
+    write_manifest(checksums_path, {'archive': os.path.basename(archive_path), 'members': members})
+    return checksums_path
+
+
+def read_checksums(archive_path):
+    """
+    Returns the checksum manifest of an archive, None if it has none
+
+    @type archive_path: str
+    @param archive_path: the path of the archive
+    @return: dict of the form { 'archive': archive_file_name, 'members': { member_name: [size, sha256] } }
+    """
+    return read_manifest(get_checksums_path(archive_path))
+
+
+def remove_backup(archive_path):
+    """
+    Deletes a backup archive along with its checksum manifest
+
+    @type archive_path: str
+    @param archive_path: the path of the archive
+    @return: None
+    """
+    os.remove(archive_path)
+    checksums_path = get_checksums_path(archive_path)
+    if os.path.isfile(checksums_path):
+        os.remove(checksums_path)
+
+
+def verify(archive_paths, workers=None):
+    """
+    Checks archives against their checksum manifests by streaming every member through SHA-256, without extracting
+        anything to disk. Zip members are spread over a process pool in batches, across all the archives at once;
+        each tar archive is read sequentially by one process, as tar streams can't be read out of order.
+
+    @type archive_paths: list
+    @param archive_paths: paths of the archives to verify
+    @type workers: int
+    @param workers: number of processes reading members concurrently, None or 1 reads them one at a time
+    @return: dict of the form { archive_path: { 'missing': [...], 'mismatched': [...], 'unexpected': [...],
+        'errors': [...] } } listing member names (and read errors) per archive; an archive whose lists are all empty
+        is intact
+    """
+    hashed = _hash_archives(archive_paths, workers)
+    results = {}
+    for archive_path in archive_paths:
+        members, errors = hashed[archive_path]
+        problems = {'missing': [], 'mismatched': [], 'unexpected': [], 'errors': list(errors)}
+        if os.path.isfile(archive_path):
+            checksums = read_checksums(archive_path)
+            if checksums is None:
+                problems['errors'].append("no checksum manifest")
+            else:
+                expected = checksums['members']
+                for name in sorted(expected):
+                    if name not in members:
+                        problems['missing'].append(name)
+                    elif members[name] != expected[name]:
+                        problems['mismatched'].append(name)
+                problems['unexpected'] = sorted(set(members) - set(expected))
+        results[archive_path] = problems
+    return results
+
+
+def _hash_archives(archive_paths, workers):
+    """
+    Hashes the members of archives
+    @return: dict of the form { archive_path: ({ member_name: [size, sha256] }, [error messages]) }
+    """
+    results = dict((archive_path, ({}, [])) for archive_path in archive_paths)
+    tasks = []
+    for archive_path in archive_paths:
+        try:
+            tasks.extend(_get_hash_tasks(archive_path))
+        except (IOError, zipfile.BadZipfile) as e:
+            results[archive_path][1].append(str(e))
+    if workers is None or workers <= 1 or len(tasks) < 2:
+        hashed = (_hash_archive_members(task) for task in tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(workers)
+        hashed = pool.imap_unordered(_hash_archive_members, tasks)
+    try:
+        for archive_path, members, errors in hashed:
+            results[archive_path][0].update(members)
+            results[archive_path][1].extend(errors)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return results
+
+
+def _get_hash_tasks(archive_path):
+    """
+    Splits the hashing of an archive into tasks for _hash_archive_members
+    @return: list of (archive_path, member names, or None for every member)
+    """
+    if not os.path.isfile(archive_path):
+        raise IOError("{} does not exist.".format(archive_path))
+    if not zipfile.is_zipfile(archive_path):
+        return [(archive_path, None)]
+    with zipfile.ZipFile(archive_path, 'r') as z:
+        members = [(info.filename, info.file_size) for info in z.infolist() if not info.filename.endswith('/')]
+    return [(archive_path, batch) for batch in _batch_members(members)]
+
+
+def _hash_archive_members(task):
+    """
+    Streams members of an archive through SHA-256
+    @return: (archive_path, { member_name: [size, sha256] }, [error messages])
+    """
+    archive_path, member_names = task
+    members = {}
+    errors = []
+    try:
+        if member_names is None:
+            for name, f in _iter_tar_members(archive_path):
+                members[name] = _hash_stream(f)
+        else:
+            with zipfile.ZipFile(archive_path, 'r') as z:
+                for name in member_names:
+                    # A damaged member can fail in many ways (bad CRC, bad deflate data, truncation, ...)
+                    try:
+                        f = z.open(name)
+                        try:
+                            members[name] = _hash_stream(f)
+                        finally:
+                            f.close()
+                    except Exception as e:
+                        errors.append("{}: {}".format(name, e))
+    except Exception as e:
+        errors.append(str(e))
+    return archive_path, members, errors
+
+
+def _hash_stream(f):
+    file_hash = hashlib.sha256()
+    size = 0
+    while True:
+        data = f.read(ARCHIVE_READ_SIZE)
+        if not data:
+            break
+        size += len(data)
+        file_hash.update(data)
+    return [size, file_hash.hexdigest()]
+
+
+def _iter_tar_members(archive_path):
+    """
+    Yields (member_name, file-like object) for every regular file of a tar archive, reading it as a stream
+    """
+    with open(archive_path, 'rb') as f:
+        stream = f
+        mode = 'r|*'
+        if archive_path.endswith('.tar.zst'):
+            if zstandard is None:
+                raise ArgumentException("tar.zst archives require the 'zstandard' package")
+            stream = zstandard.ZstdDecompressor().stream_reader(f)
+            mode = 'r|'
+        tar = tarfile.open(fileobj=stream, mode=mode)
+        try:
+            for member in tar:
+                if member.isfile():
+                    yield member.name, tar.extractfile(member)
+        finally:
+            tar.close()
+
+
+def parse_backup_file_name(file_name):
+    """
+    Parses the name of a backup file, as named by get_output_file_path (by this or earlier versions)
+
+    @type file_name: str
+    @param file_name: name of a file in an output directory
+    @return: (source_name, datetime, container), None if the file is not a backup
+    """
+    match = _BACKUP_FILE_NAME_PATTERN.match(file_name)
+    if match is None:
+        return None
+    container = re.sub(r'_[0-9]+', '', match.group('extension'))[1:]
+    if container not in CONTAINERS:
+        return None
+    try:
+        created = datetime.datetime(*[int(field) for field in match.group('time').split('_')])
+    except ValueError:
+        return None
+    return match.group('source'), created, container
+
+
+# A backup recorded in a BackupCatalog; parent is the file name of the archive an incremental backup builds on
+CatalogEntry = collections.namedtuple('CatalogEntry', ('file_name', 'source', 'created', 'parent'))
+
+
+class BackupCatalog(object):
+    """
+    Index of the backups in an output directory, kept in a SQLite database in that directory, so the backups of a
+        source can be listed in order without listing and parsing a directory of tens of thousands of archives. The
+        directory is only listed again when its modification time shows files were added or removed behind the
+        catalog's back.
+    """
+
+    def __init__(self, output_dir_path, sync=True):
+        """
+        Opens the catalog of the given output directory, creating it if there is none, and brings it up to date
+        @type output_dir_path: str
+        @param output_dir_path: the path of the directory holding the backups
+        @type sync: bool
+        @param sync: if False, the catalog is opened as it is, e.g. to add a backup without listing the directory
+        """
+        if not os.path.isdir(output_dir_path):
+            raise file_sys_manip.DirectoryError("{} is not a directory".format(output_dir_path))
+        self.output_dir_path = os.path.abspath(output_dir_path)
+        self._connection = sqlite3.connect(os.path.join(self.output_dir_path, CATALOG_FILE_NAME))
+        self._connection.text_factory = str
+        self._connection.execute('CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT)')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS backups (file_name TEXT PRIMARY KEY, source TEXT, created TEXT, parent TEXT)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS backups_by_source ON backups (source, created)')
+        self._connection.commit()
+        if sync:
+            self.sync()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def sync(self, force=False):
+        """
+        Adds the backups missing from the catalog and drops the ones no longer in the directory
+        @type force: bool
+        @param force: if True, the directory is listed even if its modification time says nothing changed
+        """
+        dir_mtime = os.stat(self.output_dir_path).st_mtime
+        row = self._connection.execute("SELECT value FROM settings WHERE name = 'dir_mtime'").fetchone()
+        if not force and row is not None and float(row[0]) == dir_mtime:
+            return
+        known = set(file_name for file_name, in self._connection.execute('SELECT file_name FROM backups'))
+        present = set()
+        for file_name in os.listdir(self.output_dir_path):
+            parsed = parse_backup_file_name(file_name)
+            if parsed is None:
+                continue
+            present.add(file_name)
+            if file_name not in known:
+                self._insert(file_name, parsed)
+        self._connection.executemany(
+            'DELETE FROM backups WHERE file_name = ?', ((file_name,) for file_name in known - present))
+        self._set_dir_mtime(dir_mtime)
+        self._connection.commit()
+
+    def _insert(self, file_name, parsed):
+        source, created, container = parsed
+        parent = None
+        if container == 'zip':
+            parent = _read_parent(os.path.join(self.output_dir_path, file_name))
+        self._connection.execute('INSERT OR REPLACE INTO backups VALUES (?, ?, ?, ?)',
+                                 (file_name, source, created.strftime('%Y-%m-%d %H:%M:%S'), parent))
+
+    def _set_dir_mtime(self, dir_mtime):
+        self._connection.execute("INSERT OR REPLACE INTO settings VALUES ('dir_mtime', ?)", (repr(dir_mtime),))
+
+    def add(self, file_path, dir_mtime=None):
+        """
+        Records a backup just written to the output directory
+        @type file_path: str
+        @param file_path: the path of the backup file
+        @type dir_mtime: float
+        @param dir_mtime: modification time of the output directory before the backup was written, if the catalog may
+            not be up to date (i.e. it was opened without syncing); the catalog is then only marked up to date if that
+            time is the one it recorded, so whatever else changed is picked up by the next sync
+        """
+        file_name = os.path.basename(file_path)
+        parsed = parse_backup_file_name(file_name)
+        if parsed is None:
+            raise ArgumentException("{} is not named like a backup".format(file_name))
+        self._insert(file_name, parsed)
+        row = self._connection.execute("SELECT value FROM settings WHERE name = 'dir_mtime'").fetchone()
+        if dir_mtime is None or (row is not None and float(row[0]) == dir_mtime):
+            self._set_dir_mtime(os.stat(self.output_dir_path).st_mtime)
+        self._connection.commit()
+
+    def remove(self, file_names):
+        """
+        Drops backups from the catalog, in one transaction
+        @type file_names: iterable
+        @param file_names: names of the backup files
+        """
+        self._connection.executemany('DELETE FROM backups WHERE file_name = ?', ((name,) for name in file_names))
+        self._set_dir_mtime(os.stat(self.output_dir_path).st_mtime)
+        self._connection.commit()
+
+    def list_backups(self, source=None):
+        """
+        Returns the backups in the catalog, oldest first
+        @type source: str
+        @param source: if given, only the backups of the file/directory with this name are listed
+        @return: list of CatalogEntry
+        """
+        query = 'SELECT file_name, source, created, parent FROM backups'
+        parameters = ()
+        if source is not None:
+            query += ' WHERE source = ?'
+            parameters = (source,)
+        return [CatalogEntry(file_name, entry_source, datetime.datetime.strptime(created, '%Y-%m-%d %H:%M:%S'), parent)
+                for file_name, entry_source, created, parent in
+                self._connection.execute(query + ' ORDER BY created, file_name', parameters)]
+
+    def close(self):
+        self._connection.close()
+
+
+def _read_parent(archive_path):
+    """
+    Returns the file name of the archive an incremental backup builds on, None for a full backup
+    """
+    try:
+        with zipfile.ZipFile(archive_path, 'r') as z:
+            if INCREMENT_MEMBER_NAME not in z.NameToInfo:
+                return None
+            return json.loads(z.read(INCREMENT_MEMBER_NAME))['parent']
+    except (IOError, zipfile.BadZipfile, ValueError, KeyError):
+        return None
+
+
+def _add_to_catalog(output_file_path, dir_mtime):
+    """
+    Records a new backup in the catalog of its output directory, if that directory has one, without listing the
+        directory
+    @param dir_mtime: modification time of the output directory before the backup was written, see _get_dir_mtime
+    """
+    output_dir_path = os.path.dirname(os.path.abspath(output_file_path))
+    if os.path.isfile(os.path.join(output_dir_path, CATALOG_FILE_NAME)):
+        with BackupCatalog(output_dir_path, sync=False) as catalog:
+            catalog.add(output_file_path, dir_mtime)
+
+
+def _get_dir_mtime(dir_path):
+    """
+    Returns the modification time of a directory, None if it does not exist
+    """
+    try:
+        return os.stat(dir_path).st_mtime
+    except OSError:
+        return None
+
+
+def select_backups_to_prune(entries, keep_last=0, keep_daily=0, keep_weekly=0, keep_monthly=0):
+    """
+    Applies a retention policy to the backups of one source. A backup is kept if it is one of the keep_last newest, or
+        the newest of one of the keep_daily newest days (keep_weekly ISO weeks, keep_monthly months) that have backups.
+        The archives an incremental backup that is kept builds on are always kept too.
+
+    @type entries: list
+    @param entries: the backups of one source, as CatalogEntry
+    @return: list of the CatalogEntry to prune, oldest first
+    """
+    newest_first = sorted(entries, key=lambda entry: (entry.created, entry.file_name), reverse=True)
+    keep = set(entry.file_name for entry in newest_first[:keep_last])
+    rules = (
+        (keep_daily, lambda created: created.date()),
+        (keep_weekly, lambda created: created.isocalendar()[:2]),
+        (keep_monthly, lambda created: (created.year, created.month)),
+    )
+    for count, get_period in rules:
+        periods = set()
+        for entry in newest_first:
+            if len(periods) >= count:
+                break
+            period = get_period(entry.created)
+            if period not in periods:
+                periods.add(period)
+                keep.add(entry.file_name)
+    entries_by_name = dict((entry.file_name, entry) for entry in entries)
+    for file_name in list(keep):
+        parent = entries_by_name[file_name].parent
+        while parent is not None and parent not in keep and parent in entries_by_name:
+            keep.add(parent)
+            parent = entries_by_name[parent].parent
+    return [entry for entry in reversed(newest_first) if entry.file_name not in keep]
+
+
+def prune_backups(output_dir_path, keep_last=0, keep_daily=0, keep_weekly=0, keep_monthly=0, source=None,
+                  dry_run=False):
+    """
+    Deletes the backups in an output directory that the given retention policy (see select_backups_to_prune) does not
+        keep, in one pass over the directory's catalog, which is created if it does not exist yet. Each source is
+        pruned separately.
+
+    @type output_dir_path: str
+    @param output_dir_path: the path of the directory holding the backups
+    @type source: str
+    @param source: if given, only the backups of the file/directory with this name are pruned
+    @type dry_run: bool
+    @param dry_run: if True, nothing is deleted
+    @return: list of the paths of the pruned (or, with dry_run, prunable) backups
+    """
+    if not (keep_last or keep_daily or keep_weekly or keep_monthly):
+        raise ArgumentException("A retention policy must keep at least one backup")
+    with BackupCatalog(output_dir_path) as catalog:
+        entries_by_source = collections.defaultdict(list)
+        for entry in catalog.list_backups(source):
+            entries_by_source[entry.source].append(entry)
+        pruned = []
+        for source_entries in entries_by_source.itervalues():
+            pruned.extend(entry.file_name for entry in select_backups_to_prune(
+                source_entries, keep_last, keep_daily, keep_weekly, keep_monthly))
+        if not dry_run:
+            for file_name in pruned:
+                try:
+                    remove_backup(os.path.join(catalog.output_dir_path, file_name))
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+            catalog.remove(pruned)
+    return [os.path.join(output_dir_path, file_name) for file_name in pruned]
+
+
 class ArgumentException(Exception):
     pass
 
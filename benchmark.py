@@ -0,0 +1,285 @@
+"""
+Benchmarks the file system utilities against a synthetic directory tree and tracks regressions. Results are written
+as JSON; when a baseline results file is given, any benchmark slower than the baseline by more than the threshold is
+reported and the exit status is 1.
+
+usage: python benchmark.py [-n files] [-d depth] [-f fanout] [-s median_file_size] [-r repeat] [-o results.json]
+                           [-b baseline.json] [-t threshold]
+"""
+
+import sys
+import os
+import shutil
+import json
+import random
+import platform
+import tempfile
+import timeit
+import unittest
+import StringIO
+import file_sys_manip
+import file_search
+import validation
+import backup
+import chunk_store
+
+
+DEFAULT_TREE_CONFIG = {
+    'files': 200,
+    'depth': 3,
+    'fanout': 4,
+    'median_size': 4 * 1024,
+    # Spread of the log-normal file size distribution
+    'size_sigma': 1.0,
+    'max_size': 1024 * 1024,
+    'seed': 0,
+}
+DEFAULT_REPEAT = 3
+# Fraction by which a benchmark may be slower than its baseline before it counts as a regression
+DEFAULT_THRESHOLD = 0.2
+# Text every generated file contains once, near its end, for the search benchmarks
+NEEDLE = 'needle_in_the_haystack'
+# Bytes split into chunks by the chunk store benchmark
+CHUNK_BENCHMARK_SIZE = 8 * 1024 * 1024
+_WORDS = ('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'do', 'eiusmod',
+          'tempor', 'incididunt', 'ut', 'labore', 'et', 'dolore', 'magna', 'aliqua')
+
+
+def generate_tree(root_dir_path, config=None):
+    """
+    Creates a reproducible synthetic directory tree of text files
+    :type root_dir_path: str
+    :param root_dir_path: path of the directory the tree is created in, created if it does not exist
+    :type config: dict
+    :param config: overrides for DEFAULT_TREE_CONFIG: the number of files, directory depth and fanout, and the
+        log-normal file size distribution
+    :return: list of the paths of the created files
+    """
+    tree_config = dict(DEFAULT_TREE_CONFIG)
+    tree_config.update(config or {})
+    rand = random.Random(tree_config['seed'])
+    dir_paths = [root_dir_path]
+    level = [root_dir_path]
+    for depth in xrange(tree_config['depth']):
+        level = [os.path.join(parent, 'dir_{}_{}'.format(depth, i))
+                 for parent in level for i in xrange(tree_config['fanout'])]
+        dir_paths.extend(level)
+    for dir_path in dir_paths:
+        if not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+    # A pool of lines to draw from keeps generation fast while file contents still differ
+    lines = [' '.join(rand.choice(_WORDS) for i in xrange(rand.randint(4, 16))) + '\n' for j in xrange(512)]
+    file_paths = []
+    for index in xrange(tree_config['files']):
+        size = int(min(tree_config['max_size'],
+                       rand.lognormvariate(0, tree_config['size_sigma']) * tree_config['median_size']))
+        contents = []
+        written = 0
+        while written < size:
+            line = rand.choice(lines)
+            contents.append(line)
+            written += len(line)
+        contents.append(NEEDLE + '\n')
+        file_path = os.path.join(rand.choice(dir_paths), 'file_{}.txt'.format(index))
+        with open(file_path, 'w') as f:
+            f.write(''.join(contents))
+        file_paths.append(file_path)
+    return file_paths
+
+
+def time_call(func, repeat=DEFAULT_REPEAT, setup=None):
+    """
+    Times a function
+    :param func: function taking no arguments
+    :param repeat: number of times func is called
+    :param setup: function called, untimed, before each call of func
+    :return: dict of the form { 'best': seconds, 'mean': seconds, 'repeat': repeat }
+    """
+    times = []
+    for i in xrange(repeat):
+        if setup is not None:
+            setup()
+        start = timeit.default_timer()
+        func()
+        times.append(timeit.default_timer() - start)
+    return {'best': min(times), 'mean': sum(times) / len(times), 'repeat': repeat}
+
+
+def run_benchmarks(work_dir_path, config=None, repeat=DEFAULT_REPEAT):
+    """
+    Generates a synthetic tree in work_dir_path and times each utility against it
+    :type work_dir_path: str
+    :param work_dir_path: path of an empty scratch directory
+    :type config: dict
+    :param config: tree configuration, see generate_tree
+    :type repeat: int
+    :param repeat: number of timed runs per benchmark
+    :return: dict of the form { 'config': tree_config, 'environment': {...}, 'results': { name: timing } }
+    """
+    tree_config = dict(DEFAULT_TREE_CONFIG)
+    tree_config.update(config or {})
+    tree_dir_path = os.path.join(work_dir_path, 'tree')
+    output_dir_path = os.path.join(work_dir_path, 'output')
+    os.makedirs(output_dir_path)
+    file_paths = generate_tree(tree_dir_path, tree_config)
+    zip_path = os.path.join(output_dir_path, 'tree.zip')
+
+    def clear_output():
+        shutil.rmtree(output_dir_path)
+        os.mkdir(output_dir_path)
+
+    def read_lines(lowered=False):
+        for file_path in file_paths:
+            file_sys_manip.get_file_line_list_from_cache(file_path, lowered)
+
+    def search_text():
+        for file_path in file_paths:
+            file_search.is_text_in_file(NEEDLE, file_path)
+
+    def search_pattern():
+        for file_path in file_paths:
+            file_search.is_pattern_in_file(r'needle_\w+_haystack$', file_path)
+
+    # Chunking bounds how fast the chunk store can back up anything, so it is timed on its own over random bytes
+    chunk_data = os.urandom(CHUNK_BENCHMARK_SIZE)
+
+    def iter_chunks():
+        for chunk in chunk_store.iter_chunks(StringIO.StringIO(chunk_data)):
+            pass
+
+    validator = validation.Validator({'x': lambda x: type(x) is int}, {float})
+    values = range(10000)
+
+    def validate():
+        for value in values:
+            validator.is_valid('x', value)
+
+    # The legacy decorator and its declarative equivalent, to compare their per call overhead
+    previous_types = getattr(validation.type_validator, 'types', None)
+    validation.type_validator.types = {'greater_than_one': float}
+
+    @validation.type_validator
+    def greater_than_one(value):
+        return value > 1
+    validation.type_validator.types = previous_types
+    declarative_greater_than_one = validation.all_of(validation.is_type(float), validation.in_range(1, exclusive=True))
+    float_values = [float(value) for value in values]
+
+    def validate_decorated():
+        for value in float_values:
+            greater_than_one(value)
+
+    def validate_declarative():
+        for value in float_values:
+            declarative_greater_than_one(value)
+
+    results = {
+        'zip_dir': time_call(lambda: file_sys_manip.zip_dir(tree_dir_path, zip_path), repeat, clear_output),
+        'backup': time_call(lambda: backup.backup(tree_dir_path, output_dir_path), repeat, clear_output),
+        'get_file_paths': time_call(lambda: file_sys_manip.get_file_paths(tree_dir_path, {'txt'}), repeat),
+        'get_file_line_list_from_cache_cold': time_call(
+            read_lines, repeat, lambda: file_sys_manip.file_line_list_cache.clear()),
+        'get_file_line_list_from_cache_warm': time_call(read_lines, repeat, read_lines),
+        'is_text_in_file': time_call(search_text, repeat),
+        'is_pattern_in_file': time_call(search_pattern, repeat),
+        'chunk_store_iter_chunks': time_call(iter_chunks, repeat),
+        'validator_is_valid': time_call(validate, repeat),
+        'type_validator_decorator': time_call(validate_decorated, repeat),
+        'declarative_validator': time_call(validate_declarative, repeat),
+    }
+    return {
+        'config': tree_config,
+        'environment': {'python': platform.python_version(), 'platform': platform.platform()},
+        'results': results,
+    }
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Returns the benchmarks which got slower than their baseline by more than the threshold; best times are compared
+    :type results: dict
+    :param results: results, as returned by run_benchmarks
+    :type baseline: dict
+    :param baseline: baseline results, as returned by run_benchmarks
+    :type threshold: float
+    :param threshold: fraction by which a benchmark may be slower than its baseline
+    :return: dict of the form { name: (baseline_seconds, seconds) } of every regression
+    """
+    regressions = {}
+    for name, timing in results['results'].iteritems():
+        baseline_timing = baseline['results'].get(name)
+        if baseline_timing is not None and timing['best'] > baseline_timing['best'] * (1 + threshold):
+            regressions[name] = (baseline_timing['best'], timing['best'])
+    return regressions
+
+
+def main(args):
+    options = {'-n': None, '-d': None, '-f': None, '-s': None, '-r': None, '-o': None, '-b': None, '-t': None}
+    for index, arg in enumerate(args[1:], 1):
+        if arg in options:
+            if index + 1 == len(args):
+                print "Missing value after '{}'".format(arg)
+                print __doc__
+                return 2
+            options[arg] = args[index + 1]
+    config = {}
+    for option, key in (('-n', 'files'), ('-d', 'depth'), ('-f', 'fanout'), ('-s', 'median_size')):
+        if options[option] is not None:
+            config[key] = int(options[option])
+    repeat = DEFAULT_REPEAT if options['-r'] is None else int(options['-r'])
+    threshold = DEFAULT_THRESHOLD if options['-t'] is None else float(options['-t'])
+
+    work_dir_path = tempfile.mkdtemp(prefix='pyutil_benchmark_')
+    try:
+        results = run_benchmarks(work_dir_path, config, repeat)
+    finally:
+        shutil.rmtree(work_dir_path)
+    for name, timing in sorted(results['results'].iteritems()):
+        print "{:<40} best {:.4f}s  mean {:.4f}s".format(name, timing['best'], timing['mean'])
+    if options['-o'] is not None:
+        with open(options['-o'], 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if options['-b'] is not None:
+        with open(options['-b'], 'r') as f:
+            regressions = compare(results, json.load(f), threshold)
+        for name, (baseline_seconds, seconds) in sorted(regressions.iteritems()):
+            print "REGRESSION {}: {:.4f}s -> {:.4f}s".format(name, baseline_seconds, seconds)
+        if regressions:
+            return 1
+    return 0
+
+
+#--------------------
+# Tests
+#--------------------
+class BenchmarkTests(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = file_sys_manip.generate_unique_path("test_dir")
+        os.mkdir(self.test_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_generate_tree(self):
+        config = {'files': 10, 'depth': 2, 'fanout': 2, 'median_size': 100}
+        file_paths = generate_tree(os.path.join(self.test_dir, 'a'), config)
+        self.assertEqual(10, len(file_paths))
+        self.assertTrue(all(file_search.is_text_in_file(NEEDLE, file_path) for file_path in file_paths))
+        # The same configuration always generates the same tree
+        other_file_paths = generate_tree(os.path.join(self.test_dir, 'b'), config)
+        for file_path, other_file_path in zip(file_paths, other_file_paths):
+            with open(file_path, 'r') as f:
+                with open(other_file_path, 'r') as other_f:
+                    self.assertEqual(f.read(), other_f.read())
+
+    def test_run_benchmarks(self):
+        results = run_benchmarks(self.test_dir, {'files': 5, 'depth': 1, 'fanout': 2, 'median_size': 100}, 1)
+        self.assertTrue('zip_dir' in results['results'])
+        self.assertEqual({}, compare(results, results))
+        slower = json.loads(json.dumps(results))
+        slower['results']['zip_dir']['best'] = results['results']['zip_dir']['best'] * 2 + 1
+        self.assertEqual(['zip_dir'], compare(slower, results).keys())
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,327 @@
+"""
+A persistent record of the size, modification time and hash of every file in a directory tree, kept in a SQLite
+database in the tree root. Each update reports which files were added, changed or removed since the last saved
+update, so tools run over the same tree again and again (backups, searches) only need to touch what changed. Files
+are only hashed when their size or modification time differ from the record, and a file whose modification time
+changed but whose contents did not is not reported as changed.
+"""
+
+import unittest
+import os
+import shutil
+import sqlite3
+import fnmatch
+import multiprocessing.pool
+import file_sys_manip
+import instrumentation
+
+
+# Name of the cache database, kept in the root of the tree it describes
+CACHE_FILE_NAME = '.change_cache.sqlite'
+CACHE_VERSION = 1
+# Suffixes of the files SQLite keeps next to the database while it is being written
+_SQLITE_SIDE_FILE_SUFFIXES = ('', '-journal', '-wal', '-shm')
+# Glob matching the names of cache databases (including ones named after their source, e.g. 'src.change_cache.sqlite')
+# and their side files, which tools archiving or scanning a tree must leave out
+CACHE_FILE_PATTERN = '*' + CACHE_FILE_NAME + '*'
+
+
+def is_cache_file(file_name):
+    """
+    Returns True if the given file name is that of a cache database or one of its side files
+    """
+    return fnmatch.fnmatch(file_name, CACHE_FILE_PATTERN)
+
+
+class ChangeCache(object):
+    """
+    Change detection cache of one directory tree. Call update to find out what changed, and save once the changes
+    have been dealt with; an update that is never saved is reported again by the next one.
+    """
+
+    def __init__(self, root_dir_path, cache_path=None, hash_name='sha256'):
+        """
+        Opens the cache of the given tree, creating it if there is none
+        :type root_dir_path: str
+        :param root_dir_path: path of the root directory of the tree
+        :type cache_path: str
+        :param cache_path: path of the cache database, CACHE_FILE_NAME in the root directory if None
+        :type hash_name: str
+        :param hash_name: name of the hashlib algorithm the files are hashed with
+        """
+        if not os.path.isdir(root_dir_path):
+            raise file_sys_manip.DirectoryError("{} is not a directory".format(root_dir_path))
+        self.root_dir_path = os.path.abspath(root_dir_path)
+        if cache_path is None:
+            cache_path = os.path.join(self.root_dir_path, CACHE_FILE_NAME)
+        self.cache_path = os.path.abspath(cache_path)
+        self.hash_name = hash_name
+        self._connection = sqlite3.connect(self.cache_path)
+        # Paths are kept as they were given rather than coming back as unicode
+        self._connection.text_factory = str
+        self._connection.execute('CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT)')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, hash TEXT)')
+        settings = dict(self._connection.execute('SELECT name, value FROM settings'))
+        expected_settings = {'version': str(CACHE_VERSION), 'hash_name': hash_name}
+        if settings != expected_settings:
+            # Records made by another version or with another hash can't be compared against, start over
+            self._connection.execute('DELETE FROM files')
+            self._connection.execute('DELETE FROM settings')
+            self._connection.executemany('INSERT INTO settings VALUES (?, ?)', expected_settings.items())
+            self._connection.commit()
+        self.last_update_stats = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def update(self, extensions=None, excluded_dir_paths=None, workers=None):
+        """
+        Compares the tree against the cache and records its current state; the new state is only persisted by save.
+        Only the records of files the filters let through can be reported as removed, so tools tracking different
+        parts of the same tree don't drop each other's records.
+        :param extensions: set of extensions of the files to track, None tracks every file
+        :param excluded_dir_paths: directory paths to leave out, as accepted by file_sys_manip.get_file_paths
+        :type workers: int
+        :param workers: number of threads hashing files concurrently, None or 1 hashes them one at a time
+        :rtype ChangeSet
+        :return: the files added, changed and removed since the last saved update
+        """
+        excluded_file_paths = set(self.cache_path + suffix for suffix in _SQLITE_SIDE_FILE_SUFFIXES)
+        records = dict((path, (size, mtime, file_hash)) for path, size, mtime, file_hash in
+                       self._connection.execute('SELECT path, size, mtime, hash FROM files'))
+        changes = ChangeSet()
+        seen = set()
+        # [ (relative_path, file_path, stat, record) ] of the files which need hashing
+        to_hash = []
+        for file_path in file_sys_manip.iter_file_paths(self.root_dir_path, extensions, excluded_dir_paths):
+            if file_path in excluded_file_paths or is_cache_file(os.path.basename(file_path)):
+                continue
+            relative_path = os.path.relpath(file_path, self.root_dir_path).replace(os.sep, '/')
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue
+            seen.add(relative_path)
+            record = records.get(relative_path)
+            if record is not None and record[0] == stat.st_size and record[1] == stat.st_mtime:
+                changes.unchanged.add(file_path)
+            else:
+                to_hash.append((relative_path, file_path, stat, record))
+
+        if workers is None or workers <= 1 or len(to_hash) < 2:
+            hashes = (self._hash_file(item[1]) for item in to_hash)
+            pool = None
+        else:
+            pool = multiprocessing.pool.ThreadPool(workers)
+            hashes = pool.imap(self._hash_file, [item[1] for item in to_hash], 16)
+        rows = []
+        # Files which had to be hashed only to find their contents hadn't changed
+        unchanged_hashed = 0
+        try:
+            for (relative_path, file_path, stat, record), file_hash in zip(to_hash, hashes):
+                if file_hash is None:
+                    # Vanished or unreadable since it was listed, it will be picked up by a later update
+                    seen.discard(relative_path)
+                    continue
+                if record is None:
+                    changes.added.add(file_path)
+                elif record[0] != stat.st_size or record[2] != file_hash:
+                    changes.changed.add(file_path)
+                else:
+                    changes.unchanged.add(file_path)
+                    unchanged_hashed += 1
+                rows.append((relative_path, stat.st_size, stat.st_mtime, file_hash))
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        is_tracked = self._get_tracked_filter(extensions, excluded_dir_paths)
+        removed = [relative_path for relative_path in records
+                   if relative_path not in seen and is_tracked(relative_path)]
+        changes.removed.update(
+            os.path.join(self.root_dir_path, relative_path.replace('/', os.sep)) for relative_path in removed)
+        self._connection.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)', rows)
+        self._connection.executemany('DELETE FROM files WHERE path = ?', ((path,) for path in removed))
+        instrumentation.record_cache('change_cache', hits=len(changes.unchanged) - unchanged_hashed,
+                                     misses=len(to_hash))
+        self.last_update_stats = {
+            'added': len(changes.added),
+            'changed': len(changes.changed),
+            'removed': len(changes.removed),
+            'unchanged': len(changes.unchanged),
+            'hashed': len(to_hash),
+        }
+        return changes
+
+    def _get_tracked_filter(self, extensions, excluded_dir_paths):
+        """
+        Returns a function telling whether a file (given by its relative path) is let through by the given filters,
+        the way file_sys_manip.iter_file_paths applies them
+        """
+        if isinstance(excluded_dir_paths, str):
+            excluded_dir_paths = {excluded_dir_paths}
+        excluded_dir_paths = set(os.path.normcase(os.path.abspath(path)) for path in excluded_dir_paths or ())
+
+        def is_tracked(relative_path):
+            file_path = os.path.join(self.root_dir_path, relative_path.replace('/', os.sep))
+            if extensions is not None and file_sys_manip._get_extension(os.path.basename(file_path)) not in extensions:
+                return False
+            dir_path = os.path.dirname(file_path)
+            while excluded_dir_paths:
+                if os.path.normcase(dir_path) in excluded_dir_paths:
+                    return False
+                if dir_path == self.root_dir_path or os.path.dirname(dir_path) == dir_path:
+                    break
+                dir_path = os.path.dirname(dir_path)
+            return True
+        return is_tracked
+
+    def _hash_file(self, file_path):
+        try:
+            return file_sys_manip.get_file_hash(file_path, self.hash_name)
+        except (IOError, OSError):
+            return None
+
+    def get_hash(self, file_path):
+        """
+        Returns the recorded hash of a file of the tree, None if the file is not in the cache
+        :type file_path: str
+        :param file_path: path of the file, relative paths being based on the root directory
+        :rtype str
+        """
+        relative_path = os.path.relpath(
+            os.path.join(self.root_dir_path, file_path), self.root_dir_path).replace(os.sep, '/')
+        row = self._connection.execute('SELECT hash FROM files WHERE path = ?', (relative_path,)).fetchone()
+        return None if row is None else row[0]
+
+    def get_records(self):
+        """
+        Returns the state recorded by the last update (or the last saved one if there was no update since)
+        :return: dict of the form { relative_path: [size, mtime, hash] }, relative paths always use '/'
+        """
+        return dict((path, [size, mtime, file_hash]) for path, size, mtime, file_hash in
+                    self._connection.execute('SELECT path, size, mtime, hash FROM files'))
+
+    def save(self):
+        """
+        Persists the state recorded by the last update, so the next update only reports what changed after it
+        """
+        self._connection.commit()
+
+    def close(self):
+        """
+        Closes the cache, discarding any update that was not saved
+        """
+        self._connection.close()
+
+
+class ChangeSet(object):
+    """
+    The outcome of ChangeCache.update, as sets of file paths
+    """
+
+    def __init__(self):
+        self.added = set()
+        self.changed = set()
+        self.removed = set()
+        self.unchanged = set()
+
+    def get_modified(self):
+        """
+        Returns the set of the paths of the files which were added or changed, i.e. which need processing again
+        """
+        return self.added | self.changed
+
+    def __nonzero__(self):
+        return bool(self.added or self.changed or self.removed)
+
+    def __repr__(self):
+        return "ChangeSet(added={}, changed={}, removed={}, unchanged={})".format(
+            len(self.added), len(self.changed), len(self.removed), len(self.unchanged))
+
+
+#--------------------
+# Tests
+#--------------------
+class ChangeCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = file_sys_manip.generate_unique_path("test_dir")
+        os.mkdir(self.test_dir)
+        self.file_creator = file_sys_manip.FileCreator()
+        self.file_creator.materialize_tree({
+            'same.txt': 'same',
+            'touched.txt': 'touched',
+            'changed.txt': 'changed',
+            'removed.txt': 'removed',
+            'sub_dir': {'nested.txt': 'nested'},
+        }, self.test_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def get_path(self, name):
+        return os.path.join(os.path.abspath(self.test_dir), name)
+
+    def test_update(self):
+        with ChangeCache(self.test_dir) as cache:
+            changes = cache.update()
+            self.assertEqual(5, len(changes.added))
+            self.assertTrue(self.get_path(os.path.join('sub_dir', 'nested.txt')) in changes.added)
+            cache.save()
+        self.assertTrue(os.path.isfile(self.get_path(CACHE_FILE_NAME)))
+
+        touched_path = self.get_path('touched.txt')
+        os.utime(touched_path, (os.path.getatime(touched_path), os.path.getmtime(touched_path) + 10))
+        with open(self.get_path('changed.txt'), 'w') as f:
+            f.write('changed!')
+        os.remove(self.get_path('removed.txt'))
+        with open(self.get_path('added.txt'), 'w') as f:
+            f.write('added')
+
+        with ChangeCache(self.test_dir) as cache:
+            changes = cache.update(workers=2)
+            self.assertEqual({self.get_path('added.txt')}, changes.added)
+            self.assertEqual({self.get_path('changed.txt')}, changes.changed)
+            self.assertEqual({self.get_path('removed.txt')}, changes.removed)
+            self.assertTrue(touched_path in changes.unchanged)
+            # Only the files whose size or modification time differ were hashed
+            self.assertEqual(3, cache.last_update_stats['hashed'])
+            self.assertEqual(file_sys_manip.get_file_hash(touched_path), cache.get_hash('touched.txt'))
+            records = cache.get_records()
+            self.assertEqual({'same.txt', 'touched.txt', 'changed.txt', 'added.txt', 'sub_dir/nested.txt'},
+                             set(records))
+            self.assertEqual(cache.get_hash('added.txt'), records['added.txt'][2])
+            # Not saved, so the same changes are reported again
+        with ChangeCache(self.test_dir) as cache:
+            self.assertEqual({self.get_path('changed.txt')}, cache.update().changed)
+            cache.save()
+            self.assertFalse(cache.update())
+            # Other caches kept in the tree (e.g. a backup's) are never reported either
+            with open(self.get_path('other' + CACHE_FILE_NAME), 'w') as f:
+                f.write('cache')
+            self.assertFalse(cache.update())
+
+    def test_update_filters(self):
+        with open(self.get_path('notes.log'), 'w') as f:
+            f.write('notes')
+        # Two tools sharing the tree's cache, each tracking other files
+        with ChangeCache(self.test_dir) as cache:
+            self.assertEqual(5, len(cache.update({'txt'}).added))
+            cache.save()
+            self.assertEqual({self.get_path('notes.log')}, cache.update({'log'}).added)
+            cache.save()
+            self.assertFalse(cache.update({'txt'}))
+            cache.save()
+            self.assertFalse(cache.update({'log'}))
+            # Files in excluded directories are left alone too
+            self.assertFalse(cache.update(excluded_dir_paths=self.get_path('sub_dir')))
+            cache.save()
+            self.assertTrue('sub_dir/nested.txt' in cache.get_records())
+            # A tracked file which is gone is still reported
+            os.remove(self.get_path('same.txt'))
+            self.assertEqual({self.get_path('same.txt')}, cache.update({'txt'}).removed)
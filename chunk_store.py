@@ -0,0 +1,451 @@
+"""
+A content-addressed, deduplicating backup store. Files are split into variable sized chunks with a rolling hash, so an
+edit only changes the chunks around it, and each chunk is stored once, compressed, under the SHA-256 of its contents.
+Every backup run writes a small snapshot file listing the chunks that make up each file.
+Boundaries are found with numpy when it is installed, the pure Python scan is several times slower.
+"""
+
+import unittest
+import os
+import shutil
+import json
+import random
+import zlib
+import hashlib
+import datetime
+import file_sys_manip
+import change_cache
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+CHUNKS_DIR_NAME = 'chunks'
+SNAPSHOTS_DIR_NAME = 'snapshots'
+SNAPSHOT_EXTENSION = '.json'
+STORE_MARKER_NAME = 'chunk_store.json'
+STORE_VERSION = 1
+
+MIN_CHUNK_SIZE = 2 * 1024
+MAX_CHUNK_SIZE = 64 * 1024
+# A boundary is cut wherever the low bits of the rolling hash are all zero, giving chunks of about 8KB on average
+CHUNK_BOUNDARY_MASK = (1 << 13) - 1
+READ_SIZE = 1024 * 1024
+
+# Gear table for the rolling hash; derived from md5 so chunk boundaries never change between runs or interpreters
+_GEAR = [int(hashlib.md5(chr(i)).hexdigest()[:8], 16) for i in xrange(256)]
+# Only the low bits of the hash decide boundaries, and those only depend on the last _GEAR_WINDOW bytes
+_GEAR_WINDOW = CHUNK_BOUNDARY_MASK.bit_length()
+_LOW_GEAR = [value & CHUNK_BOUNDARY_MASK for value in _GEAR]
+
+
+def is_store(store_path):
+    """
+    Returns True if the given path is the root directory of a chunk store, False otherwise
+    :param store_path: path of the directory to check
+    :return: True if the given path is the root directory of a chunk store, False otherwise
+    """
+    return os.path.isfile(os.path.join(store_path, STORE_MARKER_NAME))
+
+
+def init_store(store_path):
+    """
+    Creates an empty chunk store in the given directory, does nothing if there is already one there
+    :param store_path: path of the directory which will hold the store, created if it does not exist
+    :return: None
+    """
+    if is_store(store_path):
+        return
+    if os.path.exists(store_path) and not os.path.isdir(store_path):
+        raise file_sys_manip.DirectoryError("{} is not a directory".format(store_path))
+    for dir_name in (CHUNKS_DIR_NAME, SNAPSHOTS_DIR_NAME):
+        dir_path = os.path.join(store_path, dir_name)
+        if not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+    with open(os.path.join(store_path, STORE_MARKER_NAME), 'w') as f:
+        json.dump({'version': STORE_VERSION}, f)
+
+
+def iter_chunks(file_obj):
+    """
+    Splits the contents of a file into content defined chunks using a gear rolling hash
+    :param file_obj: file opened for binary reading
+    :return: generator of the chunks (str), which concatenated give the file's contents
+    """
+    data = ''
+    # Start of the data not yet chunked; the buffer is only compacted once per read, copying the rest of the buffer
+    # after every chunk would make chunking a file quadratic in READ_SIZE / chunk size
+    offset = 0
+    while True:
+        block = file_obj.read(READ_SIZE)
+        data = data[offset:] + block
+        offset = 0
+        candidates = _find_boundary_candidates(data)
+        # Only cut once a full chunk is buffered, the best boundary could lie beyond what has been read so far
+        while len(data) - offset >= MAX_CHUNK_SIZE or (not block and offset < len(data)):
+            cut = _find_chunk_boundary(data, offset, candidates)
+            yield data[offset:offset + cut]
+            offset += cut
+        if not block:
+            return
+
+
+def _find_boundary_candidates(data):
+    """
+    Returns the sorted indexes of the data at which the rolling hash over the full window ending there is a boundary,
+    computed for the whole buffer at once, or None when numpy is not installed
+    """
+    if numpy is None or len(data) < _GEAR_WINDOW:
+        return None
+    # 16 bit sums are enough, overflowing them only loses bits above the mask.
+    # Element i of hashes is the hash of the hash_width bytes ending at data[i + hash_width - 1], likewise for
+    # powers; windows are doubled and merged as in binary exponentiation, a few passes over the data in all
+    powers = numpy.array(_LOW_GEAR, dtype=numpy.uint16).take(numpy.frombuffer(data, dtype=numpy.uint8))
+    power_width = 1
+    hashes = None
+    hash_width = 0
+    while True:
+        if _GEAR_WINDOW & power_width:
+            if hashes is None:
+                hashes = powers
+            else:
+                # The bytes before the ones hashed so far are shifted further left
+                hashes = hashes[power_width:] + (powers[:len(hashes) - power_width] << hash_width)
+            hash_width += power_width
+        if power_width * 2 > _GEAR_WINDOW:
+            break
+        powers = powers[power_width:] + (powers[:-power_width] << power_width)
+        power_width *= 2
+    return numpy.flatnonzero((hashes & CHUNK_BOUNDARY_MASK) == 0) + (_GEAR_WINDOW - 1)
+
+
+def _find_chunk_boundary(data, start=0, candidates=None):
+    """
+    Returns the length of the first chunk of the data from start on. The hash restarts at every chunk, so the first
+    bytes hashed only see part of a window and are always scanned here; after that the boundary is looked up in the
+    candidates from _find_boundary_candidates when there are some.
+    """
+    end = min(len(data) - start, MAX_CHUNK_SIZE)
+    if end <= MIN_CHUNK_SIZE:
+        return end
+    scan_end = end if candidates is None else min(end, MIN_CHUNK_SIZE + _GEAR_WINDOW - 1)
+    low_gear = _LOW_GEAR
+    rolling_hash = 0
+    for index, byte in enumerate(bytearray(data[start + MIN_CHUNK_SIZE:start + scan_end])):
+        rolling_hash = ((rolling_hash << 1) + low_gear[byte]) & CHUNK_BOUNDARY_MASK
+        if not rolling_hash:
+            return MIN_CHUNK_SIZE + index + 1
+    if scan_end == end:
+        return end
+    position = candidates.searchsorted(start + scan_end)
+    if position < len(candidates) and candidates[position] < start + end:
+        return int(candidates[position]) - start + 1
+    return end
+
+
+def _get_chunk_path(store_path, chunk_hash):
+    return os.path.join(store_path, CHUNKS_DIR_NAME, chunk_hash[:2], chunk_hash)
+
+
+def _store_chunk(store_path, chunk):
+    """
+    Writes a chunk to the store unless an identical one is already there
+    :return: (chunk_hash, number of compressed bytes written)
+    """
+    chunk_hash = hashlib.sha256(chunk).hexdigest()
+    chunk_path = _get_chunk_path(store_path, chunk_hash)
+    if os.path.exists(chunk_path):
+        return chunk_hash, 0
+    chunk_dir_path = os.path.dirname(chunk_path)
+    if not os.path.isdir(chunk_dir_path):
+        os.makedirs(chunk_dir_path)
+    compressed = zlib.compress(chunk)
+    # Write then rename, an interrupted backup must never leave a truncated chunk under a valid hash
+    temp_path = chunk_path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(compressed)
+    os.rename(temp_path, chunk_path)
+    return chunk_hash, len(compressed)
+
+
+def _read_chunk(store_path, chunk_hash):
+    with open(_get_chunk_path(store_path, chunk_hash), 'rb') as f:
+        return zlib.decompress(f.read())
+
+
+def _iter_input_files(input_path, top_path=None):
+    """
+    Yields (file_path, relative_path) for every file to back up, or only for those under top_path if given; relative
+    paths are relative to input_path and always use '/'. Change cache databases kept in the tree are left out, they
+    change whenever anything else does.
+    """
+    if os.path.isfile(input_path):
+        yield input_path, os.path.basename(input_path)
+        return
+    top_path = top_path or input_path
+    if os.path.isfile(top_path):
+        if not change_cache.is_cache_file(os.path.basename(top_path)):
+            yield top_path, os.path.relpath(top_path, input_path).replace(os.sep, '/')
+        return
+    for root, dirs, file_names in os.walk(top_path):
+        dirs.sort()
+        for file_name in sorted(file_names):
+            if change_cache.is_cache_file(file_name):
+                continue
+            file_path = os.path.join(root, file_name)
+            yield file_path, os.path.relpath(file_path, input_path).replace(os.sep, '/')
+
+
+def backup(input_path, store_path, changed_paths=None):
+    """
+    Backs up the file/directory with the given input_path into the chunk store at store_path, creating the store if
+    needed. Files whose size and modification time match the latest snapshot of the same input are not read at all.
+    :param input_path: the path of the file/directory to back up
+    :param store_path: the path of the chunk store
+    :param changed_paths: if given, the only paths (files or directories, created, modified or deleted) which may
+        have changed since the latest snapshot of the same input; everything else is carried over from that snapshot
+        without being looked at
+    :return: the path of the snapshot file written for this run
+    """
+    if not os.path.exists(input_path):
+        raise IOError("{} does not exist.".format(input_path))
+    init_store(store_path)
+    input_path = os.path.abspath(input_path)
+    name = os.path.basename(input_path)
+
+    previous_files = {}
+    for snapshot_name in reversed(list_snapshots(store_path)):
+        snapshot = read_snapshot(store_path, snapshot_name)
+        if snapshot['source'] == input_path:
+            previous_files = snapshot['files']
+            break
+
+    files = {}
+    top_paths = [input_path]
+    if changed_paths is not None and previous_files and os.path.isdir(input_path):
+        files = dict(previous_files)
+        top_paths = []
+        for changed_path in set(os.path.abspath(path) for path in changed_paths):
+            relative_path = os.path.relpath(changed_path, input_path).replace(os.sep, '/')
+            if relative_path == '.':
+                files = {}
+                top_paths = [input_path]
+                break
+            if relative_path == '..' or relative_path.startswith('../'):
+                continue
+            # Whatever was under a directory is looked at again; a known file has nothing under it
+            if files.pop(relative_path, None) is None:
+                prefix = relative_path + '/'
+                for path in [path for path in files if path.startswith(prefix)]:
+                    del files[path]
+            top_paths.append(changed_path)
+    for top_path in top_paths:
+        for file_path, relative_path in _iter_input_files(input_path, top_path):
+            stat = os.stat(file_path)
+            entry = previous_files.get(relative_path)
+            if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+                with open(file_path, 'rb') as f:
+                    chunks = [_store_chunk(store_path, chunk)[0] for chunk in iter_chunks(f)]
+                entry = {'size': stat.st_size, 'mtime': stat.st_mtime, 'chunks': chunks}
+            entry['mode'] = stat.st_mode & 0o7777
+            files[relative_path] = entry
+
+    now = datetime.datetime.now()
+    # Zero padded, so the snapshots of a source sort by name in the order they were made
+    snapshot_name = '{}_{}'.format(name, now.strftime('%Y_%m_%d_%H_%M_%S'))
+    snapshot_path = file_sys_manip.generate_unique_path(
+        snapshot_name + SNAPSHOT_EXTENSION, os.path.join(store_path, SNAPSHOTS_DIR_NAME))
+    with open(snapshot_path, 'w') as f:
+        json.dump({'source': input_path, 'created': now.isoformat(), 'files': files}, f)
+    return snapshot_path
+
+
+def list_snapshots(store_path):
+    """
+    Returns the names of the snapshots in the store, oldest first
+    :param store_path: the path of the chunk store
+    :return: list of snapshot names
+    """
+    if not is_store(store_path):
+        raise IOError("{} is not a chunk store.".format(store_path))
+    snapshots = []
+    snapshots_dir_path = os.path.join(store_path, SNAPSHOTS_DIR_NAME)
+    for file_name in os.listdir(snapshots_dir_path):
+        if file_name.endswith(SNAPSHOT_EXTENSION):
+            snapshots.append((os.path.getmtime(os.path.join(snapshots_dir_path, file_name)), file_name))
+    return [file_name[:-len(SNAPSHOT_EXTENSION)] for mtime, file_name in sorted(snapshots)]
+
+
+def read_snapshot(store_path, snapshot_name):
+    """
+    Returns the contents of a snapshot
+    :param store_path: the path of the chunk store
+    :param snapshot_name: name of the snapshot, as returned by list_snapshots
+    :return: dict of the form { 'source': input_path, 'created': iso_time, 'files': { relative_path: entry } }
+    """
+    snapshot_path = os.path.join(store_path, SNAPSHOTS_DIR_NAME, snapshot_name + SNAPSHOT_EXTENSION)
+    if not os.path.isfile(snapshot_path):
+        raise IOError("Snapshot {} does not exist.".format(snapshot_name))
+    with open(snapshot_path, 'r') as f:
+        return json.load(f)
+
+
+def restore(store_path, snapshot_name, output_dir_path):
+    """
+    Recreates the files captured by a snapshot in the directory with the given output_dir_path
+    :param store_path: the path of the chunk store
+    :param snapshot_name: name of the snapshot to restore, as returned by list_snapshots
+    :param output_dir_path: the path of the directory the files will be restored to
+    :return: the number of files restored
+    """
+    snapshot = read_snapshot(store_path, snapshot_name)
+    for relative_path, entry in snapshot['files'].iteritems():
+        file_path = os.path.join(output_dir_path, relative_path.replace('/', os.sep))
+        file_dir_path = os.path.dirname(file_path)
+        if not os.path.isdir(file_dir_path):
+            os.makedirs(file_dir_path)
+        with open(file_path, 'wb') as f:
+            for chunk_hash in entry['chunks']:
+                f.write(_read_chunk(store_path, chunk_hash))
+        os.chmod(file_path, entry['mode'])
+        os.utime(file_path, (entry['mtime'], entry['mtime']))
+    return len(snapshot['files'])
+
+
+def prune(store_path, keep_last):
+    """
+    Deletes all but the newest keep_last snapshots of each backed up source, then deletes the chunks no remaining
+    snapshot refers to
+    :param store_path: the path of the chunk store
+    :param keep_last: number of snapshots to keep per source
+    :return: (list of the names of the removed snapshots, number of removed chunks)
+    """
+    snapshots_by_source = {}
+    for snapshot_name in list_snapshots(store_path):
+        source = read_snapshot(store_path, snapshot_name)['source']
+        snapshots_by_source.setdefault(source, []).append(snapshot_name)
+    removed_snapshots = []
+    for snapshot_names in snapshots_by_source.itervalues():
+        removed_snapshots.extend(snapshot_names[:max(0, len(snapshot_names) - keep_last)])
+    for snapshot_name in removed_snapshots:
+        os.remove(os.path.join(store_path, SNAPSHOTS_DIR_NAME, snapshot_name + SNAPSHOT_EXTENSION))
+
+    referenced = set()
+    for snapshot_name in list_snapshots(store_path):
+        for entry in read_snapshot(store_path, snapshot_name)['files'].itervalues():
+            referenced.update(entry['chunks'])
+    removed_chunk_count = 0
+    chunks_dir_path = os.path.join(store_path, CHUNKS_DIR_NAME)
+    for prefix in os.listdir(chunks_dir_path):
+        prefix_dir_path = os.path.join(chunks_dir_path, prefix)
+        for chunk_hash in os.listdir(prefix_dir_path):
+            if chunk_hash not in referenced:
+                os.remove(os.path.join(prefix_dir_path, chunk_hash))
+                removed_chunk_count += 1
+    return removed_snapshots, removed_chunk_count
+
+
+#--------------------
+# Tests
+#--------------------
+class ChunkStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = file_sys_manip.generate_unique_path("test_dir")
+        self.input_dir = os.path.join(self.test_dir, 'input')
+        self.store_dir = os.path.join(self.test_dir, 'store')
+        os.makedirs(os.path.join(self.input_dir, 'sub'))
+        self.file_creator = file_sys_manip.FileCreator()
+        self.file_creator.create_files_from_dict({
+            'small.txt': 'small',
+            os.path.join('sub', 'large.bin'): ''.join(chr(i * 7 % 251) for i in xrange(200000)),
+        }, self.input_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _count_chunks(self):
+        return sum(len(files) for root, dirs, files in os.walk(os.path.join(self.store_dir, CHUNKS_DIR_NAME)))
+
+    def test_iter_chunks(self):
+        with open(os.path.join(self.input_dir, 'sub', 'large.bin'), 'rb') as f:
+            contents = f.read()
+            f.seek(0)
+            chunks = list(iter_chunks(f))
+        self.assertEqual(contents, ''.join(chunks))
+        self.assertTrue(all(len(chunk) <= MAX_CHUNK_SIZE for chunk in chunks))
+        self.assertTrue(all(len(chunk) >= MIN_CHUNK_SIZE for chunk in chunks[:-1]))
+        # Boundaries only depend on the contents, not on how they were read
+        global READ_SIZE
+        read_size = READ_SIZE
+        READ_SIZE = MAX_CHUNK_SIZE + 1000
+        try:
+            with open(os.path.join(self.input_dir, 'sub', 'large.bin'), 'rb') as f:
+                self.assertEqual(chunks, list(iter_chunks(f)))
+        finally:
+            READ_SIZE = read_size
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_boundary_candidates(self):
+        rand = random.Random(0)
+        data = ''.join(chr(rand.randrange(256)) for i in xrange(200000)) + '\0' * 20000 + 'ab' * 20000
+        candidates = _find_boundary_candidates(data)
+        # Cutting from the precomputed candidates must match the byte by byte scan, or stored chunks stop deduplicating
+        offset = 0
+        while offset < len(data):
+            cut = _find_chunk_boundary(data, offset)
+            self.assertEqual(cut, _find_chunk_boundary(data, offset, candidates))
+            offset += cut
+
+    def test_backup_restore(self):
+        snapshot_name = os.path.basename(backup(self.input_dir, self.store_dir))[:-len(SNAPSHOT_EXTENSION)]
+        # Zero padded time stamp
+        time_stamp = snapshot_name[-len('2016_01_02_03_04_05'):]
+        self.assertEqual(time_stamp, datetime.datetime.strptime(time_stamp, '%Y_%m_%d_%H_%M_%S').strftime(
+            '%Y_%m_%d_%H_%M_%S'))
+        chunk_count = self._count_chunks()
+        # Nothing changed, so nothing new is stored
+        backup(self.input_dir, self.store_dir)
+        self.assertEqual(chunk_count, self._count_chunks())
+
+        with open(os.path.join(self.input_dir, 'small.txt'), 'w') as f:
+            f.write('changed')
+        snapshot_name = os.path.basename(backup(self.input_dir, self.store_dir))[:-len(SNAPSHOT_EXTENSION)]
+        self.assertEqual(3, len(list_snapshots(self.store_dir)))
+        self.assertEqual(snapshot_name, list_snapshots(self.store_dir)[-1])
+
+        output_dir = os.path.join(self.test_dir, 'restored')
+        restore(self.store_dir, snapshot_name, output_dir)
+        for relative_path in ('small.txt', os.path.join('sub', 'large.bin')):
+            with open(os.path.join(self.input_dir, relative_path), 'rb') as expected:
+                with open(os.path.join(output_dir, relative_path), 'rb') as restored:
+                    self.assertEqual(expected.read(), restored.read())
+
+    def test_backup_changed_paths(self):
+        backup(self.input_dir, self.store_dir)
+        with open(os.path.join(self.input_dir, 'small.txt'), 'w') as f:
+            f.write('changed')
+        os.remove(os.path.join(self.input_dir, 'sub', 'large.bin'))
+        self.file_creator.create_files_from_dict({os.path.join('new', 'new.txt'): 'new'}, self.input_dir)
+        snapshot_path = backup(self.input_dir, self.store_dir,
+                               [os.path.join(self.input_dir, 'sub'), os.path.join(self.input_dir, 'new')])
+        files = read_snapshot(self.store_dir, os.path.basename(snapshot_path)[:-len(SNAPSHOT_EXTENSION)])['files']
+        # small.txt was not among the changed paths, so its previous entry is carried over without a look
+        self.assertEqual(['new/new.txt', 'small.txt'], sorted(files))
+        self.assertEqual(len('small'), files['small.txt']['size'])
+        # The input itself means every path may have changed
+        snapshot_path = backup(self.input_dir, self.store_dir, [self.input_dir])
+        files = read_snapshot(self.store_dir, os.path.basename(snapshot_path)[:-len(SNAPSHOT_EXTENSION)])['files']
+        self.assertEqual(len('changed'), files['small.txt']['size'])
+
+    def test_prune(self):
+        backup(self.input_dir, self.store_dir)
+        with open(os.path.join(self.input_dir, 'small.txt'), 'w') as f:
+            f.write('changed')
+        backup(self.input_dir, self.store_dir)
+        removed_snapshots, removed_chunk_count = prune(self.store_dir, 1)
+        self.assertEqual(1, len(removed_snapshots))
+        # Only the chunk of the original small.txt is no longer referenced
+        self.assertEqual(1, removed_chunk_count)
+        self.assertEqual(1, len(list_snapshots(self.store_dir)))
@@ -2,19 +2,33 @@ import unittest
 import os
 import shutil
 import re
+import mmap
+import multiprocessing
 import file_sys_manip
+import change_cache
+import instrumentation
 
 
-def is_text_in_file(text, file_path):
+# Bytes read at a time when a file can't be memory-mapped
+CHUNK_SIZE = 16 * 1024 * 1024
+# Regular expression matches longer than this may be missed where they straddle two chunks
+MAX_CHUNKED_MATCH_LENGTH = 64 * 1024
+
+
+def is_text_in_file(text, file_path, binary=False):
     """
     Returns true if the given text is found in the file at the given path, false otherwise
     @type text: str
     @param text: text to search for
     @type file_path: str
     @param file_path: path of the file that will be searched
+    @type binary: bool
+    @param binary: if True, search the raw bytes of the file (see iter_byte_matches) instead of iterating its lines
     @rtype bool
     @return: true if the given text is found in the file at the given path, false otherwise
     """
+    if binary:
+        return next(iter_byte_matches(text, file_path), None) is not None
     with open(file_path, 'r') as f:
         for line in f:
             if text in line:
@@ -22,16 +36,20 @@ def is_text_in_file(text, file_path):
     return False
 
 
-def is_pattern_in_file(pattern, file_path):
+def is_pattern_in_file(pattern, file_path, binary=False):
     """
     Returns true if the given pattern is found in the file at the given path, false otherwise
     @type pattern: str
     @param pattern: str which will be interpreted as a regular expression and then searched for
     @type file_path: str
     @param file_path: path of the file that will be searched
+    @type binary: bool
+    @param binary: if True, search the raw bytes of the file (see iter_byte_matches) instead of iterating its lines
     @rtype bool
     @return: true if the given pattern is found in the file at the given path, false otherwise
     """
+    if binary:
+        return next(iter_byte_matches(pattern, file_path, regex=True), None) is not None
     pattern = re.compile(pattern)
     with open(file_path, 'r') as f:
         for line in f:
@@ -41,6 +59,301 @@ def is_pattern_in_file(pattern, file_path):
     return False
 
 
+def iter_byte_matches(needle, file_path, regex=False, encoding=None, use_mmap=True, chunk_size=CHUNK_SIZE):
+    """
+    Searches the raw bytes of a file rather than its lines, so huge lines and binary content are no problem. The file
+        is memory-mapped where possible; otherwise (empty files, pipes, mmap disabled) it is read in overlapping chunks
+        so that matches straddling two chunks are still found. Line numbers are only worked out for actual matches.
+    @type needle: str or unicode
+    @param needle: text (or a regular expression, if regex is True) to search for. Regular expressions are compiled
+        with re.MULTILINE, so '^' and '$' still match at line boundaries.
+    @type file_path: str
+    @param file_path: path of the file that will be searched
+    @type regex: bool
+    @param regex: if True, needle is interpreted as a regular expression, otherwise as literal text
+    @type encoding: str
+    @param encoding: encoding of the file (e.g. 'utf-16-le'); the needle is encoded with it before searching and the
+        matched bytes are decoded with it. None searches for needle's bytes as they are. Regular expressions can only
+        be used with encodings which keep ASCII as single bytes (e.g. 'utf-8', 'latin-1'), ValueError is raised for
+        others.
+    @type use_mmap: bool
+    @param use_mmap: if False, always use the chunked reader
+    @type chunk_size: int
+    @param chunk_size: bytes read at a time by the chunked reader
+    @rtype generator
+    @return: generator of (line_number, offset, matched) tuples; line numbers start at 1, offset is the byte offset of
+        the match in the file
+    """
+    newline = '\n'
+    if encoding is not None:
+        newline = u'\n'.encode(encoding)
+        if regex and len(newline) > 1:
+            # The pattern's own syntax would be encoded too, e.g. 'fo+' into 'f\0o\0+\0'
+            raise ValueError("Regular expressions can't be searched for in {} encoded files".format(encoding))
+        if isinstance(needle, str):
+            needle = needle.decode('utf-8')
+        needle = needle.encode(encoding)
+    elif isinstance(needle, unicode):
+        needle = needle.encode('utf-8')
+    if regex:
+        needle = re.compile(needle, re.MULTILINE)
+        overlap = MAX_CHUNKED_MATCH_LENGTH
+    elif not needle:
+        return
+    else:
+        # Enough to also see whole newlines at the end of a chunk
+        overlap = max(len(needle), len(newline)) - 1
+    with open(file_path, 'rb') as f:
+        buf = None
+        if use_mmap:
+            try:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (mmap.error, ValueError, EnvironmentError):
+                # Empty or non-regular files can't be mapped
+                buf = None
+        if buf is not None:
+            try:
+                if regex:
+                    # The whole file is visible at once, so matches of any length are found
+                    matches = _iter_mmap_regex_matches(needle, buf, newline)
+                else:
+                    # Reading windows of the map lets str.find's fast search do the work, which is far quicker than
+                    # mmap.find's naive scan
+                    matches = _iter_chunked_matches(needle, regex, buf, chunk_size, overlap, newline)
+                for match in matches:
+                    yield match if encoding is None else match[:2] + (match[2].decode(encoding),)
+            finally:
+                buf.close()
+        else:
+            for match in _iter_chunked_matches(needle, regex, f, chunk_size, overlap, newline):
+                yield match if encoding is None else match[:2] + (match[2].decode(encoding),)
+
+
+def _iter_mmap_regex_matches(pattern, buf, newline):
+    line_number = 1
+    counted_to = 0
+    for match in pattern.finditer(buf):
+        line_number += _count_mmap_newlines(buf, counted_to, match.start(), newline)
+        counted_to = match.start()
+        yield line_number, match.start(), match.group(0)
+
+
+def _count_mmap_newlines(buf, start, end, newline, step=CHUNK_SIZE):
+    """
+    Counts the newlines starting between two offsets of an mmap without copying more than step bytes at a time
+    """
+    count = 0
+    for block_start in xrange(start, end, step):
+        block_end = min(end, block_start + step)
+        # Each block reaches into the next so a multi-byte newline across the cut is seen whole
+        block = buf[block_start:block_end + len(newline) - 1]
+        count += _count_newlines(block, 0, block_end - block_start, newline, block_start)
+    return count
+
+
+def _count_newlines(buf, start, end, newline, buf_offset=0):
+    """
+    Counts the newlines starting between two offsets of a string. A multi-byte newline (UTF-16 or UTF-32) only counts
+        where it starts a code unit, i.e. at a file offset which is a multiple of its length, so characters which
+        merely contain its bytes aren't mistaken for it.
+    @param buf_offset: file offset of buf[0]
+    """
+    if len(newline) == 1:
+        return buf.count(newline, start, end)
+    count = 0
+    search_end = end + len(newline) - 1
+    offset = buf.find(newline, start, search_end)
+    while offset != -1:
+        if (buf_offset + offset) % len(newline) == 0:
+            count += 1
+            offset = buf.find(newline, offset + len(newline), search_end)
+        else:
+            offset = buf.find(newline, offset + 1, search_end)
+    return count
+
+
+def _iter_chunked_matches(needle, regex, f, chunk_size, overlap, newline):
+    """
+    Searches anything with a read method (a file or an mmap) chunk by chunk. The last overlap bytes of each chunk are
+    searched again with the next one, and the overlap bytes before them are kept as context, so '^', '\\b' and
+    lookbehinds see what precedes the cut rather than the start of a string.
+    """
+    buf = ''
+    # File offset of buf[0]
+    buf_offset = 0
+    # Offset in buf of the first byte not searched yet, what's before it is context
+    start = 0
+    line_number = 1
+    counted_to = 0
+    while True:
+        chunk = f.read(chunk_size)
+        buf += chunk
+        # Matches starting in the last 'overlap' bytes are left for the next round, when more data follows them
+        limit = len(buf) if not chunk else max(start, len(buf) - overlap)
+        if regex:
+            for match in needle.finditer(buf, start):
+                if match.start() >= limit:
+                    break
+                line_number += _count_newlines(buf, counted_to, match.start(), newline, buf_offset)
+                counted_to = match.start()
+                yield line_number, buf_offset + match.start(), match.group(0)
+                if match.end() > limit:
+                    limit = match.end()
+        else:
+            offset = buf.find(needle, start, limit + len(needle) - 1)
+            while offset != -1:
+                # With a multi-byte encoding, matches must start a code unit too
+                if (buf_offset + offset) % len(newline) == 0:
+                    line_number += _count_newlines(buf, counted_to, offset, newline, buf_offset)
+                    counted_to = offset
+                    yield line_number, buf_offset + offset, needle
+                offset = buf.find(needle, offset + 1, limit + len(needle) - 1)
+        if not chunk:
+            return
+        line_number += _count_newlines(buf, counted_to, limit, newline, buf_offset)
+        context_start = max(0, limit - overlap)
+        buf_offset += context_start
+        buf = buf[context_start:]
+        start = counted_to = limit - context_start
+
+
+def search_files(file_paths, patterns, regex=False, ignore_case=False, workers=None, first_match_only=False,
+                 max_matches=None):
+    """
+    Searches many files for many literal strings or regular expressions, reading each file once. Every line is first
+        tested against a single combined alternation of all the patterns, so lines without any match cost one regex
+        call however many patterns there are. Files that cannot be read are skipped.
+    @type file_paths: iterable
+    @param file_paths: paths of the files that will be searched, e.g. the output of file_sys_manip.get_file_paths
+    @type patterns: str or list
+    @param patterns: text (or regular expressions, if regex is True) to search for
+    @type regex: bool
+    @param regex: if True, patterns are interpreted as regular expressions, otherwise as literal text
+    @type ignore_case: bool
+    @param ignore_case: if True, matching ignores case
+    @type workers: int
+    @param workers: number of processes searching files concurrently, None or 1 searches them one at a time
+    @type first_match_only: bool
+    @param first_match_only: if True, stop searching a file at its first match
+    @type max_matches: int
+    @param max_matches: if given, stop the whole search once this many matches have been found
+    @rtype generator
+    @return: generator of (file_path, line_number, pattern, matched_text) tuples, line numbers starting at 1. With
+        several workers, files are reported in the order they finish.
+    """
+    if isinstance(patterns, basestring):
+        patterns = [patterns]
+    searcher = (tuple(patterns), regex, ignore_case, first_match_only)
+    if max_matches is not None and max_matches <= 0:
+        return
+    match_count = 0
+    if workers is None or workers <= 1:
+        compiled_searcher = _compile_searcher(searcher)
+        results = (_search_file(compiled_searcher, file_path) for file_path in file_paths)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(workers, _init_search_worker, (searcher,))
+        results = pool.imap_unordered(_search_file_worker, file_paths, 8)
+    try:
+        for file_results, bytes_read in results:
+            instrumentation.count('searched_files')
+            instrumentation.count('searched_bytes', bytes_read)
+            instrumentation.count('search_matches', len(file_results))
+            for result in file_results:
+                yield result
+                match_count += 1
+                if max_matches is not None and match_count >= max_matches:
+                    return
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def search_changed_files(cache, patterns, extensions=None, excluded_dir_paths=None, **kwargs):
+    """
+    Searches only the files of a tree added or changed since the last saved update of its change cache, e.g. to
+        re-scan a large tree for new occurrences. The cache is updated first and saved once every changed file has
+        been searched, so a search abandoned part way is redone in full by the next one.
+    @type cache: change_cache.ChangeCache
+    @param cache: open change cache of the tree to search
+    @param patterns: text (or regular expressions) to search for, see search_files
+    @param extensions: set of extensions of the files to search, None searches every file
+    @param excluded_dir_paths: directory paths to leave out, as accepted by file_sys_manip.get_file_paths
+    @param kwargs: any other argument of search_files
+    @rtype generator
+    @return: generator of (file_path, line_number, pattern, matched_text) tuples, see search_files
+    """
+    with instrumentation.phase('change_cache_update'):
+        changes = cache.update(extensions, excluded_dir_paths)
+    for result in search_files(sorted(changes.get_modified()), patterns, **kwargs):
+        yield result
+    cache.save()
+
+
+# The searcher of a worker process, compiled once by _init_search_worker rather than once per file
+_worker_searcher = None
+
+
+def _init_search_worker(searcher):
+    global _worker_searcher
+    _worker_searcher = _compile_searcher(searcher)
+
+
+def _search_file_worker(file_path):
+    return _search_file(_worker_searcher, file_path)
+
+
+def _compile_searcher(searcher):
+    patterns, regex, ignore_case, first_match_only = searcher
+    flags = re.IGNORECASE if ignore_case else 0
+    if regex:
+        compiled = [re.compile(pattern, flags) for pattern in patterns]
+        sources = ['(?:{})'.format(pattern) for pattern in patterns]
+    else:
+        compiled = [re.compile(re.escape(pattern), flags) for pattern in patterns]
+        sources = [re.escape(pattern) for pattern in patterns]
+    if regex and any(re.search(r'\\[1-9]|\(\?P=', pattern) for pattern in patterns):
+        # Back references would point at the wrong groups once the patterns are combined, so don't prefilter
+        combined = None
+    else:
+        try:
+            combined = re.compile('|'.join(sources), flags)
+        except (re.error, AssertionError):
+            # Patterns which only compile on their own: the same group name used by several of them (re.error), or
+            # more groups between them than Python 2's limit of 100 (which sre_compile asserts)
+            combined = None
+    if len(compiled) == 1:
+        combined = compiled[0]
+    return zip(patterns, compiled), combined, first_match_only
+
+
+def _search_file(compiled_searcher, file_path):
+    """
+    Searches a single file
+    @return: (list of (file_path, line_number, pattern, matched_text) tuples, number of bytes read)
+    """
+    pattern_regexes, combined, first_match_only = compiled_searcher
+    results = []
+    bytes_read = 0
+    try:
+        with open(file_path, 'r') as f:
+            for line_number, line in enumerate(f, 1):
+                if combined is not None and combined.search(line) is None:
+                    continue
+                for pattern, pattern_regex in pattern_regexes:
+                    match = pattern_regex.search(line)
+                    if match is not None:
+                        results.append((file_path, line_number, pattern, match.group(0)))
+                        if first_match_only:
+                            # Where the read ahead stopped, so what was read from disk
+                            return results, f.tell()
+            bytes_read = f.tell()
+    except (IOError, OSError):
+        pass
+    return results, bytes_read
+
+
 class FileSearchTests(unittest.TestCase):
 
     def setUp(self):
@@ -62,3 +375,82 @@ class FileSearchTests(unittest.TestCase):
     def test_is_pattern_in_file(self):
         self.assertTrue(is_pattern_in_file("{}.*for.$".format(re.escape("hese]")), self.file_path))
         self.assertFalse(is_pattern_in_file("^a", self.file_path))
+
+    def test_search_files(self):
+        other_file_path = self.file_creator.create_unique_file(dir_path=self.test_dir)
+        with open(other_file_path, 'w') as f:
+            f.write("Move along.\nThese are not\nthe droids.")
+        file_paths = [self.file_path, other_file_path]
+        for workers in (None, 2):
+            found = set(search_files(file_paths, ["droids", "along", "missing"], workers=workers))
+            self.assertEqual({
+                (self.file_path, 1, "droids", "droids"),
+                (other_file_path, 1, "along", "along"),
+                (other_file_path, 3, "droids", "droids"),
+            }, found)
+            found = set(search_files(file_paths, [r"th\w+", r"^Move"], regex=True, ignore_case=True, workers=workers))
+            self.assertEqual({
+                (self.file_path, 1, r"th\w+", "These"),
+                (other_file_path, 1, r"^Move", "Move"),
+                (other_file_path, 2, r"th\w+", "These"),
+                (other_file_path, 3, r"th\w+", "the"),
+            }, found)
+            # Patterns which can't be combined into one prefilter are still searched for
+            patterns = [r"(?P<word>droids)", r"(?P<word>along)"] + [r"(x)" * 60, r"(y)" * 60]
+            self.assertEqual(3, len(list(search_files(file_paths, patterns, regex=True, workers=workers))))
+            found = list(search_files(file_paths, "droids", first_match_only=True, workers=workers))
+            self.assertEqual(2, len(found))
+            found = list(search_files(file_paths, ["droids", "along"], max_matches=1, workers=workers))
+            self.assertEqual(1, len(found))
+
+    def test_search_changed_files(self):
+        with change_cache.ChangeCache(self.test_dir) as cache:
+            self.assertEqual([os.path.abspath(self.file_path)],
+                             [result[0] for result in search_changed_files(cache, "droids")])
+            other_file_path = self.file_creator.create_unique_file(dir_path=self.test_dir)
+            with open(other_file_path, 'w') as f:
+                f.write("More droids.")
+            # The unchanged file is not searched again
+            self.assertEqual([os.path.abspath(other_file_path)],
+                             [result[0] for result in search_changed_files(cache, "droids")])
+
+    def test_iter_byte_matches(self):
+        with open(self.file_path, 'wb') as f:
+            f.write("first droid\n\x00\xff binary droid\n" + "x" * 100 + "droid\n")
+        for use_mmap in (True, False):
+            # Tiny chunks make matches straddle chunk boundaries
+            self.assertEqual(
+                [(1, 6, "droid"), (2, 22, "droid"), (3, 128, "droid")],
+                list(iter_byte_matches("droid", self.file_path, use_mmap=use_mmap, chunk_size=7)))
+            self.assertEqual(
+                [(1, 0, "first"), (3, 28, "x" * 100 + "droid")],
+                list(iter_byte_matches(r"^\w+", self.file_path, regex=True, use_mmap=use_mmap, chunk_size=7)))
+        self.assertTrue(is_text_in_file("binary", self.file_path, binary=True))
+        self.assertFalse(is_pattern_in_file("^binary", self.file_path, binary=True))
+        # Chunks smaller than a line and than the overlap
+        with open(self.file_path, 'wb') as f:
+            f.write('a' * 100000 + 'xyz\n' + 'b' * 10)
+        for use_mmap in (True, False):
+            self.assertEqual([(1, 0, 'a'), (2, 100004, 'b')],
+                             list(iter_byte_matches(r'^\w', self.file_path, regex=True, use_mmap=use_mmap,
+                                                    chunk_size=70000)))
+            self.assertEqual([(1, 0, 'a'), (2, 100004, 'b')],
+                             list(iter_byte_matches(r'\b\w', self.file_path, regex=True, use_mmap=use_mmap,
+                                                    chunk_size=30000)))
+
+    def test_iter_byte_matches_encoding(self):
+        with open(self.file_path, 'wb') as f:
+            f.write(u"caf\xe9\nna\xefve caf\xe9".encode('utf-16-le'))
+        for use_mmap in (True, False):
+            self.assertEqual(
+                [(1, 0, u"caf\xe9"), (2, 22, u"caf\xe9")],
+                list(iter_byte_matches(u"caf\xe9", self.file_path, encoding='utf-16-le', use_mmap=use_mmap,
+                                       chunk_size=5)))
+        # Only whole encoded newlines count, not every 0x0a byte
+        with open(self.file_path, 'wb') as f:
+            f.write((unichr(0x10a) * 2 + u'\nfoo').encode('utf-16-le'))
+        for use_mmap in (True, False):
+            self.assertEqual([(2, 6, u'foo')], list(iter_byte_matches(
+                u'foo', self.file_path, encoding='utf-16-le', use_mmap=use_mmap, chunk_size=3)))
+        self.assertRaises(ValueError, lambda: list(iter_byte_matches(
+            u'fo+', self.file_path, regex=True, encoding='utf-16-le')))
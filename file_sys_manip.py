@@ -1,13 +1,82 @@
 import unittest
+import StringIO
 import os
 import shutil
 import time
 import re
 import zipfile
+import hashlib
+import zlib
+import itertools
+import multiprocessing
+import collections
+import stat
+import math
+import threading
+import errno
+import struct
+import fnmatch
+import multiprocessing.pool
+import sys
+import json
+import sqlite3
+import instrumentation
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
-file_line_list_cache = {}
-file_line_list_cache_lowered = {}
+
+# Default total size of the lines held by a FileLineCache
+FILE_LINE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+# Files larger than this are never deflated in memory by write_files_to_zip's worker processes
+PARALLEL_ZIP_MAX_MEMBER_SIZE = 64 * 1024 * 1024
+# Batches of members write_files_to_zip hands out per worker process ahead of the one being written, which bounds the
+# compressed data held in memory while the archive is written
+PARALLEL_ZIP_BATCHES_PER_WORKER = 2
+# Largest number of files of one directory removed by a single remove_files task
+REMOVE_FILES_BATCH_SIZE = 256
+# Whether files can be unlinked relative to an open directory, saving a path lookup per file (Python 3 only)
+_UNLINK_SUPPORTS_DIR_FD = os.unlink in getattr(os, 'supports_dir_fd', ())
+# Number of files handed to a create_files_from_dict worker thread at a time
+MATERIALIZE_CHUNK_SIZE = 64
+# Extensions of formats whose contents are already compressed, so deflating them again only costs time
+COMPRESSED_EXTENSIONS = frozenset((
+    'jpg', 'jpeg', 'png', 'gif', 'webp', 'heic', 'mp3', 'aac', 'm4a', 'ogg', 'oga', 'opus', 'flac', 'mp4', 'm4v',
+    'mov', 'avi', 'mkv', 'webm', 'wmv', 'zip', 'gz', 'tgz', 'bz2', 'tbz2', 'xz', 'txz', 'lz4', 'zst', '7z', 'rar',
+    'jar', 'war', 'apk', 'whl', 'egg', 'docx', 'xlsx', 'pptx', 'odt', 'ods', 'odp', 'epub',
+))
+# Compression methods a CompressionPolicy can name; bzip2 and lzma need a zipfile module which supports them
+COMPRESSION_METHODS = {
+    'stored': zipfile.ZIP_STORED,
+    'deflate': zipfile.ZIP_DEFLATED,
+    'bzip2': getattr(zipfile, 'ZIP_BZIP2', None),
+    'lzma': getattr(zipfile, 'ZIP_LZMA', None),
+}
+# Bytes sampled from the start of a file to estimate its entropy
+ENTROPY_SAMPLE_SIZE = 4096
+# Files whose sample has more bits of entropy per byte than this are stored; deflate rarely gains anything above it
+DEFAULT_ENTROPY_THRESHOLD = 7.5
+# Names CompressionPolicy reports its built in rules under
+COMPRESSED_EXTENSION_RULE = 'compressed extension'
+HIGH_ENTROPY_RULE = 'high entropy'
+DEFAULT_RULE = 'default'
+# Bytes iter_duplicate_files hashes at each end of a file, and reads at a time when hashing whole files
+DUPLICATE_BLOCK_SIZE = 64 * 1024
+# Bytes a kernel side copy is asked for at a time, and bytes read at a time where files are copied by hand
+SYNC_KERNEL_COPY_SIZE = 64 * 1024 * 1024
+SYNC_COPY_BLOCK_SIZE = 1024 * 1024
+# Errors of kernel side copies which mean they can't be used between those two files, e.g. across file systems
+_KERNEL_COPY_UNSUPPORTED_ERRORS = set(getattr(errno, name) for name in
+                                      ('EXDEV', 'ENOSYS', 'EINVAL', 'EOPNOTSUPP', 'ENOTSUP', 'ENOTSOCK', 'EBADF')
+                                      if hasattr(errno, name))
+# Python 3.8+ and 3.3+ respectively, on platforms which support them
+_copy_file_range = getattr(os, 'copy_file_range', None)
+_sendfile = getattr(os, 'sendfile', None)
 
 
 def touch(path):
@@ -20,27 +89,255 @@ def touch(path):
         os.utime(path, None)
 
 
+def get_file_hash(file_path, hash_name='sha256', block_size=1 << 16):
+    """
+    Returns the hex digest of the contents of the given file, read in blocks so large files are never held in memory
+    :param file_path: path of the file to hash
+    :param hash_name: name of any algorithm supported by hashlib
+    :param block_size: number of bytes read at a time
+    :return: the hex digest of the file's contents
+    """
+    file_hash = hashlib.new(hash_name)
+    with open(file_path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+class FileLineCache(object):
+    """
+    Thread safe cache of the lines of text files. An entry is re-read whenever its file's size, modification time or
+    inode change, and the least recently used entries are evicted once the cached lines exceed max_bytes in total.
+    """
+
+    def __init__(self, max_bytes=FILE_LINE_CACHE_MAX_BYTES):
+        """
+        :type max_bytes: int
+        :param max_bytes: total length of cached lines (lowered copies included) above which entries are evicted
+        """
+        self.max_bytes = max_bytes
+        # { file_path: _FileLineCacheEntry }, least recently used first
+        self._entries = collections.OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_lines(self, file_path, lowered=False):
+        """
+        Returns the list of text lines of the given file, reading it only if it is not cached or has changed
+        :param file_path: the path to the file whose contents shall be retrieved
+        :param lowered: if true, all text in the returned lines will be lower-case
+        :return: a list of text lines corresponding to the current state of the given file
+        """
+        stat = os.stat(file_path)
+        stat_key = (stat.st_size, stat.st_mtime, stat.st_ino)
+        with self._lock:
+            entry = self._entries.get(file_path)
+            if entry is not None and entry.stat_key == stat_key:
+                self.hits += 1
+                instrumentation.record_cache('file_line_cache', hits=1)
+                # Move to the most recently used end
+                del self._entries[file_path]
+                self._entries[file_path] = entry
+                if not lowered:
+                    return entry.lines
+                if entry.lowered_lines is not None:
+                    return entry.lowered_lines
+            else:
+                self.misses += 1
+                instrumentation.record_cache('file_line_cache', misses=1)
+                entry = None
+        if entry is None:
+            # Read outside the lock so worker threads don't wait on each other's I/O
+            with open(file_path, 'r') as f:
+                entry = _FileLineCacheEntry(stat_key, [line for line in f])
+        # The lowered variant is derived from the cached lines rather than from another read of the file
+        lowered_lines = [line.lower() for line in entry.lines] if lowered else None
+        with self._lock:
+            added_bytes = 0
+            if lowered_lines is not None and entry.lowered_lines is None:
+                entry.lowered_lines = lowered_lines
+                added_bytes = sum(len(line) for line in lowered_lines)
+                entry.size += added_bytes
+            if self._entries.get(file_path) is entry:
+                self._total_bytes += added_bytes
+            else:
+                self._remove(file_path)
+                self._entries[file_path] = entry
+                self._total_bytes += entry.size
+            self._evict()
+        return entry.lowered_lines if lowered else entry.lines
+
+    def _remove(self, file_path):
+        entry = self._entries.pop(file_path, None)
+        if entry is not None:
+            self._total_bytes -= entry.size
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes and self._entries:
+            file_path, entry = self._entries.popitem(last=False)
+            self._total_bytes -= entry.size
+            self.evictions += 1
+
+    def invalidate(self, file_path):
+        """
+        Drops the given file from the cache
+        :param file_path: the path to the file whose entry shall be dropped
+        """
+        with self._lock:
+            self._remove(file_path)
+
+    def clear(self):
+        """
+        Drops every entry and resets the counters
+        """
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def get_stats(self):
+        """
+        Returns the cache's counters
+        :rtype dict
+        :return: dict with the keys 'hits', 'misses', 'evictions', 'entries' and 'bytes'
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._total_bytes,
+            }
+
+
+class _FileLineCacheEntry(object):
+    __slots__ = ('stat_key', 'lines', 'lowered_lines', 'size')
+
+    def __init__(self, stat_key, lines):
+        self.stat_key = stat_key
+        self.lines = lines
+        self.lowered_lines = None
+        self.size = sum(len(line) for line in lines)
+
+
+file_line_list_cache = FileLineCache()
+
+
 def get_file_line_list_from_cache(file_path, lowered=False):
     """
-    Returns a list of text lines corresponding to the state of the given file the last time it was read by this
-    function. If the file has never been read, it will be cached.
+    Returns a list of text lines corresponding to the current state of the given file. The lines are kept in the
+    module's FileLineCache, so the file is only read again once it changes or its entry has been evicted.
     :param file_path: the path to the file whose contents shall be retrieved
     :param lowered: if true, all text in the returned lines will be lower-case
     :return: a list of text lines corresponding to the state of the given file
     """
-    if lowered:
-        if file_path not in file_line_list_cache_lowered:
-            with open(file_path, 'r') as f:
-                line_list = [line.lower() for line in f]
-            file_line_list_cache_lowered[file_path] = line_list
-        line_list = file_line_list_cache_lowered[file_path]
-    else:
-        if file_path not in file_line_list_cache:
-            with open(file_path, 'r') as f:
-                line_list = [line for line in f]
-            file_line_list_cache[file_path] = line_list
-        line_list = file_line_list_cache[file_path]
-    return line_list
+    return file_line_list_cache.get_lines(file_path, lowered)
+
+
+class UniquePathAllocator(object):
+    """
+    Hands out unique paths of the form 'name.ext', 'name_1.ext', 'name_2.ext', ... The next suffix to try is remembered
+    per base path, and seeded from a single listing of the parent directory the first time a base path is taken, so
+    allocating the Nth path costs a couple of stat calls rather than N. claim and reserve create what they allocate
+    with an exclusive create, so a path is never handed out twice, even to competing processes.
+    """
+
+    def __init__(self):
+        # { normalized base path: next suffix to try }
+        self._next_suffixes = {}
+        self._lock = threading.Lock()
+
+    def _iter_candidates(self, base_path):
+        """
+        Yields the base path, then suffixed paths starting after the highest suffix handed out or seen so far
+        """
+        yield base_path
+        key = os.path.normcase(base_path)
+        base_path_name, base_path_extension = os.path.splitext(base_path)
+        with self._lock:
+            suffix = self._next_suffixes.get(key)
+        if suffix is None:
+            suffix = self._get_highest_suffix(base_path_name, base_path_extension) + 1
+        while True:
+            with self._lock:
+                # Another thread may have moved past this suffix already
+                suffix = max(suffix, self._next_suffixes.get(key, 0))
+                self._next_suffixes[key] = suffix + 1
+            yield "{}_{}{}".format(base_path_name, suffix, base_path_extension)
+            suffix += 1
+
+    @staticmethod
+    def _get_highest_suffix(base_path_name, base_path_extension):
+        parent_dir, name = os.path.split(base_path_name)
+        suffix_pattern = re.compile("^{}_([0-9]+){}$".format(re.escape(name), re.escape(base_path_extension)))
+        highest = 0
+        try:
+            file_names = os.listdir(parent_dir or os.curdir)
+        except OSError:
+            return highest
+        for file_name in file_names:
+            match = suffix_pattern.match(file_name)
+            if match is not None:
+                highest = max(highest, int(match.group(1)))
+        return highest
+
+    def generate(self, base_file_name, parent_dir=None):
+        """
+        Returns an available (not in use) path without creating anything; see claim for a race-free alternative
+        :param base_file_name: base file name to be used in generating the path
+        :param parent_dir: parent directory of the desired path
+        :return: an available (not in use) path
+        """
+        for path in self._iter_candidates(_get_base_path(base_file_name, parent_dir)):
+            if not os.path.exists(path):
+                return path
+
+    def claim(self, base_file_name, parent_dir=None, directory=False):
+        """
+        Atomically creates an empty file (or directory) at an available path and returns the path
+        :param base_file_name: base file name to be used in generating the path
+        :param parent_dir: parent directory of the desired path
+        :param directory: if True, create a directory rather than a file
+        :return: the path of the created file/directory
+        """
+        for path in self._iter_candidates(_get_base_path(base_file_name, parent_dir)):
+            try:
+                if directory:
+                    os.mkdir(path)
+                else:
+                    os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666))
+                return path
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def reserve(self, base_file_name, count, parent_dir=None):
+        """
+        Atomically creates count empty files at available paths
+        :param base_file_name: base file name to be used in generating the paths
+        :param count: number of files to create
+        :param parent_dir: parent directory of the desired paths
+        :return: the list of the paths of the created files
+        """
+        return [self.claim(base_file_name, parent_dir) for i in xrange(count)]
+
+
+def _get_base_path(base_file_name, parent_dir):
+    if parent_dir is None:
+        parent_dir = os.getcwd()
+    return os.path.abspath(os.path.join(parent_dir, base_file_name))
+
+
+unique_path_allocator = UniquePathAllocator()
 
 
 def generate_unique_path(base_file_name, parent_dir=None):
@@ -50,24 +347,33 @@ def generate_unique_path(base_file_name, parent_dir=None):
     :param parent_dir: parent directory of the desired path
     :return: an available (not in use) path
     """
-    if parent_dir is None:
-        parent_dir = os.getcwd()
-    base_file_name = os.path.join(parent_dir, base_file_name)
-    if not os.path.exists(base_file_name):
-        unique_path = base_file_name
-    else:
-        count = 0
-        base_path_name, base_path_extension = os.path.splitext(base_file_name)
-        while True:
-            count += 1
-            unique_path = "{}_{}{}".format(base_path_name, count, base_path_extension)
-            if not os.path.exists(unique_path):
-                break
-    # noinspection PyUnboundLocalVariable
-    return os.path.abspath(unique_path)
+    return unique_path_allocator.generate(base_file_name, parent_dir)
+
+
+def claim_unique_path(base_file_name, parent_dir=None, directory=False):
+    """
+    Creates an empty file (or directory) at an available path, atomically, so no other thread or process can be handed
+    the same path
+    :param base_file_name: base file name to be used in generating the path
+    :param parent_dir: parent directory of the desired path
+    :param directory: if True, create a directory rather than a file
+    :return: the path of the created file/directory
+    """
+    return unique_path_allocator.claim(base_file_name, parent_dir, directory)
+
+
+def reserve_unique_paths(base_file_name, count, parent_dir=None):
+    """
+    Creates count empty files at available paths, atomically
+    :param base_file_name: base file name to be used in generating the paths
+    :param count: number of files to create
+    :param parent_dir: parent directory of the desired paths
+    :return: the list of the paths of the created files
+    """
+    return unique_path_allocator.reserve(base_file_name, count, parent_dir)
 
 
-def get_file_paths(dir_paths, extensions=None, excluded_dir_paths=None):
+def get_file_paths(dir_paths, extensions=None, excluded_dir_paths=None, include=None, exclude=None, workers=None):
     """
     Returns the set of every file path in the specified directory trees which has one of the given extensions
     :type dir_paths: str or set
@@ -75,23 +381,779 @@ def get_file_paths(dir_paths, extensions=None, excluded_dir_paths=None):
     :type extensions: set
     :param extensions: set of extensions file paths will be checked against
     :type excluded_dir_paths: unknown or str or dict or set
-    :param excluded_dir_paths: set of directory paths to exclude from the search
+    :param excluded_dir_paths: set of directory paths to exclude from the search, along with everything below them
+    :param include: rules (see iter_file_paths) at least one of which a file must match to be returned
+    :param exclude: rules (see iter_file_paths) matching files, or whole directory trees, to leave out
+    :type workers: int
+    :param workers: number of threads listing directories concurrently, None or 1 lists them one at a time
     :return: the set of every file path in the specified directory trees
     """
+    with instrumentation.phase('list_files'):
+        return set(iter_file_paths(dir_paths, extensions, excluded_dir_paths, include, exclude, workers))
+
+
+def iter_file_paths(dir_paths, extensions=None, excluded_dir_paths=None, include=None, exclude=None, workers=None):
+    """
+    Generates every file path in the specified directory trees which has one of the given extensions, as the
+    directories are listed. Excluded directories are never descended into.
+
+    A rule is either a glob string or a compiled regular expression. Globs without a path separator are matched against
+    the file/directory name, other globs against the whole path; regular expressions are searched for in the whole path.
+    :type dir_paths: str or set
+    :param dir_paths: set of directory paths to search
+    :type extensions: set
+    :param extensions: set of extensions file paths will be checked against
+    :type excluded_dir_paths: unknown or str or dict or set
+    :param excluded_dir_paths: set of directory paths to exclude from the search, along with everything below them
+    :type include: str or list
+    :param include: rules at least one of which a file must match to be generated
+    :type exclude: str or list
+    :param exclude: rules matching files, or whole directory trees, to leave out
+    :type workers: int
+    :param workers: number of threads listing directories concurrently, worthwhile on high latency file systems; None
+        or 1 lists them one at a time
+    :return: generator of file paths
+    """
     if isinstance(dir_paths, str):
         dir_paths = {dir_paths}
     if isinstance(excluded_dir_paths, str):
         excluded_dir_paths = {excluded_dir_paths}
     if excluded_dir_paths is None:
         excluded_dir_paths = set()
-    paths = set()
-    for dir_path in dir_paths:
-        for root_path, dir_names, file_names in os.walk(dir_path):
-            if root_path not in excluded_dir_paths:
-                for file_name in file_names:
-                    if extensions is None or os.path.splitext(file_name)[1][1:] in extensions:
-                        paths.add(os.path.join(root_path, file_name))
-    return paths
+    excluded_dir_paths = set(os.path.normcase(os.path.abspath(path)) for path in excluded_dir_paths)
+    include_matcher = _compile_path_rules(include)
+    exclude_matcher = _compile_path_rules(exclude)
+
+    def is_dir_excluded(dir_path, dir_name):
+        if excluded_dir_paths and os.path.normcase(os.path.abspath(dir_path)) in excluded_dir_paths:
+            return True
+        return exclude_matcher is not None and exclude_matcher(dir_path, dir_name)
+
+    def scan(dir_path):
+        file_paths = []
+        sub_dir_paths = []
+        for name, path, is_dir, is_link in _scan_dir(dir_path):
+            if is_dir:
+                if not is_link and not is_dir_excluded(path, name):
+                    sub_dir_paths.append(path)
+            elif (extensions is None or _get_extension(name) in extensions) and \
+                    (include_matcher is None or include_matcher(path, name)) and \
+                    (exclude_matcher is None or not exclude_matcher(path, name)):
+                file_paths.append(path)
+        instrumentation.count('dirs_listed')
+        instrumentation.count('files_listed', len(file_paths))
+        return file_paths, sub_dir_paths
+
+    pending = [dir_path for dir_path in dir_paths if not is_dir_excluded(dir_path, os.path.basename(dir_path))]
+    if workers is None or workers <= 1:
+        while pending:
+            file_paths, sub_dir_paths = scan(pending.pop())
+            for file_path in file_paths:
+                yield file_path
+            pending.extend(reversed(sub_dir_paths))
+        return
+
+    # List each level of the trees concurrently, streaming results as each directory completes
+    pool = multiprocessing.pool.ThreadPool(workers)
+    try:
+        while pending:
+            next_pending = []
+            for file_paths, sub_dir_paths in pool.imap_unordered(scan, pending):
+                for file_path in file_paths:
+                    yield file_path
+                next_pending.extend(sub_dir_paths)
+            pending = next_pending
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _scan_dir(dir_path):
+    """
+    Returns [ (name, path, is_dir, is_link) ] for the entries of a directory, using the file type information the
+    directory listing already provides where possible. Unreadable directories are treated as empty, as os.walk does.
+    """
+    try:
+        if scandir is not None:
+            return [(entry.name, entry.path, entry.is_dir(), entry.is_symlink()) for entry in scandir(dir_path)]
+        entries = []
+        for name in os.listdir(dir_path):
+            path = os.path.join(dir_path, name)
+            entries.append((name, path, os.path.isdir(path), os.path.islink(path)))
+        return entries
+    except OSError:
+        return []
+
+
+def _get_extension(file_name):
+    """
+    Returns the extension of a file name without its leading '.', as os.path.splitext(file_name)[1][1:] would
+    """
+    dot_index = file_name.rfind('.')
+    # Leading dots (e.g. '.bashrc') do not start an extension
+    if dot_index <= 0 or not file_name[:dot_index].lstrip('.'):
+        return ''
+    return file_name[dot_index + 1:]
+
+
+def _compile_path_rules(rules):
+    """
+    Returns a function(path, name) which is True when any of the given rules matches, None if there are no rules
+    """
+    if rules is None:
+        return None
+    if isinstance(rules, basestring) or hasattr(rules, 'search'):
+        rules = [rules]
+    name_patterns = []
+    path_patterns = []
+    regexes = []
+    for rule in rules:
+        if hasattr(rule, 'search'):
+            regexes.append(rule)
+        elif os.sep in rule or '/' in rule or (os.altsep is not None and os.altsep in rule):
+            path_patterns.append(fnmatch.translate(os.path.normcase(rule)))
+        else:
+            name_patterns.append(fnmatch.translate(os.path.normcase(rule)))
+    # Globs are combined into one expression per target, so matching costs a single regex call whatever their number
+    name_regex = re.compile('|'.join('(?:{})'.format(p) for p in name_patterns)) if name_patterns else None
+    path_regex = re.compile('|'.join('(?:{})'.format(p) for p in path_patterns)) if path_patterns else None
+
+    def matches(path, name):
+        if name_regex is not None and name_regex.match(os.path.normcase(name)):
+            return True
+        if path_regex is not None and path_regex.match(os.path.normcase(path)):
+            return True
+        for regex in regexes:
+            if regex.search(path) is not None:
+                return True
+        return False
+    return matches
+
+
+def iter_duplicate_files(dir_paths, extensions=None, excluded_dir_paths=None, include=None, exclude=None,
+                         workers=None, min_size=1, block_size=DUPLICATE_BLOCK_SIZE, hardlink=False, failures=None):
+    """
+    Generates groups of files with identical contents in the specified directory trees. Files are grouped by size
+    first, then files sharing a size by a hash of their first and last blocks, and only files still colliding after
+    that are hashed in full, so most files are never read beyond two blocks. Groups are generated as soon as they are
+    confirmed. Paths which are hard links to the same file count as one file.
+    :param dir_paths: directory paths to search, as accepted by get_file_paths
+    :param extensions: set of extensions of the files to consider, see get_file_paths
+    :param excluded_dir_paths: directory paths to leave out, see get_file_paths
+    :param include: rules the files to consider must match, see get_file_paths
+    :param exclude: rules of the files to leave out, see get_file_paths
+    :type workers: int
+    :param workers: number of threads listing directories and hashing files concurrently, None or 1 does one thing
+        at a time
+    :type min_size: int
+    :param min_size: files smaller than this many bytes are ignored (by default, empty files)
+    :type block_size: int
+    :param block_size: bytes hashed at each end of a file in the second pass, and read at a time in the last one, so
+        each worker holds at most this much file data in memory
+    :type hardlink: bool
+    :param hardlink: if True, every duplicate is replaced by a hard link to the first path of its group; duplicates
+        on another device than that path, or which changed since they were hashed, are left alone
+    :type failures: list
+    :param failures: if given, (file_path, exception) is appended to it for every duplicate which could not be
+        replaced by a hard link (e.g. the original has too many links already); the search goes on regardless
+    :rtype generator
+    :return: generator of (size, sorted list of paths) tuples
+    """
+    files_by_size = collections.defaultdict(list)
+    seen_inodes = set()
+    for file_path in iter_file_paths(dir_paths, extensions, excluded_dir_paths, include, exclude, workers):
+        try:
+            file_stat = os.lstat(file_path)
+        except OSError:
+            continue
+        if not stat.S_ISREG(file_stat.st_mode) or file_stat.st_size < min_size:
+            continue
+        # Inode numbers are 0 where the platform doesn't provide them
+        if file_stat.st_ino:
+            inode = (file_stat.st_dev, file_stat.st_ino)
+            if inode in seen_inodes:
+                continue
+            seen_inodes.add(inode)
+        files_by_size[file_stat.st_size].append((file_path, file_stat))
+    tasks = [(file_path, file_stat, block_size) for files in files_by_size.itervalues() if len(files) > 1
+             for file_path, file_stat in files]
+    files_by_size = seen_inodes = None
+
+    pool = None if workers is None or workers <= 1 else multiprocessing.pool.ThreadPool(workers)
+    try:
+        files_by_ends = collections.defaultdict(list)
+        for file_path, file_stat, digest in _imap_unordered(pool, _hash_file_ends, tasks):
+            if digest is not None:
+                files_by_ends[(file_stat.st_size, digest)].append((file_path, file_stat))
+        tasks = []
+        remaining = []
+        for (size, digest), files in files_by_ends.iteritems():
+            if len(files) < 2:
+                continue
+            if size <= 2 * block_size:
+                # Both ends cover the whole file, so it is already confirmed
+                yield size, _finish_duplicate_group(files, hardlink, failures)
+                continue
+            tasks.extend((len(remaining), file_path, file_stat, block_size) for file_path, file_stat in files)
+            remaining.append(len(files))
+        files_by_ends = None
+
+        files_by_hash = collections.defaultdict(lambda: collections.defaultdict(list))
+        for index, file_path, file_stat, digest in _imap_unordered(pool, _hash_duplicate_candidate, tasks):
+            remaining[index] -= 1
+            if digest is not None:
+                files_by_hash[index][digest].append((file_path, file_stat))
+            if remaining[index] == 0:
+                for files in files_by_hash.pop(index, {}).itervalues():
+                    if len(files) > 1:
+                        yield files[0][1].st_size, _finish_duplicate_group(files, hardlink, failures)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def _imap_unordered(pool, func, iterable):
+    if pool is None:
+        return itertools.imap(func, iterable)
+    return pool.imap_unordered(func, iterable, 16)
+
+
+def _hash_file_ends(task):
+    """
+    Thread pool worker: hashes the first and last blocks of a file
+    :return: (file_path, file_stat, digest), digest being None if the file can't be read
+    """
+    file_path, file_stat, block_size = task
+    file_hash = hashlib.sha256()
+    try:
+        with open(file_path, 'rb') as f:
+            file_hash.update(f.read(block_size))
+            if file_stat.st_size > block_size:
+                f.seek(max(block_size, file_stat.st_size - block_size))
+                file_hash.update(f.read(block_size))
+    except IOError:
+        return file_path, file_stat, None
+    return file_path, file_stat, file_hash.digest()
+
+
+def _hash_duplicate_candidate(task):
+    """
+    Thread pool worker: hashes a whole file
+    :return: (index, file_path, file_stat, digest), digest being None if the file can't be read
+    """
+    index, file_path, file_stat, block_size = task
+    try:
+        return index, file_path, file_stat, get_file_hash(file_path, block_size=block_size)
+    except IOError:
+        return index, file_path, file_stat, None
+
+
+def _finish_duplicate_group(files, hardlink, failures):
+    """
+    Hard links a confirmed group of duplicates together if asked to
+    :param files: list of the form [ (file_path, file_stat) ]
+    :param failures: list to append (file_path, exception) to for every duplicate which could not be linked, or None
+    :return: sorted list of the paths of the group
+    """
+    files = sorted(files)
+    if hardlink:
+        original_path, original_stat = files[0]
+        for file_path, file_stat in files[1:]:
+            try:
+                _replace_with_hardlink(original_path, original_stat, file_path, file_stat)
+            except OSError as e:
+                # e.g. too many links to the original, or links not permitted there; the rest can still be linked
+                if failures is not None:
+                    failures.append((file_path, e))
+    return [file_path for file_path, file_stat in files]
+
+
+def _replace_with_hardlink(original_path, original_stat, file_path, file_stat):
+    """
+    Atomically replaces file_path by a hard link to original_path
+    :return: True if the file was replaced, False if it was left alone
+    """
+    if file_stat.st_dev != original_stat.st_dev:
+        return False
+    # Neither file may have changed since it was hashed, or the duplicate would be replaced by other contents
+    for path, expected_stat in ((original_path, original_stat), (file_path, file_stat)):
+        try:
+            current_stat = os.lstat(path)
+        except OSError:
+            return False
+        if ((current_stat.st_ino, current_stat.st_size, current_stat.st_mtime) !=
+                (expected_stat.st_ino, expected_stat.st_size, expected_stat.st_mtime)):
+            return False
+    # Link under a temporary name first, so file_path never goes missing; the link itself claims the name
+    for temp_path in unique_path_allocator._iter_candidates(file_path + '.link'):
+        try:
+            os.link(original_path, temp_path)
+            break
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    try:
+        os.rename(temp_path, file_path)
+    except OSError:
+        os.remove(temp_path)
+        raise
+    return True
+
+
+class SyncReport(object):
+    """
+    The outcome of sync_tree; paths are relative to the trees. In a dry run, what would have been done.
+    """
+
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.copied = []
+        self.created_dirs = []
+        self.deleted = []
+        self.unchanged = 0
+        # [ (path, exception) ]
+        self.failed = []
+        self.bytes_copied = 0
+        self.seconds = 0.0
+
+    def get_throughput(self):
+        """
+        :return: bytes copied per second
+        """
+        return self.bytes_copied / self.seconds if self.seconds else 0.0
+
+    def as_dict(self):
+        return {'dry_run': self.dry_run, 'copied': len(self.copied), 'created_dirs': len(self.created_dirs),
+                'deleted': len(self.deleted), 'unchanged': self.unchanged, 'failed': len(self.failed),
+                'bytes_copied': self.bytes_copied, 'seconds': self.seconds, 'throughput': self.get_throughput()}
+
+    def __repr__(self):
+        return "SyncReport(copied={}, deleted={}, unchanged={}, failed={}, bytes_copied={})".format(
+            len(self.copied), len(self.deleted), self.unchanged, len(self.failed), self.bytes_copied)
+
+
+def sync_tree(source_dir_path, dest_dir_path, delete=False, checksum=False, dry_run=False, workers=None):
+    """
+    Makes the destination directory a mirror of the source directory, copying only the files which are new or
+    changed. A file is considered changed when its size or modification time (to the second) differ, or with checksum,
+    when its size or contents differ. Copies are made by the kernel (copy_file_range, else sendfile) where the Python
+    version and platform allow, written under a temporary name and moved into place, and keep the source's
+    modification time and permissions. Symbolic links to files are copied as the files they point to, symbolic links
+    to directories are left out, as get_file_paths does.
+    :type source_dir_path: str
+    :param source_dir_path: path of the directory to mirror
+    :type dest_dir_path: str
+    :param dest_dir_path: path of the mirror, created if needed
+    :type delete: bool
+    :param delete: if True, files and directories of the destination which aren't in the source are deleted
+    :type checksum: bool
+    :param checksum: if True, files of the same size are compared by contents rather than modification time
+    :type dry_run: bool
+    :param dry_run: if True, nothing is changed and the report says what would have been done
+    :type workers: int
+    :param workers: number of threads listing, hashing and copying concurrently, None or 1 does one thing at a time
+    :rtype SyncReport
+    :return: what was copied, created and deleted, and how fast
+    """
+    if not os.path.isdir(source_dir_path):
+        raise DirectoryError("{} is not a directory".format(source_dir_path))
+    if os.path.exists(dest_dir_path) and not os.path.isdir(dest_dir_path):
+        raise DirectoryError("{} is not a directory".format(dest_dir_path))
+    start_time = time.time()
+    report = SyncReport(dry_run)
+    pool = None if workers is None or workers <= 1 else multiprocessing.pool.ThreadPool(workers)
+    try:
+        source_files, source_dirs = _scan_sync_tree(source_dir_path, pool, True)
+        if os.path.isdir(dest_dir_path):
+            dest_files, dest_dirs = _scan_sync_tree(dest_dir_path, pool, False)
+        else:
+            dest_files, dest_dirs = {}, set()
+
+        to_copy = []
+        to_compare = []
+        for path, source_stat in source_files.iteritems():
+            dest_stat = dest_files.get(path)
+            if dest_stat is None or not stat.S_ISREG(dest_stat.st_mode) or dest_stat.st_size != source_stat.st_size:
+                to_copy.append(path)
+            elif checksum:
+                to_compare.append(path)
+            elif int(dest_stat.st_mtime) != int(source_stat.st_mtime):
+                to_copy.append(path)
+            else:
+                report.unchanged += 1
+        compare_tasks = [(os.path.join(source_dir_path, path), os.path.join(dest_dir_path, path), path)
+                         for path in to_compare]
+        for path, equal in _imap_unordered(pool, _compare_sync_files, compare_tasks):
+            if not equal:
+                to_copy.append(path)
+                continue
+            report.unchanged += 1
+            source_stat = source_files[path]
+            if not dry_run and int(dest_files[path].st_mtime) != int(source_stat.st_mtime):
+                try:
+                    os.utime(os.path.join(dest_dir_path, path), (source_stat.st_atime, source_stat.st_mtime))
+                except OSError as e:
+                    report.failed.append((path, e))
+
+        # Destination entries in the way of the source's (a directory where a file goes or the other way around)
+        # always go, extraneous ones only if asked; either way only the top of an extraneous tree needs naming
+        obstructions = [path for path in dest_dirs if path in source_files]
+        obstructions.extend(path for path in dest_files if path in source_dirs)
+        if delete:
+            obstructions.extend(path for path in itertools.chain(dest_files, dest_dirs)
+                                if path not in source_files and path not in source_dirs and
+                                (os.path.dirname(path) == '' or os.path.dirname(path) in source_dirs))
+        report.created_dirs = sorted(path for path in source_dirs if path not in dest_dirs)
+        to_copy.sort()
+        report.copied = to_copy
+        if dry_run:
+            report.deleted = sorted(obstructions)
+            report.bytes_copied = sum(source_files[path].st_size for path in to_copy)
+        else:
+            summary = remove_files([os.path.join(dest_dir_path, path) for path in obstructions], workers=workers,
+                                   remove_dirs=True)
+            report.deleted = sorted(os.path.relpath(path, dest_dir_path) for path in summary.removed)
+            report.failed.extend(summary.failed)
+            # Sorted, so parents are created before their children
+            for path in [''] + report.created_dirs:
+                dir_path = os.path.join(dest_dir_path, path)
+                if not os.path.isdir(dir_path):
+                    os.makedirs(dir_path)
+            copy_tasks = [(os.path.join(source_dir_path, path), os.path.join(dest_dir_path, path), path)
+                          for path in to_copy]
+            report.copied = []
+            for path, copied_bytes, error in _imap_unordered(pool, _sync_file, copy_tasks):
+                if error is None:
+                    report.copied.append(path)
+                    report.bytes_copied += copied_bytes
+                else:
+                    report.failed.append((path, error))
+            report.copied.sort()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    report.seconds = time.time() - start_time
+    return report
+
+
+def _scan_sync_tree(root_dir_path, pool, follow_links):
+    """
+    Lists a tree for sync_tree, level by level
+    :param follow_links: if True, symbolic links to files are listed with their target's stat and symbolic links to
+        directories and anything but regular files are left out (the source); otherwise every entry which isn't a
+        directory is listed with its own stat (the destination)
+    :return: ({ relative file path: stat }, set of relative directory paths)
+    """
+    files = {}
+    dirs = set()
+    pending = ['']
+    while pending:
+        tasks = [(root_dir_path, path, follow_links) for path in pending]
+        pending = []
+        for dir_path, entries in _imap_unordered(pool, _list_sync_dir, tasks):
+            for name, is_dir, entry_stat in entries:
+                path = os.path.join(dir_path, name) if dir_path else name
+                if is_dir:
+                    dirs.add(path)
+                    pending.append(path)
+                else:
+                    files[path] = entry_stat
+    return files, dirs
+
+
+def _list_sync_dir(task):
+    """
+    Thread pool worker: lists a directory for _scan_sync_tree
+    :return: (relative directory path, [ (name, is_dir, stat) ])
+    """
+    root_dir_path, dir_path, follow_links = task
+    entries = []
+    for name, path, is_dir, is_link in _scan_dir(os.path.join(root_dir_path, dir_path)):
+        if is_dir and not is_link:
+            entries.append((name, True, None))
+            continue
+        try:
+            entry_stat = os.stat(path) if follow_links else os.lstat(path)
+        except OSError:
+            continue
+        if follow_links and not stat.S_ISREG(entry_stat.st_mode):
+            continue
+        entries.append((name, False, entry_stat))
+    return dir_path, entries
+
+
+def _compare_sync_files(task):
+    """
+    Thread pool worker: compares the contents of a source file and its copy
+    :return: (relative path, True if their contents are the same)
+    """
+    source_path, dest_path, path = task
+    try:
+        return path, get_file_hash(source_path) == get_file_hash(dest_path)
+    except IOError:
+        return path, False
+
+
+def _sync_file(task):
+    """
+    Thread pool worker: copies a file over its mirror, by way of a temporary file in the same directory
+    :return: (relative path, bytes copied, exception or None)
+    """
+    source_path, dest_path, path = task
+    temp_path = None
+    try:
+        temp_path = claim_unique_path(os.path.basename(dest_path) + '.sync', os.path.dirname(dest_path))
+        source_fd = os.open(source_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            dest_fd = os.open(temp_path, os.O_WRONLY | os.O_TRUNC | getattr(os, 'O_BINARY', 0))
+            try:
+                copied_bytes = _copy_file_data(source_fd, dest_fd)
+            finally:
+                os.close(dest_fd)
+        finally:
+            os.close(source_fd)
+        shutil.copystat(source_path, temp_path)
+        if os.name == 'nt' and os.path.exists(dest_path):
+            # Windows won't rename over an existing file
+            os.remove(dest_path)
+        os.rename(temp_path, dest_path)
+    except (IOError, OSError) as e:
+        if temp_path is not None and os.path.exists(temp_path):
+            os.remove(temp_path)
+        return path, 0, e
+    return path, copied_bytes, None
+
+
+def _copy_file_data(source_fd, dest_fd):
+    """
+    Copies everything from one open file to another, in the kernel where possible, falling back on reading and writing
+    blocks when kernel side copies aren't available or fail with an error meaning they can't be used here
+    :return: number of bytes copied
+    """
+    copied = 0
+    if _copy_file_range is not None:
+        try:
+            while True:
+                count = _copy_file_range(source_fd, dest_fd, SYNC_KERNEL_COPY_SIZE, copied, copied)
+                if count == 0:
+                    return copied
+                copied += count
+        except OSError as e:
+            if e.errno not in _KERNEL_COPY_UNSUPPORTED_ERRORS:
+                raise
+    if _sendfile is not None:
+        # sendfile writes at the destination's current position
+        os.lseek(dest_fd, copied, os.SEEK_SET)
+        try:
+            while True:
+                count = _sendfile(dest_fd, source_fd, copied, SYNC_KERNEL_COPY_SIZE)
+                if count == 0:
+                    return copied
+                copied += count
+        except OSError as e:
+            if e.errno not in _KERNEL_COPY_UNSUPPORTED_ERRORS:
+                raise
+    os.lseek(source_fd, copied, os.SEEK_SET)
+    os.lseek(dest_fd, copied, os.SEEK_SET)
+    while True:
+        block = os.read(source_fd, SYNC_COPY_BLOCK_SIZE)
+        if not block:
+            return copied
+        while block:
+            written = os.write(dest_fd, block)
+            block = block[written:]
+            copied += written
+
+
+class DirectoryUsage(object):
+    """
+    Totals of the files in a directory tree, as reported by get_disk_usage. Sizes are of the files only, directories
+    themselves count as nothing.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Bytes of content, and bytes allocated on disk (the former where the platform doesn't report allocation)
+        self.size = 0
+        self.disk_usage = 0
+        self.file_count = 0
+        # Directories below path
+        self.dir_count = 0
+
+    def add(self, other):
+        self.size += other.size
+        self.disk_usage += other.disk_usage
+        self.file_count += other.file_count
+        self.dir_count += other.dir_count + 1
+
+    def __repr__(self):
+        return "DirectoryUsage({!r}, size={}, disk_usage={}, file_count={}, dir_count={})".format(
+            self.path, self.size, self.disk_usage, self.file_count, self.dir_count)
+
+
+def get_disk_usage(dir_paths, excluded_dir_paths=None, workers=None, cache_path=None):
+    """
+    Returns the totals of every directory in the specified trees, like du. File sizes come from the stat information
+    the directory listing provides where possible; files with several hard links are only counted once, under the
+    first of their paths in sorted order, and symbolic links are counted as themselves rather than followed.
+
+    With a cache, a directory whose modification time is the same as when it was cached is not listed again. Adding,
+    removing or renaming entries updates a directory's modification time but writing to a file does not, so files
+    which grew in place since the cache was written are reported at their cached size.
+    :type dir_paths: str or set
+    :param dir_paths: set of directory paths to summarize
+    :param excluded_dir_paths: directory paths to leave out, as accepted by get_file_paths
+    :type workers: int
+    :param workers: number of threads listing directories concurrently, None or 1 lists them one at a time
+    :type cache_path: str
+    :param cache_path: path of the database the listings are cached in (created if needed), None to use no cache
+    :rtype dict
+    :return: dict of the form { directory path: DirectoryUsage } with an entry for every directory of the trees
+    """
+    if isinstance(dir_paths, str):
+        dir_paths = {dir_paths}
+    if isinstance(excluded_dir_paths, str):
+        excluded_dir_paths = {excluded_dir_paths}
+    excluded_dir_paths = set(os.path.normcase(os.path.abspath(path)) for path in excluded_dir_paths or ())
+    cache = None if cache_path is None else _DiskUsageCache(cache_path)
+    # Listings newer than this may be changed again within the same modification time tick, so aren't cached
+    cacheable_mtime = time.time() - 2
+    listings = {}
+    pool = None if workers is None or workers <= 1 else multiprocessing.pool.ThreadPool(workers)
+    try:
+        pending = [os.path.abspath(dir_path) for dir_path in dir_paths]
+        while pending:
+            tasks = [(dir_path, None if cache is None else cache.get(dir_path)) for dir_path in pending
+                     if os.path.normcase(dir_path) not in excluded_dir_paths]
+            pending = []
+            for dir_path, dir_stat, listing, cached in _imap_unordered(pool, _list_dir_usage, tasks):
+                if listing is None:
+                    continue
+                listings[dir_path] = listing
+                if cache is not None and not cached and dir_stat.st_mtime < cacheable_mtime:
+                    cache.put(dir_path, dir_stat, listing)
+                pending.extend(os.path.join(dir_path, name) for name in listing[4])
+        if cache is not None:
+            cache.save()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if cache is not None:
+            cache.close()
+
+    usages = {}
+    seen_inodes = set()
+    # Sorted, so which path a hard linked file is counted under doesn't depend on the listing order
+    for dir_path in sorted(listings):
+        file_count, size, disk_usage, linked_files, sub_dir_names = listings[dir_path]
+        usage = usages[dir_path] = DirectoryUsage(dir_path)
+        usage.file_count, usage.size, usage.disk_usage = file_count, size, disk_usage
+        for dev, ino, file_size, file_disk_usage in linked_files:
+            if (dev, ino) not in seen_inodes:
+                seen_inodes.add((dev, ino))
+                usage.file_count += 1
+                usage.size += file_size
+                usage.disk_usage += file_disk_usage
+    # Deepest first, so every directory's totals are complete before they are added to its parent's
+    for dir_path in sorted(listings, key=lambda path: path.count(os.sep), reverse=True):
+        parent_usage = usages.get(os.path.dirname(dir_path))
+        if parent_usage is not None and parent_usage is not usages[dir_path]:
+            parent_usage.add(usages[dir_path])
+    return usages
+
+
+def get_largest_dirs(usages, count=10, key='disk_usage'):
+    """
+    Returns the largest of the directories summarized by get_disk_usage
+    :type usages: dict
+    :param usages: dict of the form { directory path: DirectoryUsage }
+    :type count: int
+    :param count: number of directories to return
+    :type key: str
+    :param key: DirectoryUsage attribute to rank by, e.g. 'size' or 'file_count'
+    :rtype list
+    :return: list of DirectoryUsage, largest first
+    """
+    return sorted(usages.itervalues(), key=lambda usage: (-getattr(usage, key), usage.path))[:count]
+
+
+def _list_dir_usage(task):
+    """
+    Thread pool worker: totals the files directly in a directory, unless its cached listing is still current
+    :return: (dir_path, dir_stat, listing, cached) where listing is (file_count, size, disk_usage, linked_files,
+        sub_dir_names), linked_files being [ (dev, ino, size, disk_usage) ] for the files with several hard links; the
+        listing is None if the directory can't be read
+    """
+    dir_path, cached_entry = task
+    try:
+        dir_stat = os.lstat(dir_path)
+    except OSError:
+        return dir_path, None, None, False
+    if cached_entry is not None and cached_entry[0] == dir_stat.st_mtime and cached_entry[1] == dir_stat.st_ino:
+        return dir_path, dir_stat, cached_entry[2], True
+    file_count = size = disk_usage = 0
+    linked_files = []
+    sub_dir_names = []
+    try:
+        if scandir is not None:
+            entries = [(entry.name, entry.path, entry) for entry in scandir(dir_path)]
+        else:
+            entries = [(name, os.path.join(dir_path, name), None) for name in os.listdir(dir_path)]
+    except OSError:
+        return dir_path, dir_stat, None, False
+    for name, path, entry in entries:
+        try:
+            # On Windows the listing already holds the stat information, elsewhere this costs an lstat
+            entry_stat = os.lstat(path) if entry is None else entry.stat(follow_symlinks=False)
+        except OSError:
+            continue
+        if stat.S_ISDIR(entry_stat.st_mode):
+            sub_dir_names.append(name)
+            continue
+        # st_blocks counts 512 byte units whatever the file system's block size
+        entry_disk_usage = entry_stat.st_blocks * 512 if hasattr(entry_stat, 'st_blocks') else entry_stat.st_size
+        if entry_stat.st_nlink > 1 and entry_stat.st_ino:
+            linked_files.append((entry_stat.st_dev, entry_stat.st_ino, entry_stat.st_size, entry_disk_usage))
+        else:
+            file_count += 1
+            size += entry_stat.st_size
+            disk_usage += entry_disk_usage
+    return dir_path, dir_stat, (file_count, size, disk_usage, linked_files, sub_dir_names), False
+
+
+class _DiskUsageCache(object):
+    """
+    Listings of get_disk_usage, keyed on each directory's path, modification time and inode number
+    """
+
+    def __init__(self, cache_path):
+        self._connection = sqlite3.connect(cache_path)
+        # Paths are kept as they were given rather than coming back as unicode
+        self._connection.text_factory = str
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime REAL, ino INTEGER, listing TEXT)')
+
+    def get(self, dir_path):
+        """
+        :return: (mtime, ino, listing), None if the directory isn't cached
+        """
+        row = self._connection.execute('SELECT mtime, ino, listing FROM dirs WHERE path = ?', (dir_path,)).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1], json.loads(row[2])
+
+    def put(self, dir_path, dir_stat, listing):
+        self._connection.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?)',
+                                 (dir_path, dir_stat.st_mtime, dir_stat.st_ino, json.dumps(listing)))
+
+    def save(self):
+        self._connection.commit()
+
+    def close(self):
+        self._connection.close()
 
 
 def get_root_dir(path):
@@ -122,6 +1184,7 @@ class FileCreator(object):
 
     def __init__(self):
         self.files_created = []
+        self.dirs_created = []
 
     def __enter__(self):
         return self
@@ -143,67 +1206,865 @@ class FileCreator(object):
             dir_path = os.getcwd()
         if base_name is None:
             base_name = "test_file.txt"
-        file_path = generate_unique_path(os.path.join(dir_path, base_name))
-        self.touch(file_path)
+        file_path = claim_unique_path(base_name, dir_path)
+        self.files_created.append(file_path)
         return file_path
 
+    def create_unique_files(self, count, base_name=None, dir_path=None):
+        """
+        Creates count uniquely named files in the given directory path
+        :type count: int
+        :param count: number of files to create
+        :type base_name: str
+        :param base_name: the base name of the files we want to create
+        :type dir_path: str
+        :param dir_path: the path to the directory where the files shall be created
+        :rtype list
+        :return: the paths of the newly created files
+        """
+        if dir_path is None:
+            dir_path = os.getcwd()
+        if base_name is None:
+            base_name = "test_file.txt"
+        file_paths = reserve_unique_paths(base_name, count, dir_path)
+        self.files_created.extend(file_paths)
+        return file_paths
+
     def touch(self, file_path):
         touch(file_path)
         self.files_created.append(file_path)
 
-    def create_files_from_dict(self, file_dict, dir_path=None):
+    def create_files_from_dict(self, file_dict, dir_path=None, workers=None):
         """
-        Creates files based on a file_dict.
+        Creates files based on a file_dict. Missing parent directories are created first, each only once, then the
+        files are written, concurrently if workers is given. A file which already exists is never overwritten.
         :type file_dict: dict
-        :param file_dict: dict of the form { file_path_str: file_contents_str }
+        :param file_dict: dict of the form { file_path_str: file_contents }, where file_contents is a str, a file-like
+            object to copy from, or an iterable of str chunks (e.g. a generator), so large contents are streamed
+            rather than held in memory
         :param dir_path: Directory path which relative file_path_str will be based upon
+        :type workers: int
+        :param workers: number of threads writing files concurrently, None or 1 writes one file at a time
         :return: None
         """
         if dir_path is None:
             dir_path = os.getcwd()
-        for file_path, contents in file_dict.iteritems():
-            full_path = os.path.join(dir_path, file_path)
-            if os.path.exists(full_path):
-                raise FileAlreadyExists("File '{}' already exists and therefor not be created as specified".format(
-                    file_path))
-            with open(full_path, 'w+') as f:
-                f.write(contents)
-            self.files_created.append(full_path)
+        items = [(os.path.join(dir_path, file_path), contents) for file_path, contents in file_dict.iteritems()]
+        self.dirs_created.extend(_make_dirs(set(os.path.dirname(full_path) for full_path, contents in items)))
+        if workers is None or workers <= 1 or len(items) < 2:
+            results = (_create_file(item) for item in items)
+            pool = None
+        else:
+            pool = multiprocessing.pool.ThreadPool(workers)
+            results = pool.imap_unordered(_create_file, items, MATERIALIZE_CHUNK_SIZE)
+        first_error = None
+        try:
+            for full_path, error in results:
+                if error is None:
+                    self.files_created.append(full_path)
+                elif first_error is None:
+                    first_error = error
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        if first_error is not None:
+            raise first_error
+
+    def materialize_tree(self, spec, dir_path=None, workers=None):
+        """
+        Creates a whole directory tree from a compact spec, see create_files_from_dict for how file contents are given
+        :param spec: either nested dicts of the form { name: file_contents or sub_dict }, where an empty sub_dict is
+            an empty directory, or a manifest: an iterable of (path, file_contents) pairs using '/' separators, where a
+            path ending with '/' (or file_contents of None) is a directory
+        :param dir_path: Directory path which the tree will be created in
+        :type workers: int
+        :param workers: number of threads writing files concurrently
+        :rtype list
+        :return: sorted list of the paths of the created files
+        """
+        if dir_path is None:
+            dir_path = os.getcwd()
+        file_dict = {}
+        dir_paths = set()
+        if isinstance(spec, dict):
+            entries = _iter_tree_spec(spec, '')
+        else:
+            entries = spec
+        for path, contents in entries:
+            if path.endswith('/') or contents is None:
+                dir_paths.add(os.path.join(dir_path, *path.strip('/').split('/')))
+            else:
+                file_dict[os.path.join(*path.split('/'))] = contents
+        self.dirs_created.extend(_make_dirs(dir_paths))
+        self.create_files_from_dict(file_dict, dir_path, workers)
+        return sorted(os.path.join(dir_path, file_path) for file_path in file_dict)
 
-    def delete_all_created_files(self):
-        remove_files(self.files_created)
+    def delete_all_created_files(self, workers=None):
+        """
+        Deletes every file this object created, then every directory it created that is empty by then
+        :type workers: int
+        :param workers: number of threads deleting concurrently, see remove_files
+        :rtype RemovalSummary
+        :return: what was removed, what was already missing and what could not be removed
+        """
+        summary = remove_files(self.files_created, workers=workers)
         self.files_created = []
+        # Deepest first, so each directory is emptied of its created sub directories before its own turn
+        for dir_path in sorted(self.dirs_created, key=len, reverse=True):
+            try:
+                os.rmdir(dir_path)
+                summary.removed.append(dir_path)
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    summary.missing.append(dir_path)
+                elif e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                    summary.failed.append((dir_path, e))
+        self.dirs_created = []
+        return summary
+
+
+def _make_dirs(dir_paths):
+    """
+    Creates the given directories and any missing parents
+    :return: list of the paths of the directories which were created, parents before children
+    """
+    created = []
+    # Sorted, a parent comes before its children, so later paths usually find their parents already there
+    for dir_path in sorted(dir_paths):
+        missing = []
+        path = dir_path
+        while path and not os.path.isdir(path):
+            missing.append(path)
+            parent = os.path.dirname(path)
+            if parent == path:
+                break
+            path = parent
+        for path in reversed(missing):
+            try:
+                os.mkdir(path)
+                created.append(path)
+            except OSError as e:
+                if e.errno != errno.EEXIST or not os.path.isdir(path):
+                    raise
+    return created
+
+
+def _create_file(item):
+    """
+    Exclusively creates one file and writes its contents, see FileCreator.create_files_from_dict
+    :return: (path, None) if the file was created, (path, exception) otherwise
+    """
+    full_path, contents = item
+    try:
+        fd = os.open(full_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0))
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            return full_path, FileAlreadyExists(
+                "File '{}' already exists and therefor not be created as specified".format(full_path))
+        return full_path, e
+    try:
+        if isinstance(contents, basestring):
+            # Text is written in text mode, as it always has been
+            with os.fdopen(fd, 'w') as f:
+                f.write(contents)
+        else:
+            with os.fdopen(fd, 'wb') as f:
+                if hasattr(contents, 'read'):
+                    shutil.copyfileobj(contents, f)
+                else:
+                    for chunk in contents:
+                        f.write(chunk)
+    except (IOError, OSError) as e:
+        _remove_partial_file(full_path)
+        return full_path, e
+    except:
+        # e.g. a contents generator failing partway
+        _remove_partial_file(full_path)
+        raise
+    return full_path, None
+
+
+def _remove_partial_file(file_path):
+    """
+    Removes a file _create_file could not finish, which would otherwise pass for a complete one without being recorded
+    in files_created
+    """
+    try:
+        os.remove(file_path)
+    except OSError:
+        pass
+
+
+def _iter_tree_spec(spec, prefix):
+    """
+    Flattens a nested dict tree spec into manifest entries, see FileCreator.materialize_tree
+    """
+    for name, value in spec.iteritems():
+        path = prefix + name
+        if isinstance(value, dict):
+            if value:
+                for entry in _iter_tree_spec(value, path + '/'):
+                    yield entry
+            else:
+                yield path + '/', None
+        else:
+            yield path, value
 
 
-def remove_files(file_paths, parent_dir=None):
+def remove_files(file_paths, parent_dir=None, workers=None, remove_dirs=False):
     """
-    Deletes the files specified by file_paths
+    Deletes the files specified by file_paths. Paths are grouped by directory and, where the platform supports it, each
+    group is unlinked relative to a single open handle on its directory, so the directory path is only resolved once.
     :param file_paths: paths of the files that will be deleted
-    :return: None
+    :param parent_dir: directory which relative file paths are based upon, the current directory if None
+    :type workers: int
+    :param workers: number of threads deleting concurrently, worthwhile on high latency file systems; None or 1
+        deletes one file at a time
+    :type remove_dirs: bool
+    :param remove_dirs: if True, paths which are directories are removed along with their contents, otherwise they
+        are reported as failures
+    :rtype RemovalSummary
+    :return: what was removed, what was already missing and what could not be removed
     """
     if parent_dir is None:
         parent_dir = os.getcwd()
+    groups = collections.OrderedDict()
     for file_path in file_paths:
+        dir_path, name = os.path.split(os.path.join(parent_dir, file_path))
+        groups.setdefault(dir_path, []).append(name)
+    # Big directories are split so their files can be spread over the workers
+    batches = [(dir_path, names[i:i + REMOVE_FILES_BATCH_SIZE])
+               for dir_path, names in groups.iteritems() for i in xrange(0, len(names), REMOVE_FILES_BATCH_SIZE)]
+    summary = RemovalSummary()
+    if workers is None or workers <= 1 or len(batches) < 2:
+        results = (_remove_batch(batch, remove_dirs) for batch in batches)
+        pool = None
+    else:
+        pool = multiprocessing.pool.ThreadPool(workers)
+        results = pool.imap_unordered(lambda batch: _remove_batch(batch, remove_dirs), batches)
+    try:
+        for removed, missing, failed in results:
+            summary.removed.extend(removed)
+            summary.missing.extend(missing)
+            summary.failed.extend(failed)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return summary
+
+
+def _remove_batch(batch, remove_dirs):
+    """
+    Removes the named entries of one directory
+    :return: (removed paths, missing paths, [ (path, exception) ] of failures)
+    """
+    dir_path, names = batch
+    removed, missing, failed = [], [], []
+    dir_fd = None
+    if _UNLINK_SUPPORTS_DIR_FD:
         try:
-            os.remove(os.path.join(parent_dir, file_path))
-        except WindowsError:
-            pass
+            dir_fd = os.open(dir_path, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return [], [os.path.join(dir_path, name) for name in names], []
+    try:
+        for name in names:
+            path = os.path.join(dir_path, name)
+            try:
+                if dir_fd is not None:
+                    os.unlink(name, dir_fd=dir_fd)
+                else:
+                    os.remove(path)
+                removed.append(path)
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    missing.append(path)
+                elif os.path.isdir(path) and not os.path.islink(path):
+                    if not remove_dirs:
+                        failed.append((path, e))
+                        continue
+                    try:
+                        shutil.rmtree(path)
+                        removed.append(path)
+                    except OSError as rmtree_error:
+                        failed.append((path, rmtree_error))
+                else:
+                    failed.append((path, e))
+    finally:
+        if dir_fd is not None:
+            os.close(dir_fd)
+    return removed, missing, failed
 
 
-def zip_dir(input_dir_path, output_file_path):
+class RemovalSummary(object):
+    """
+    The outcome of remove_files
+    """
+
+    def __init__(self):
+        self.removed = []
+        self.missing = []
+        # [ (path, exception) ]
+        self.failed = []
+
+    def __repr__(self):
+        return "RemovalSummary(removed={}, missing={}, failed={})".format(
+            len(self.removed), len(self.missing), len(self.failed))
+
+
+def zip_dir(input_dir_path, output_file_path, workers=None, policy=None, exclude=None):
     """
     Zips the given directory and all contents up and outputs the result to output_file_path
     :type input_dir_path: str
     :param input_dir_path: the path to the directory to be zipped up
     :type output_file_path: str
     :param output_file_path: the desired path of the output zip file
+    :type workers: int
+    :param workers: number of processes deflating members concurrently, None or 1 deflates them one at a time
+    :type policy: CompressionPolicy
+    :param policy: how each member is compressed, DEFAULT_COMPRESSION_POLICY if None
+    :type exclude: str or list
+    :param exclude: rules matching files, or whole directory trees, to leave out, see iter_file_paths
+    :rtype CompressionReport
+    :return: the bytes saved by each rule of the policy
     """
     if not os.path.isdir(input_dir_path):
-        raise DirectoryError("{} is not a directory")
+        raise DirectoryError("{} is not a directory".format(input_dir_path))
     with zipfile.ZipFile(output_file_path, 'w', zipfile.ZIP_DEFLATED) as z:
+        return write_files_to_zip(
+            z, get_zip_dir_members(input_dir_path, exclude), workers, policy or DEFAULT_COMPRESSION_POLICY)
+
+
+def zip_dir_to_stream(input_dir_path, stream, workers=None, policy=None, exclude=None):
+    """
+    Zips the given directory and all contents up, as zip_dir does, writing the archive to a stream which need not be
+    seekable (e.g. stdout or a pipe)
+    :type input_dir_path: str
+    :param input_dir_path: the path to the directory to be zipped up
+    :param stream: writable file-like object
+    :type workers: int
+    :param workers: number of processes deflating members concurrently, None or 1 deflates them one at a time
+    :type policy: CompressionPolicy
+    :param policy: how each member is compressed, DEFAULT_COMPRESSION_POLICY if None
+    :type exclude: str or list
+    :param exclude: rules matching files, or whole directory trees, to leave out, see iter_file_paths
+    :rtype CompressionReport
+    :return: the bytes saved by each rule of the policy
+    """
+    if not os.path.isdir(input_dir_path):
+        raise DirectoryError("{} is not a directory".format(input_dir_path))
+    with StreamingZipFile(stream) as z:
+        return write_files_to_zip(
+            z, get_zip_dir_members(input_dir_path, exclude), workers, policy or DEFAULT_COMPRESSION_POLICY)
+
+
+def get_zip_dir_members(input_dir_path, exclude=None):
+    """
+    Returns the members zip_dir archives for the given directory
+    :type input_dir_path: str
+    :param input_dir_path: the path to the directory to be zipped up
+    :type exclude: str or list
+    :param exclude: rules matching files, or whole directory trees, to leave out, see iter_file_paths
+    :return: list of the form [ (file_path, None) ], as accepted by write_files_to_zip
+    """
+    excluded = _compile_path_rules(exclude)
+    members = []
+    with instrumentation.phase('list_files'):
         for root, dirs, files in os.walk(input_dir_path):
-            for f in files:
-                z.write(os.path.join(root, f))
+            if excluded is not None:
+                dirs[:] = [d for d in dirs if not excluded(os.path.join(root, d), d)]
+                files = [f for f in files if not excluded(os.path.join(root, f), f)]
+            # Sorting keeps the member order deterministic however the members are compressed
+            dirs.sort()
+            for f in sorted(files):
+                members.append((os.path.join(root, f), None))
+            instrumentation.count('dirs_listed')
+            instrumentation.count('files_listed', len(files))
+    return members
+
+
+class CompressionPolicy(object):
+    """
+    Chooses how each member of a zip is compressed. The first pattern rule matching a member decides; otherwise
+    members with an extension of an already compressed format, or whose first block looks random, are stored, and
+    everything else gets the default method.
+    """
+
+    def __init__(self, rules=None, store_extensions=COMPRESSED_EXTENSIONS, entropy_threshold=DEFAULT_ENTROPY_THRESHOLD,
+                 default_method='deflate', default_level=None):
+        """
+        :type rules: list
+        :param rules: list of the form [ (pattern, method, level) ]: a glob pattern (see fnmatch) matched against the
+            member's file name or its whole '/' separated name, a key of COMPRESSION_METHODS, and a compression level
+            (1-9, None for the method's default)
+        :param store_extensions: set of lower case extensions of the files to store
+        :type entropy_threshold: float
+        :param entropy_threshold: bits per byte above which a file's sample counts as incompressible, None to never
+            sample files
+        :param default_method: key of COMPRESSION_METHODS for every other file
+        :param default_level: compression level for every other file
+        """
+        self.rules = [(pattern, _get_compress_type(method), level) for pattern, method, level in rules or ()]
+        self.store_extensions = frozenset(store_extensions)
+        self.entropy_threshold = entropy_threshold
+        self.default_compress_type = _get_compress_type(default_method)
+        self.default_level = default_level
+
+    def choose(self, file_path, arcname=None):
+        """
+        Returns how the given file should be compressed
+        :param file_path: path of the file
+        :param arcname: name the file is archived under, derived from file_path if None
+        :return: (rule_name, compress_type, level), rule_name being the pattern of the rule that decided, or one of
+            COMPRESSED_EXTENSION_RULE, HIGH_ENTROPY_RULE and DEFAULT_RULE
+        """
+        name = _get_arcname(file_path, arcname).replace(os.sep, '/')
+        file_name = name.rsplit('/', 1)[-1]
+        for pattern, compress_type, level in self.rules:
+            if fnmatch.fnmatch(file_name, pattern) or fnmatch.fnmatch(name, pattern):
+                return pattern, compress_type, level
+        if _get_extension(file_name).lower() in self.store_extensions:
+            return COMPRESSED_EXTENSION_RULE, zipfile.ZIP_STORED, None
+        if self.entropy_threshold is not None:
+            try:
+                with open(file_path, 'rb') as f:
+                    sample = f.read(ENTROPY_SAMPLE_SIZE)
+            except IOError:
+                sample = ''
+            # Tiny samples always look orderly, and tiny files cost next to nothing to deflate anyway
+            if len(sample) == ENTROPY_SAMPLE_SIZE and get_entropy(sample) > self.entropy_threshold:
+                return HIGH_ENTROPY_RULE, zipfile.ZIP_STORED, None
+        return DEFAULT_RULE, self.default_compress_type, self.default_level
+
+
+def _get_compress_type(method):
+    if method not in COMPRESSION_METHODS:
+        raise ValueError("Unknown compression method '{}', expected one of {}".format(
+            method, sorted(COMPRESSION_METHODS)))
+    compress_type = COMPRESSION_METHODS[method]
+    if compress_type is None:
+        raise ValueError("This Python's zipfile module does not support {} compression".format(method))
+    return compress_type
+
+
+def get_entropy(data):
+    """
+    Returns the Shannon entropy of the given bytes, in bits per byte (0 for constant data, 8 for random data)
+    :type data: str
+    :rtype float
+    """
+    if not data:
+        return 0.0
+    length = float(len(data))
+    return -sum(count / length * math.log(count / length, 2) for count in collections.Counter(data).itervalues())
+
+
+DEFAULT_COMPRESSION_POLICY = CompressionPolicy()
+
+
+class CompressionReport(object):
+    """
+    What each rule of a CompressionPolicy did while writing an archive
+    """
+
+    def __init__(self):
+        # { rule_name: [files, bytes, compressed_bytes] }
+        self._rules = collections.OrderedDict()
+
+    def add(self, rule_name, file_size, compress_size):
+        totals = self._rules.setdefault(rule_name, [0, 0, 0])
+        totals[0] += 1
+        totals[1] += file_size
+        totals[2] += compress_size
+
+    def get_saved_bytes(self, rule_name=None):
+        """
+        Returns the number of bytes compression saved, for the given rule or in total
+        """
+        if rule_name is not None:
+            totals = self._rules.get(rule_name, (0, 0, 0))
+            return totals[1] - totals[2]
+        return sum(totals[1] - totals[2] for totals in self._rules.itervalues())
+
+    def as_dict(self):
+        """
+        :return: dict of the form { rule_name: { 'files': n, 'bytes': n, 'compressed_bytes': n, 'saved_bytes': n } }
+        """
+        return dict((rule_name, {'files': files, 'bytes': size, 'compressed_bytes': compressed_size,
+                                 'saved_bytes': size - compressed_size})
+                    for rule_name, (files, size, compressed_size) in self._rules.iteritems())
+
+    def __repr__(self):
+        return "CompressionReport({})".format(', '.join(
+            "{}: {} files, {} bytes saved".format(rule_name, files, size - compressed_size)
+            for rule_name, (files, size, compressed_size) in self._rules.iteritems()))
+
+
+def write_files_to_zip(zip_file, members, workers=None, policy=None):
+    """
+    Writes files to an open zip file, in order. With several workers, members are compressed concurrently by a process
+    pool while this process appends the pre-compressed entries to the archive. Members larger than
+    PARALLEL_ZIP_MAX_MEMBER_SIZE are always written directly so their contents never have to be held in memory.
+    :type zip_file: zipfile.ZipFile or StreamingZipFile
+    :param zip_file: zip file opened for writing
+    :type members: list
+    :param members: list of the form [ (file_path, arcname) ], arcname of None is derived from file_path as
+        zipfile.ZipFile.write does
+    :type workers: int
+    :param workers: number of processes deflating members concurrently, None or 1 deflates them one at a time
+    :type policy: CompressionPolicy
+    :param policy: how each member is compressed, every member gets the zip file's own compression if None
+    :rtype CompressionReport
+    :return: the bytes saved by each rule of the policy
+    """
+    with instrumentation.phase('compress'):
+        report = _write_files_to_zip(zip_file, members, workers, policy)
+    if instrumentation.is_enabled():
+        for rule_name, totals in report.as_dict().iteritems():
+            instrumentation.count('compressed_files', totals['files'])
+            instrumentation.count('compressed_bytes_in', totals['bytes'])
+            instrumentation.count('compressed_bytes_out', totals['compressed_bytes'])
+            # Per rule, so a policy can be tuned from the stats of real runs
+            instrumentation.count('saved_bytes:' + rule_name, totals['saved_bytes'])
+    return report
+
+
+def _write_files_to_zip(zip_file, members, workers, policy):
+    report = CompressionReport()
+    if workers is None or workers <= 1 or len(members) < 2:
+        for file_path, arcname in members:
+            rule_name, compress_type, level = _choose_compression(policy, file_path, arcname)
+            _write_zip_member(zip_file, file_path, arcname, compress_type, level)
+            report.add(rule_name, *_get_last_member_sizes(zip_file))
+        return report
+    pool = multiprocessing.Pool(workers)
+    try:
+        batch_size = max(1, min(64, len(members) // (workers * 16)))
+        # A sliding window of batches rather than pool.imap, which would compress every member as fast as the workers
+        # can, holding the results in memory however far behind the writing of the archive falls
+        pending = collections.deque()
+        for start in xrange(0, len(members), batch_size):
+            batch = [(file_path, arcname, policy) for file_path, arcname in members[start:start + batch_size]]
+            pending.append((batch, pool.apply_async(_compress_zip_members, (batch,))))
+            if len(pending) > workers * PARALLEL_ZIP_BATCHES_PER_WORKER:
+                _write_compressed_batch(zip_file, report, *pending.popleft())
+        while pending:
+            _write_compressed_batch(zip_file, report, *pending.popleft())
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return report
+
+
+def _write_compressed_batch(zip_file, report, batch, result):
+    """
+    Writes a batch of members compressed by _compress_zip_members, waiting for it if needed
+    """
+    for (file_path, arcname, policy), (rule_name, compress_type, level, compressed) in itertools.izip(
+            batch, result.get()):
+        if compressed is None:
+            _write_zip_member(zip_file, file_path, arcname, compress_type, level)
+        elif isinstance(zip_file, StreamingZipFile):
+            zip_file.write_compressed(*compressed)
+        else:
+            _write_compressed_zip_member(zip_file, *compressed)
+        report.add(rule_name, *_get_last_member_sizes(zip_file))
+
+
+def _choose_compression(policy, file_path, arcname):
+    if policy is None:
+        return DEFAULT_RULE, None, None
+    return policy.choose(file_path, arcname)
+
+
+def _write_zip_member(zip_file, file_path, arcname, compress_type, level):
+    """
+    Writes one file to an open zip file with the given compression, None meaning the zip file's own
+    """
+    if compress_type is None:
+        zip_file.write(file_path, arcname)
+    elif isinstance(zip_file, StreamingZipFile):
+        zip_file.write(file_path, arcname, compress_type, level)
+    elif compress_type == zipfile.ZIP_DEFLATED and level is not None:
+        # zipfile.ZipFile.write has no level, so deflate here; files too large for memory get the default level
+        compressed = _compress_zip_member((file_path, arcname, None), compress_type, level)[3]
+        if compressed is None:
+            zip_file.write(file_path, arcname, compress_type)
+        else:
+            _write_compressed_zip_member(zip_file, *compressed)
+    else:
+        zip_file.write(file_path, arcname, compress_type)
+
+
+def _get_last_member_sizes(zip_file):
+    """
+    Returns (file_size, compress_size) of the member last written to a zip file
+    """
+    if isinstance(zip_file, StreamingZipFile):
+        member = zip_file._members[-1]
+        return member['file_size'], member['compress_size']
+    zinfo = zip_file.filelist[-1]
+    return zinfo.file_size, zinfo.compress_size
+
+
+def _compress_zip_members(tasks):
+    """
+    Process pool worker: compresses a batch of members, see _compress_zip_member
+    """
+    return [_compress_zip_member(task) for task in tasks]
+
+
+def _compress_zip_member(task, compress_type=None, level=None):
+    """
+    Process pool worker: chooses how a file is compressed, then reads and compresses it as zipfile.ZipFile.write would
+    :param task: (file_path, arcname, policy) tuple; when policy is None, compress_type and level are used
+    :return: (rule_name, compress_type, level, compressed) where compressed is (arcname, date_time, external_attr,
+        file_size, crc, compressed_data, compress_type), or None if the file is too large to be compressed in memory or
+        needs a method only zipfile.ZipFile.write implements
+    """
+    file_path, arcname, policy = task
+    if policy is None:
+        rule_name = DEFAULT_RULE
+        if compress_type is None:
+            compress_type = zipfile.ZIP_DEFLATED
+    else:
+        rule_name, compress_type, level = policy.choose(file_path, arcname)
+    st = os.stat(file_path)
+    if st.st_size > PARALLEL_ZIP_MAX_MEMBER_SIZE or compress_type not in (zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED):
+        return rule_name, compress_type, level, None
+    arcname = _get_arcname(file_path, arcname)
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    if compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION if level is None else level, zlib.DEFLATED, -15)
+        compressed_data = compressor.compress(data) + compressor.flush()
+    else:
+        compressed_data = data
+    crc = zlib.crc32(data) & 0xffffffff
+    return rule_name, compress_type, level, (arcname, time.localtime(st.st_mtime)[0:6], (st.st_mode & 0xFFFF) << 16,
+                                             len(data), crc, compressed_data, compress_type)
+
+
+def _get_arcname(file_path, arcname):
+    """
+    Returns the name a file is archived under, derived from its path when arcname is None, as zipfile.ZipFile.write does
+    """
+    if arcname is None:
+        arcname = file_path
+    arcname = os.path.normpath(os.path.splitdrive(arcname)[1])
+    while arcname[0] in (os.sep, os.altsep):
+        arcname = arcname[1:]
+    return arcname
+
+
+def _write_compressed_zip_member(zip_file, arcname, date_time, external_attr, file_size, crc, compressed_data,
+                                 compress_type=zipfile.ZIP_DEFLATED):
+    """
+    Appends an already compressed member to an open zip file, mirroring what zipfile.ZipFile.write does internally
+    """
+    # Relies on the private _writecheck and _didModify of zipfile.ZipFile as found in Python 2.7 (checked against
+    # 2.7.18). Python 3's ZipFile also tracks the start of the central directory (start_dir) and its open writers, so
+    # this would need updating there.
+    zinfo = zipfile.ZipInfo(arcname, date_time)
+    zinfo.external_attr = external_attr
+    zinfo.compress_type = compress_type
+    zinfo.file_size = file_size
+    zinfo.compress_size = len(compressed_data)
+    zinfo.CRC = crc
+    zinfo.header_offset = zip_file.fp.tell()
+    zip_file._writecheck(zinfo)
+    zip_file._didModify = True
+    zip_file.fp.write(zinfo.FileHeader())
+    zip_file.fp.write(compressed_data)
+    zip_file.filelist.append(zinfo)
+    zip_file.NameToInfo[zinfo.filename] = zinfo
+
+
+class StreamingZipFile(object):
+    """
+    Write-only zip archive for streams which can't seek or tell (stdout, pipes, sockets). Each member is compressed as
+    it is read, its CRC and sizes following its data in a data descriptor, and offsets are counted as bytes are written.
+    Zip64 records are used wherever sizes, offsets or the member count outgrow the classic format.
+    """
+
+    def __init__(self, stream, compression=zipfile.ZIP_DEFLATED):
+        """
+        :param stream: writable file-like object
+        :param compression: zipfile.ZIP_DEFLATED or zipfile.ZIP_STORED
+        """
+        self.stream = stream
+        self.compression = compression
+        # Members written so far, each a dict of the values needed for its central directory entry
+        self._members = []
+        self._offset = 0
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _write(self, data):
+        self.stream.write(data)
+        self._offset += len(data)
+
+    def _write_header(self, arcname, date_time, external_attr, compress_type, file_size, zip64):
+        if isinstance(arcname, unicode):
+            arcname, flag_bits = arcname.encode('utf-8'), 0x08 | 0x800
+        else:
+            flag_bits = 0x08
+        dos_time = date_time[3] << 11 | date_time[4] << 5 | date_time[5] // 2
+        dos_date = (date_time[0] - 1980) << 9 | date_time[1] << 5 | date_time[2]
+        member = {
+            'arcname': arcname, 'flag_bits': flag_bits, 'compress_type': compress_type, 'dos_time': dos_time,
+            'dos_date': dos_date, 'external_attr': external_attr, 'header_offset': self._offset, 'zip64': zip64,
+        }
+        if zip64:
+            # Sizes are only known once the data is written, the zip64 extra field just announces 8 byte descriptors
+            extra = struct.pack('<HHQQ', 1, 16, 0, 0)
+            size_field = 0xFFFFFFFF
+        else:
+            extra = ''
+            size_field = 0
+        self._write(struct.pack(
+            zipfile.structFileHeader, zipfile.stringFileHeader, 45 if zip64 else 20, 0, flag_bits, compress_type,
+            dos_time, dos_date, 0, size_field, size_field, len(arcname), len(extra)))
+        self._write(arcname)
+        self._write(extra)
+        return member
+
+    def _write_descriptor(self, member, crc, compress_size, file_size):
+        member.update(CRC=crc, compress_size=compress_size, file_size=file_size)
+        if member['zip64']:
+            self._write(struct.pack('<4sLQQ', 'PK\x07\x08', crc, compress_size, file_size))
+        elif compress_size > zipfile.ZIP64_LIMIT or file_size > zipfile.ZIP64_LIMIT:
+            raise zipfile.LargeZipFile("{} grew past the zip64 limit while being archived".format(member['arcname']))
+        else:
+            self._write(struct.pack('<4sLLL', 'PK\x07\x08', crc, compress_size, file_size))
+        self._members.append(member)
+
+    def write(self, file_path, arcname=None, compress_type=None, level=None):
+        """
+        Reads the given file in blocks and appends it to the archive
+        :param file_path: path of the file to archive
+        :param arcname: name to archive the file under, derived from file_path as zipfile.ZipFile.write does if None
+        :param compress_type: zipfile.ZIP_DEFLATED or zipfile.ZIP_STORED, the archive's compression if None
+        :param level: deflate level, zlib's default if None
+        """
+        if compress_type is None:
+            compress_type = self.compression
+        if compress_type not in (zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED):
+            raise ValueError("StreamingZipFile only supports ZIP_DEFLATED and ZIP_STORED")
+        st = os.stat(file_path)
+        # Leave room for deflate's worst case expansion when deciding whether zip64 sizes are needed
+        zip64 = st.st_size + st.st_size // 100 + 1024 > zipfile.ZIP64_LIMIT
+        member = self._write_header(
+            _get_arcname(file_path, arcname), time.localtime(st.st_mtime)[0:6], (st.st_mode & 0xFFFF) << 16,
+            compress_type, st.st_size, zip64)
+        if compress_type == zipfile.ZIP_DEFLATED:
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION if level is None else level, zlib.DEFLATED, -15)
+        else:
+            compressor = None
+        crc = 0
+        file_size = 0
+        compress_size = 0
+        with open(file_path, 'rb') as f:
+            while True:
+                block = f.read(1 << 16)
+                if not block:
+                    break
+                file_size += len(block)
+                crc = zlib.crc32(block, crc)
+                if compressor is not None:
+                    block = compressor.compress(block)
+                compress_size += len(block)
+                self._write(block)
+        if compressor is not None:
+            block = compressor.flush()
+            compress_size += len(block)
+            self._write(block)
+        self._write_descriptor(member, crc & 0xffffffff, compress_size, file_size)
+
+    def writestr(self, arcname, data):
+        """
+        Appends a member with the given contents to the archive
+        :param arcname: name of the member
+        :param data: contents of the member
+        """
+        member = self._write_header(
+            arcname, time.localtime(time.time())[0:6], 0o600 << 16, self.compression, len(data),
+            len(data) + len(data) // 100 + 1024 > zipfile.ZIP64_LIMIT)
+        compressed_data = data
+        if self.compression == zipfile.ZIP_DEFLATED:
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+            compressed_data = compressor.compress(data) + compressor.flush()
+        self._write(compressed_data)
+        self._write_descriptor(member, zlib.crc32(data) & 0xffffffff, len(compressed_data), len(data))
+
+    def write_compressed(self, arcname, date_time, external_attr, file_size, crc, compressed_data,
+                         compress_type=zipfile.ZIP_DEFLATED):
+        """
+        Appends an already compressed member to the archive, as produced by write_files_to_zip's worker processes
+        """
+        member = self._write_header(
+            arcname, date_time, external_attr, compress_type, file_size,
+            max(file_size, len(compressed_data)) > zipfile.ZIP64_LIMIT)
+        self._write(compressed_data)
+        self._write_descriptor(member, crc, len(compressed_data), file_size)
+
+    def close(self):
+        """
+        Writes the central directory; the stream itself is left open
+        """
+        if self._closed:
+            return
+        self._closed = True
+        central_dir_offset = self._offset
+        for member in self._members:
+            extra_values = []
+            file_size = member['file_size']
+            compress_size = member['compress_size']
+            header_offset = member['header_offset']
+            if file_size > zipfile.ZIP64_LIMIT or compress_size > zipfile.ZIP64_LIMIT:
+                extra_values.extend((file_size, compress_size))
+                file_size = compress_size = 0xFFFFFFFF
+            if header_offset > zipfile.ZIP64_LIMIT:
+                extra_values.append(header_offset)
+                header_offset = 0xFFFFFFFF
+            if extra_values:
+                extra = struct.pack('<HH' + 'Q' * len(extra_values), 1, 8 * len(extra_values), *extra_values)
+            else:
+                extra = ''
+            version = 45 if extra_values or member['zip64'] else 20
+            self._write(struct.pack(
+                zipfile.structCentralDir, zipfile.stringCentralDir, version, 3, version, 0, member['flag_bits'],
+                member['compress_type'], member['dos_time'], member['dos_date'], member['CRC'], compress_size,
+                file_size, len(member['arcname']), len(extra), 0, 0, 0, member['external_attr'], header_offset))
+            self._write(member['arcname'])
+            self._write(extra)
+        central_dir_size = self._offset - central_dir_offset
+        member_count = len(self._members)
+        if member_count > zipfile.ZIP_FILECOUNT_LIMIT or central_dir_offset > zipfile.ZIP64_LIMIT or \
+                central_dir_size > zipfile.ZIP64_LIMIT:
+            zip64_end_offset = self._offset
+            self._write(struct.pack(
+                zipfile.structEndArchive64, zipfile.stringEndArchive64, 44, 45, 45, 0, 0, member_count, member_count,
+                central_dir_size, central_dir_offset))
+            self._write(struct.pack(
+                zipfile.structEndArchive64Locator, zipfile.stringEndArchive64Locator, 0, zip64_end_offset, 1))
+            member_count = min(member_count, 0xFFFF)
+            central_dir_size = min(central_dir_size, 0xFFFFFFFF)
+            central_dir_offset = min(central_dir_offset, 0xFFFFFFFF)
+        self._write(struct.pack(
+            zipfile.structEndArchive, zipfile.stringEndArchive, 0, 0, member_count, member_count, central_dir_size,
+            central_dir_offset, 0))
+        self.stream.flush()
 
 
 class DirectoryError(Exception):
@@ -253,7 +2114,43 @@ class FileCreatorTests(unittest.TestCase):
         for file_path, contents in file_dict.iteritems():
             with open(os.path.join(self.test_dir, file_path), 'r') as f:
                 self.assertTrue(f.read() == contents)
+        self.assertRaises(FileAlreadyExists, self.file_creator.create_files_from_dict, file_dict, self.test_dir)
+        self.file_creator.delete_all_created_files()
+
+    def test_create_files_from_dict_streamed(self):
+        file_dict = dict(("sub_dir/{}/file_{}.bin".format(i % 3, i), StringIO.StringIO("file-like {}".format(i)))
+                         for i in xrange(20))
+        file_dict["generated.bin"] = (str(i) for i in xrange(10))
+        self.file_creator.create_files_from_dict(file_dict, self.test_dir, workers=4)
+        with open(os.path.join(self.test_dir, "sub_dir", "2", "file_5.bin"), 'rb') as f:
+            self.assertEqual("file-like 5", f.read())
+        with open(os.path.join(self.test_dir, "generated.bin"), 'rb') as f:
+            self.assertEqual("0123456789", f.read())
+        self.assertEqual(21, len(self.file_creator.files_created))
+        summary = self.file_creator.delete_all_created_files()
+        self.assertEqual(21 + 4, len(summary.removed))
+        self.assertEqual([], os.listdir(self.test_dir))
+
+        def failing_contents():
+            yield "partial"
+            raise ValueError("contents failed")
+        # A file whose contents fail partway is not left behind
+        self.assertRaises(ValueError, self.file_creator.create_files_from_dict,
+                          {"failed.bin": failing_contents()}, self.test_dir)
+        self.assertEqual([], os.listdir(self.test_dir))
+
+    def test_materialize_tree(self):
+        file_paths = self.file_creator.materialize_tree(
+            {"a": {"b.txt": "b", "c": {"d.txt": "d"}, "empty": {}}, "e.txt": "e"}, self.test_dir)
+        self.assertEqual(sorted(os.path.join(self.test_dir, *parts)
+                                for parts in (("a", "b.txt"), ("a", "c", "d.txt"), ("e.txt",))), file_paths)
+        self.assertTrue(os.path.isdir(os.path.join(self.test_dir, "a", "empty")))
+        self.file_creator.materialize_tree([("f/g.txt", "g"), ("f/h/", None)], self.test_dir, workers=2)
+        with open(os.path.join(self.test_dir, "f", "g.txt"), 'r') as f:
+            self.assertEqual("g", f.read())
+        self.assertTrue(os.path.isdir(os.path.join(self.test_dir, "f", "h")))
         self.file_creator.delete_all_created_files()
+        self.assertEqual([], os.listdir(self.test_dir))
 
     def test_delete_all_created_files(self):
         test_file_base_name = "test_delete_all_files_created.txt"
@@ -351,6 +2248,190 @@ class FileSysManipTests(unittest.TestCase):
         for p in paths:
             os.remove(p)
 
+    def test_unique_path_allocator(self):
+        allocator = UniquePathAllocator()
+        base_path = os.path.join(self.test_dir, "allocator_test_file.txt")
+        touch(base_path)
+        touch(os.path.join(self.test_dir, "allocator_test_file_7.txt"))
+        # Probing starts after the highest suffix already in the directory
+        self.assertEqual(os.path.join(self.test_dir, "allocator_test_file_8.txt"), allocator.generate(base_path))
+        claimed = allocator.claim("allocator_test_file.txt", self.test_dir)
+        self.assertTrue(os.path.isfile(claimed))
+        reserved = allocator.reserve("allocator_test_file.txt", 5, self.test_dir)
+        self.assertEqual(5, len(set(reserved)))
+        self.assertTrue(claimed not in reserved)
+        self.assertTrue(all(os.path.isfile(path) for path in reserved))
+        # Paths created behind the allocator's back are still never handed out
+        next_path = allocator.generate(base_path)
+        touch(next_path)
+        self.assertNotEqual(next_path, allocator.claim(base_path))
+        directory = allocator.claim("allocator_test_dir", self.test_dir, directory=True)
+        self.assertTrue(os.path.isdir(directory))
+
+    def test_iter_duplicate_files(self):
+        top_dir_path = os.path.join(self.test_dir, 'test_iter_duplicate_files')
+        self.file_creator.materialize_tree({
+            'big_1.txt': 'head' + 'x' * 100 + 'tail',
+            'sub': {'big_2.txt': 'head' + 'x' * 100 + 'tail'},
+            # Same size and ends as the big files, different middle
+            'big_3.txt': 'head' + 'x' * 50 + 'y' + 'x' * 49 + 'tail',
+            'small_1.txt': 'small',
+            'small_2.txt': 'small',
+            'unique.txt': 'unique',
+            'empty_1.txt': '',
+            'empty_2.txt': '',
+        }, top_dir_path)
+        big_paths = [os.path.join(top_dir_path, 'big_1.txt'), os.path.join(top_dir_path, 'sub', 'big_2.txt')]
+        small_paths = [os.path.join(top_dir_path, 'small_1.txt'), os.path.join(top_dir_path, 'small_2.txt')]
+        for workers in (None, 3):
+            self.assertEqual({(108, tuple(big_paths)), (5, tuple(small_paths))},
+                             set((size, tuple(paths)) for size, paths in
+                                 iter_duplicate_files(top_dir_path, workers=workers, block_size=16)))
+        if hasattr(os, 'link'):
+            self.assertEqual(2, len(list(iter_duplicate_files(top_dir_path, block_size=16, hardlink=True))))
+            self.assertEqual(os.stat(big_paths[0]).st_ino, os.stat(big_paths[1]).st_ino)
+            with open(big_paths[1], 'r') as f:
+                self.assertEqual('head' + 'x' * 100 + 'tail', f.read())
+            # Hard links to the same file are not duplicates
+            self.assertEqual([], list(iter_duplicate_files(top_dir_path, block_size=16)))
+
+    @unittest.skipUnless(hasattr(os, 'link'), "hard links are not supported")
+    def test_iter_duplicate_files_link_failures(self):
+        top_dir_path = os.path.join(self.test_dir, 'test_iter_duplicate_files_link_failures')
+        self.file_creator.materialize_tree({'a.txt': 'same', 'b.txt': 'same', 'c.txt': 'same'}, top_dir_path)
+        a_path, b_path, c_path = [os.path.join(top_dir_path, name) for name in ('a.txt', 'b.txt', 'c.txt')]
+        link = os.link
+        calls = []
+
+        def failing_link(source, link_name):
+            calls.append(link_name)
+            if len(calls) == 1:
+                raise OSError(errno.EMLINK, os.strerror(errno.EMLINK), link_name)
+            link(source, link_name)
+        os.link = failing_link
+        try:
+            failures = []
+            self.assertEqual([(4, [a_path, b_path, c_path])],
+                             list(iter_duplicate_files(top_dir_path, hardlink=True, failures=failures)))
+        finally:
+            os.link = link
+        # The failure is reported and the next duplicate still linked
+        self.assertEqual([b_path], [file_path for file_path, e in failures])
+        self.assertNotEqual(os.stat(a_path).st_ino, os.stat(b_path).st_ino)
+        self.assertEqual(os.stat(a_path).st_ino, os.stat(c_path).st_ino)
+        # Nothing is linked to an original which changed since it was hashed
+        b_stat = os.lstat(b_path)
+        a_stat = os.lstat(a_path)
+        with open(a_path, 'w') as f:
+            f.write('changed')
+        self.assertFalse(_replace_with_hardlink(a_path, a_stat, b_path, b_stat))
+
+    def test_get_disk_usage(self):
+        top_dir_path = os.path.join(self.test_dir, 'test_get_disk_usage')
+        self.file_creator.materialize_tree({
+            'a.txt': 'a' * 10,
+            'sub': {'b.txt': 'b' * 20, 'deeper': {'c.txt': 'c' * 30}},
+            'var': {'d.txt': 'd' * 40},
+        }, top_dir_path)
+        sub_dir_path = os.path.join(top_dir_path, 'sub')
+        self.assertEqual(50, get_disk_usage(top_dir_path, sub_dir_path)[top_dir_path].size)
+        if hasattr(os, 'link'):
+            # Hard links are only counted once
+            os.link(os.path.join(sub_dir_path, 'b.txt'), os.path.join(top_dir_path, 'var', 'b_link.txt'))
+        for workers in (None, 3):
+            usages = get_disk_usage(top_dir_path, workers=workers)
+            self.assertEqual((100, 4, 3), (usages[top_dir_path].size, usages[top_dir_path].file_count,
+                                           usages[top_dir_path].dir_count))
+            self.assertEqual((50, 2, 1), (usages[sub_dir_path].size, usages[sub_dir_path].file_count,
+                                          usages[sub_dir_path].dir_count))
+            self.assertEqual([top_dir_path, sub_dir_path],
+                             [usage.path for usage in get_largest_dirs(usages, 2, 'size')])
+
+        cache_path = os.path.join(self.test_dir, 'disk_usage.sqlite')
+        # Only listings of directories which haven't changed for a moment are cached
+        old_time = time.time() - 60
+        for dir_path in get_disk_usage(top_dir_path):
+            os.utime(dir_path, (old_time, old_time))
+        get_disk_usage(top_dir_path, cache_path=cache_path)
+        # Reruns reuse the listings of unchanged directories...
+        with open(os.path.join(sub_dir_path, 'b.txt'), 'a') as f:
+            f.write('b')
+        os.utime(sub_dir_path, (old_time, old_time))
+        self.assertEqual(100, get_disk_usage(top_dir_path, cache_path=cache_path)[top_dir_path].size)
+        # ...and list changed ones again
+        os.remove(os.path.join(top_dir_path, 'a.txt'))
+        usages = get_disk_usage(top_dir_path, cache_path=cache_path)
+        self.assertEqual((90, 3), (usages[top_dir_path].size, usages[top_dir_path].file_count))
+
+    def test_sync_tree(self):
+        source_dir_path = os.path.join(self.test_dir, 'test_sync_tree', 'source')
+        dest_dir_path = os.path.join(self.test_dir, 'test_sync_tree', 'dest')
+        self.file_creator.materialize_tree({
+            'same.txt': 'same', 'changed.txt': 'new contents', 'sub': {'new.txt': 'new', 'empty': {}},
+            'was_dir': 'now a file'}, source_dir_path)
+        self.file_creator.materialize_tree({
+            'same.txt': 'same', 'changed.txt': 'old', 'extra.txt': 'extra', 'extra_dir': {'extra.txt': 'extra'},
+            'was_dir': {'old.txt': 'old'}}, dest_dir_path)
+        same_time = time.time() - 60
+        for dir_path in (source_dir_path, dest_dir_path):
+            os.utime(os.path.join(dir_path, 'same.txt'), (same_time, same_time))
+
+        report = sync_tree(source_dir_path, dest_dir_path, delete=True, dry_run=True)
+        self.assertEqual(['changed.txt', os.path.join('sub', 'new.txt'), 'was_dir'], report.copied)
+        self.assertEqual(['extra.txt', 'extra_dir', 'was_dir'], report.deleted)
+        self.assertEqual(len('new contents' 'new' 'now a file'), report.bytes_copied)
+        self.assertTrue(os.path.isfile(os.path.join(dest_dir_path, 'extra.txt')))
+
+        report = sync_tree(source_dir_path, dest_dir_path, workers=3)
+        self.assertEqual(['changed.txt', os.path.join('sub', 'new.txt'), 'was_dir'], report.copied)
+        self.assertEqual(['was_dir'], report.deleted)
+        self.assertEqual(1, report.unchanged)
+        for path in ('same.txt', 'changed.txt', os.path.join('sub', 'new.txt'), 'was_dir'):
+            with open(os.path.join(source_dir_path, path), 'rb') as source_file:
+                with open(os.path.join(dest_dir_path, path), 'rb') as dest_file:
+                    self.assertEqual(source_file.read(), dest_file.read())
+        self.assertTrue(os.path.isdir(os.path.join(dest_dir_path, 'sub', 'empty')))
+        self.assertTrue(os.path.isfile(os.path.join(dest_dir_path, 'extra.txt')))
+        self.assertEqual([], sync_tree(source_dir_path, dest_dir_path).copied)
+
+        # Same size and modification time, different contents: only a checksum comparison notices
+        with open(os.path.join(dest_dir_path, 'same.txt'), 'w') as f:
+            f.write('SAME')
+        os.utime(os.path.join(dest_dir_path, 'same.txt'), (same_time, same_time))
+        self.assertEqual([], sync_tree(source_dir_path, dest_dir_path).copied)
+        report = sync_tree(source_dir_path, dest_dir_path, delete=True, checksum=True)
+        self.assertEqual(['same.txt'], report.copied)
+        self.assertEqual(['extra.txt', 'extra_dir'], report.deleted)
+        self.assertEqual(sorted(os.listdir(source_dir_path)), sorted(os.listdir(dest_dir_path)))
+
+    def test_instrumentation(self):
+        top_dir_path = os.path.join(self.test_dir, 'test_instrumentation')
+        self.file_creator.materialize_tree({'a.txt': 'a' * 100, 'sub': {'b.txt': 'b'}}, top_dir_path)
+        instrumentation.reset()
+        instrumentation.enable()
+        try:
+            get_file_paths(top_dir_path)
+            zip_dir(top_dir_path, os.path.join(self.test_dir, 'test_instrumentation.zip'))
+            for i in xrange(2):
+                get_file_line_list_from_cache(os.path.join(top_dir_path, 'a.txt'))
+            stats = instrumentation.get_stats()
+        finally:
+            instrumentation.disable()
+        self.assertEqual(2, stats.phases['list_files'].calls)
+        self.assertEqual(1, stats.phases['compress'].calls)
+        self.assertEqual({'dirs_listed': 4, 'files_listed': 4, 'compressed_files': 2, 'compressed_bytes_in': 101},
+                         dict((name, total) for name, total in stats.counters.iteritems()
+                              if name not in ('compressed_bytes_out', 'saved_bytes:' + DEFAULT_RULE)))
+        self.assertEqual(101 - stats.counters['compressed_bytes_out'], stats.counters['saved_bytes:' + DEFAULT_RULE])
+        self.assertEqual(0.5, stats.get_hit_rate('file_line_cache'))
+        instrumentation.reset()
+
+    def test_create_unique_files(self):
+        file_paths = self.file_creator.create_unique_files(10, "unique.txt", self.test_dir)
+        self.assertEqual(10, len(set(file_paths)))
+        self.file_creator.delete_all_created_files()
+        self.assertFalse(any(os.path.exists(file_path) for file_path in file_paths))
+
     def test_remove_files(self):
         base_file_name = "test_remove_files.txt"
         # Test multiple files
@@ -366,6 +2447,22 @@ class FileSysManipTests(unittest.TestCase):
         touch(file_path)
         remove_files([os.path.basename(file_path)], self.test_dir)
 
+    def test_remove_files_summary(self):
+        file_paths = reserve_unique_paths("test_remove_files_summary.txt", 600, self.test_dir)
+        sub_dir_path = os.path.join(self.test_dir, "sub_dir")
+        os.mkdir(sub_dir_path)
+        touch(os.path.join(sub_dir_path, "file.txt"))
+        missing_path = os.path.join(self.test_dir, "missing.txt")
+        for workers in (None, 4):
+            summary = remove_files(file_paths + [missing_path, sub_dir_path], workers=workers)
+            self.assertEqual(set(file_paths), set(summary.removed))
+            self.assertEqual([missing_path], summary.missing)
+            self.assertEqual([sub_dir_path], [path for path, error in summary.failed])
+            file_paths = reserve_unique_paths("test_remove_files_summary.txt", 600, self.test_dir)
+        summary = remove_files([sub_dir_path], remove_dirs=True)
+        self.assertEqual([sub_dir_path], summary.removed)
+        self.assertFalse(os.path.exists(sub_dir_path))
+
     def test_get_file_paths(self):
         deep_path = os.path.join(self.test_dir, "deep\\path")
         os.makedirs(deep_path)
@@ -390,6 +2487,38 @@ class FileSysManipTests(unittest.TestCase):
             expected = {os.path.join(self.test_dir, 'get_file_path_2.ext2')}
             self.assertTrue(found == expected)
 
+    def test_iter_file_paths(self):
+        os.makedirs(os.path.join(self.test_dir, 'keep', 'excluded', 'below'))
+        with FileCreator() as file_creator:
+            test_files = {
+                os.path.join('keep', 'a.txt'): "",
+                os.path.join('keep', 'b.log'): "",
+                os.path.join('keep', '.hidden'): "",
+                os.path.join('keep', 'excluded', 'c.txt'): "",
+                os.path.join('keep', 'excluded', 'below', 'd.txt'): "",
+            }
+            file_creator.create_files_from_dict(test_files, self.test_dir)
+            every_path = set(os.path.join(self.test_dir, file_path) for file_path in test_files)
+            for workers in (None, 4):
+                self.assertEqual(every_path, set(iter_file_paths(self.test_dir, workers=workers)))
+                # Excluded directories are pruned along with everything below them
+                found = get_file_paths(
+                    self.test_dir, excluded_dir_paths=os.path.join(self.test_dir, 'keep', 'excluded'), workers=workers)
+                self.assertEqual(
+                    {os.path.join(self.test_dir, 'keep', name) for name in ('a.txt', 'b.log', '.hidden')}, found)
+                found = get_file_paths(self.test_dir, exclude='excluded', workers=workers)
+                self.assertEqual(
+                    {os.path.join(self.test_dir, 'keep', name) for name in ('a.txt', 'b.log', '.hidden')}, found)
+                # Glob and regex rules
+                found = get_file_paths(self.test_dir, include='*.txt', exclude=re.compile(r'below'), workers=workers)
+                expected = {
+                    os.path.join(self.test_dir, 'keep', 'a.txt'),
+                    os.path.join(self.test_dir, 'keep', 'excluded', 'c.txt'),
+                }
+                self.assertEqual(expected, found)
+            self.assertEqual({os.path.join(self.test_dir, 'keep', 'b.log')}, get_file_paths(self.test_dir, {'log'}))
+            self.assertEqual(set(), get_file_paths(self.test_dir, {'hidden'}))
+
     def test_zip_dir(self):
         top_dir_path = os.path.join(self.test_dir, 'test_zip_dir')
         zip_file_path = top_dir_path + '.zip'
@@ -406,3 +2535,220 @@ class FileSysManipTests(unittest.TestCase):
         with zipfile.ZipFile(zip_file_path, 'r') as zfile:
             zipped_file_names = set([os.path.basename(file_path) for file_path in zfile.namelist()])
         self.assertTrue(set([os.path.basename(file_path) for file_path in files]) == zipped_file_names)
+
+    def test_zip_dir_parallel(self):
+        top_dir_path = os.path.join(self.test_dir, 'test_zip_dir_parallel')
+        os.makedirs(os.path.join(top_dir_path, 'deep'))
+        files = dict(
+            (os.path.join('deep' if i % 2 else '', 'zip_file_{}'.format(i)), 'contents {}\n'.format(i) * i)
+            for i in xrange(20))
+        self.file_creator.create_files_from_dict(files, top_dir_path)
+        serial_zip_path = top_dir_path + '_serial.zip'
+        parallel_zip_path = top_dir_path + '_parallel.zip'
+        zip_dir(top_dir_path, serial_zip_path)
+        zip_dir(top_dir_path, parallel_zip_path, workers=3)
+        with zipfile.ZipFile(serial_zip_path, 'r') as serial_zip:
+            with zipfile.ZipFile(parallel_zip_path, 'r') as parallel_zip:
+                self.assertIsNone(parallel_zip.testzip())
+                self.assertEqual(serial_zip.namelist(), parallel_zip.namelist())
+                for name in serial_zip.namelist():
+                    self.assertEqual(serial_zip.read(name), parallel_zip.read(name))
+
+    def test_compression_policy(self):
+        top_dir_path = os.path.join(self.test_dir, 'test_compression_policy')
+        random_data = os.urandom(ENTROPY_SAMPLE_SIZE * 2)
+        self.file_creator.materialize_tree({
+            'photo.JPG': 'not really a jpeg, ' * 1000,
+            'random.bin': random_data,
+            'text.txt': 'very compressible ' * 1000,
+            'server.log': 'very compressible ' * 1000,
+            'raw': {'data.txt': 'very compressible ' * 1000},
+        }, top_dir_path)
+        policy = CompressionPolicy([('*.log', 'deflate', 9), ('raw/*', 'stored', None)])
+        self.assertEqual(('*.log', zipfile.ZIP_DEFLATED, 9), policy.choose(os.path.join(top_dir_path, 'server.log')))
+        self.assertRaises(ValueError, lambda: CompressionPolicy([('*', 'brotli', None)]))
+        self.assertTrue(get_entropy(random_data) > DEFAULT_ENTROPY_THRESHOLD)
+        self.assertEqual(0, get_entropy('a' * 100))
+
+        members = [(os.path.join(top_dir_path, name), name) for name in
+                   ('photo.JPG', 'random.bin', 'text.txt', 'server.log', 'raw/data.txt')]
+        for workers in (None, 2):
+            for streaming in (False, True):
+                stream = StringIO.StringIO()
+                z = StreamingZipFile(stream) if streaming else zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED)
+                with z:
+                    report = write_files_to_zip(z, members, workers, policy)
+                with zipfile.ZipFile(stream, 'r') as z:
+                    self.assertIsNone(z.testzip())
+                    self.assertEqual({'photo.JPG': zipfile.ZIP_STORED, 'random.bin': zipfile.ZIP_STORED,
+                                      'text.txt': zipfile.ZIP_DEFLATED, 'server.log': zipfile.ZIP_DEFLATED,
+                                      'raw/data.txt': zipfile.ZIP_STORED},
+                                     dict((info.filename, info.compress_type) for info in z.infolist()))
+                    self.assertEqual(random_data, z.read('random.bin'))
+                stats = report.as_dict()
+                self.assertEqual({COMPRESSED_EXTENSION_RULE, HIGH_ENTROPY_RULE, DEFAULT_RULE, '*.log', 'raw/*'},
+                                 set(stats))
+                self.assertEqual(0, stats[HIGH_ENTROPY_RULE]['saved_bytes'])
+                self.assertTrue(stats[DEFAULT_RULE]['saved_bytes'] > 0)
+                self.assertEqual(sum(rule['saved_bytes'] for rule in stats.itervalues()), report.get_saved_bytes())
+
+    def test_file_line_cache(self):
+        file_path = os.path.join(self.test_dir, "test_file_line_cache.txt")
+        self.file_creator.create_files_from_dict({file_path: "Hurble\nDurble"})
+        cache = FileLineCache()
+        self.assertEqual(["Hurble\n", "Durble"], cache.get_lines(file_path))
+        self.assertEqual(["hurble\n", "durble"], cache.get_lines(file_path, lowered=True))
+        self.assertEqual({'hits': 1, 'misses': 1, 'evictions': 0, 'entries': 1, 'bytes': 26}, cache.get_stats())
+
+        # Changes to the file invalidate its entry
+        with open(file_path, 'w') as f:
+            f.write("Changed")
+        self.assertEqual(["Changed"], cache.get_lines(file_path))
+        self.assertEqual(2, cache.get_stats()['misses'])
+        self.assertEqual(["changed"], cache.get_lines(file_path, lowered=True))
+
+    def test_file_line_cache_eviction(self):
+        file_paths = [os.path.join(self.test_dir, "test_file_line_cache_{}.txt".format(i)) for i in xrange(3)]
+        self.file_creator.create_files_from_dict(dict((file_path, "0123456789") for file_path in file_paths))
+        cache = FileLineCache(max_bytes=25)
+        for file_path in file_paths:
+            cache.get_lines(file_path)
+        # The least recently used entry went first
+        stats = cache.get_stats()
+        self.assertEqual(1, stats['evictions'])
+        self.assertEqual(20, stats['bytes'])
+        cache.get_lines(file_paths[1])
+        self.assertEqual(1, cache.get_stats()['hits'])
+        cache.get_lines(file_paths[0])
+        self.assertEqual(2, cache.get_stats()['evictions'])
+
+    def test_zip_dir_to_stream(self):
+        top_dir_path = os.path.join(self.test_dir, 'test_zip_dir_to_stream')
+        os.makedirs(os.path.join(top_dir_path, 'deep'))
+        files = {os.path.join('deep', 'zip_file'): 'zipped ' * 100, 'top_zip_file': ''}
+        self.file_creator.create_files_from_dict(files, top_dir_path)
+        for workers in (None, 2):
+            # A pipe can't seek or tell, so check against a write-only wrapper
+            stream = StringIO.StringIO()
+            zip_dir_to_stream(top_dir_path, _WriteOnlyStream(stream), workers)
+            with zipfile.ZipFile(stream, 'r') as zfile:
+                self.assertIsNone(zfile.testzip())
+                self.assertEqual(
+                    [os.path.basename(file_path) for file_path, arcname in get_zip_dir_members(top_dir_path)],
+                    [os.path.basename(name) for name in zfile.namelist()])
+                for info in zfile.infolist():
+                    with open(os.sep + info.filename, 'rb') as f:
+                        self.assertEqual(f.read(), zfile.read(info))
+
+
+class _WriteOnlyStream(object):
+    def __init__(self, stream):
+        self.write = stream.write
+        self.flush = stream.flush
+
+
+def main(args):
+    """
+    Usage: file_sys_manip.py du [-w workers] [-n count] [--cache path] [--sort size|disk_usage|file_count] dir ...
+           file_sys_manip.py sync [-w workers] [--delete] [--checksum] [--dry-run] source_dir dest_dir
+
+    'du' prints the directories below the given ones using the most disk space (or holding the largest files, or the
+    most files) with their file counts, 10 of them unless '-n' says otherwise. Pass '--cache' followed by a database
+    path to reuse the listings of directories that haven't changed since the last run with the same cache.
+
+    'sync' makes dest_dir a mirror of source_dir, copying only new and changed files (see sync_tree). Pass '--delete'
+    to also delete what isn't in source_dir, '--checksum' to compare files by contents rather than modification time
+    and '--dry-run' to only print what would be done. The exit status is 1 if any file could not be synced.
+    """
+    commands = {'du': command_line_disk_usage, 'sync': command_line_sync}
+    if len(args) < 3 or args[1] not in commands:
+        print main.__doc__
+        exit(1)
+    try:
+        if not commands[args[1]](args[2:]):
+            exit(1)
+    except (ValueError, DirectoryError) as e:
+        print e.message
+        print main.__doc__
+        exit(1)
+
+
+def command_line_disk_usage(args):
+    dir_paths = []
+    workers = None
+    count = 10
+    cache_path = None
+    key = 'disk_usage'
+    index = 0
+    try:
+        while index < len(args):
+            arg = args[index]
+            if arg == '-w':
+                workers = int(args[index + 1])
+                index += 1
+            elif arg == '-n':
+                count = int(args[index + 1])
+                index += 1
+            elif arg == '--cache':
+                cache_path = args[index + 1]
+                index += 1
+            elif arg == '--sort':
+                key = args[index + 1]
+                if key not in ('size', 'disk_usage', 'file_count'):
+                    raise ValueError(key)
+                index += 1
+            else:
+                dir_paths.append(arg)
+            index += 1
+    except (IndexError, ValueError):
+        raise ValueError("Invalid value after '{}'".format(args[index]))
+    for dir_path in dir_paths:
+        if not os.path.isdir(dir_path):
+            raise ValueError("{} is not a directory".format(dir_path))
+    usages = get_disk_usage(set(dir_paths), workers=workers, cache_path=cache_path)
+    print "{:>14} {:>14} {:>10}  {}".format('disk usage', 'size', 'files', 'directory')
+    for usage in get_largest_dirs(usages, count, key):
+        print "{:>14,} {:>14,} {:>10,}  {}".format(usage.disk_usage, usage.size, usage.file_count, usage.path)
+    return True
+
+
+def command_line_sync(args):
+    dir_paths = []
+    workers = None
+    options = {'--delete': False, '--checksum': False, '--dry-run': False}
+    index = 0
+    while index < len(args):
+        arg = args[index]
+        if arg == '-w':
+            try:
+                workers = int(args[index + 1])
+            except (IndexError, ValueError):
+                raise ValueError("Invalid value after '{}'".format(arg))
+            index += 1
+        elif arg in options:
+            options[arg] = True
+        else:
+            dir_paths.append(arg)
+        index += 1
+    if len(dir_paths) != 2:
+        raise ValueError("Expected a source and a destination directory")
+    report = sync_tree(dir_paths[0], dir_paths[1], options['--delete'], options['--checksum'], options['--dry-run'],
+                       workers)
+    if report.dry_run:
+        for path in report.deleted:
+            print "delete {}".format(path)
+        for path in report.created_dirs:
+            print "create {}".format(path)
+        for path in report.copied:
+            print "copy {}".format(path)
+    for path, error in report.failed:
+        print "failed {}: {}".format(path, error)
+    print "{} {} files ({:,} bytes, {:.1f} MB/s), deleted {}, created {} directories, {} unchanged, {} failed".format(
+        "Would copy" if report.dry_run else "Copied", len(report.copied), report.bytes_copied,
+        report.get_throughput() / (1024 * 1024), len(report.deleted), len(report.created_dirs), report.unchanged,
+        len(report.failed))
+    return not report.failed
+
+
+if __name__ == '__main__':
+    main(sys.argv)
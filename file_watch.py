@@ -0,0 +1,339 @@
+"""
+Watches a directory tree for changes. On Linux the kernel reports changes through inotify (used via ctypes, so no
+extra package is needed); elsewhere, or when the tree needs more watches than allowed, the tree is polled instead.
+Either way a watcher's read method returns the set of paths that were touched, where a directory path means anything
+below it may have changed.
+"""
+
+import unittest
+import os
+import sys
+import shutil
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import file_sys_manip
+
+
+# inotify event flags, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+_EVENT_HEADER = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+
+# Most directories a single InotifyWatcher will watch; each watch costs kernel memory and an entry in the watcher
+DEFAULT_MAX_WATCHES = 65536
+DEFAULT_POLL_INTERVAL = 2.0
+
+_libc = None
+if sys.platform.startswith('linux'):
+    try:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        _libc.inotify_init1
+    except (OSError, AttributeError):
+        _libc = None
+
+
+def is_inotify_available():
+    """
+    Returns True if the kernel's inotify interface can be used, False otherwise
+    """
+    return _libc is not None
+
+
+def create_watcher(root_dir_path, max_watches=DEFAULT_MAX_WATCHES, poll_interval=DEFAULT_POLL_INTERVAL):
+    """
+    Returns an InotifyWatcher of the given tree where possible, a PollingWatcher otherwise
+    :type root_dir_path: str
+    :param root_dir_path: path of the root directory of the tree to watch
+    :type max_watches: int
+    :param max_watches: most directories to watch with inotify, larger trees are polled
+    :type poll_interval: float
+    :param poll_interval: seconds between scans when polling
+    """
+    if is_inotify_available():
+        try:
+            return InotifyWatcher(root_dir_path, max_watches)
+        except WatchLimitExceeded:
+            pass
+        except OSError as e:
+            if e.errno not in (errno.ENOSPC, errno.EMFILE, errno.ENOSYS):
+                raise
+    return PollingWatcher(root_dir_path, poll_interval)
+
+
+class WatchLimitExceeded(Exception):
+    pass
+
+
+class InotifyWatcher(object):
+    """
+    Watches every directory of a tree with inotify. Only a { watch descriptor: directory path } map is kept, so memory
+    grows with the number of directories, up to max_watches, rather than with the number of files.
+    """
+
+    def __init__(self, root_dir_path, max_watches=DEFAULT_MAX_WATCHES):
+        if not os.path.isdir(root_dir_path):
+            raise file_sys_manip.DirectoryError("{} is not a directory".format(root_dir_path))
+        self.root_dir_path = os.path.abspath(root_dir_path)
+        self.max_watches = max_watches
+        # Set once the tree has grown past max_watches, from then on the watcher misses changes and must be replaced
+        self.exhausted = False
+        self._watches = {}
+        # { cookie: path } of the directories moved away, until the matching IN_MOVED_TO shows where they went
+        self._moved_from = {}
+        self._fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        try:
+            self._add_watches(self.root_dir_path)
+        except:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def get_watch_count(self):
+        return len(self._watches)
+
+    def _add_watches(self, dir_path):
+        for root, dirs, file_names in os.walk(dir_path):
+            if len(self._watches) >= self.max_watches:
+                raise WatchLimitExceeded("{} has more than {} directories".format(self.root_dir_path, self.max_watches))
+            wd = _libc.inotify_add_watch(self._fd, root, WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error in (errno.ENOENT, errno.ENOTDIR):
+                    # Removed while we were walking
+                    continue
+                raise OSError(error, "{}: {}".format(os.strerror(error), root))
+            self._watches[wd] = root
+
+    def read(self, timeout=None):
+        """
+        Waits for changes and returns the paths they touched
+        :type timeout: float
+        :param timeout: most seconds to wait, None waits until something changes
+        :rtype set
+        :return: set of touched file and directory paths, empty if nothing changed before the timeout
+        """
+        touched = set()
+        try:
+            readable = select.select([self._fd], [], [], timeout)[0]
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return touched
+            raise
+        if not readable:
+            return touched
+        while True:
+            try:
+                data = os.read(self._fd, READ_SIZE)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+            if not data:
+                break
+            self._handle_events(data, touched)
+        # Directories moved away without a matching IN_MOVED_TO left the tree, their watches would report changes at
+        # paths which no longer exist
+        for dir_path in self._moved_from.itervalues():
+            self._remove_watches(dir_path)
+        self._moved_from = {}
+        return touched
+
+    def _handle_events(self, data, touched):
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped, so anything may have changed
+                touched.add(self.root_dir_path)
+                continue
+            dir_path = self._watches.get(wd)
+            if dir_path is None:
+                continue
+            if mask & IN_IGNORED:
+                del self._watches[wd]
+                continue
+            path = os.path.join(dir_path, name) if name else dir_path
+            touched.add(path)
+            if mask & IN_MOVE_SELF and dir_path == self.root_dir_path:
+                # The watched tree itself was moved, the paths of everything in it are no longer valid
+                self.exhausted = True
+            if not mask & IN_ISDIR:
+                continue
+            if mask & IN_MOVED_FROM:
+                self._moved_from[cookie] = path
+            elif mask & IN_MOVED_TO and cookie in self._moved_from:
+                # Watches follow the directories, only the paths they stand for changed
+                self._rename_watches(self._moved_from.pop(cookie), path)
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                try:
+                    self._add_watches(path)
+                except WatchLimitExceeded:
+                    self.exhausted = True
+
+    def _rename_watches(self, old_dir_path, new_dir_path):
+        """
+        Updates the paths of the watches of a directory moved within the tree and of everything below it
+        """
+        prefix = os.path.join(old_dir_path, '')
+        for wd, dir_path in self._watches.items():
+            if dir_path == old_dir_path or dir_path.startswith(prefix):
+                self._watches[wd] = new_dir_path + dir_path[len(old_dir_path):]
+
+    def _remove_watches(self, old_dir_path):
+        """
+        Stops watching a directory which left the tree and everything below it
+        """
+        prefix = os.path.join(old_dir_path, '')
+        for wd, dir_path in self._watches.items():
+            if dir_path == old_dir_path or dir_path.startswith(prefix):
+                _libc.inotify_rm_watch(self._fd, wd)
+                del self._watches[wd]
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+        self._watches = {}
+        self._moved_from = {}
+
+
+class PollingWatcher(object):
+    """
+    Watches a tree by periodically comparing the size and modification time of every file against the previous scan
+    """
+
+    def __init__(self, root_dir_path, interval=DEFAULT_POLL_INTERVAL):
+        if not os.path.isdir(root_dir_path):
+            raise file_sys_manip.DirectoryError("{} is not a directory".format(root_dir_path))
+        self.root_dir_path = os.path.abspath(root_dir_path)
+        self.interval = interval
+        self.exhausted = False
+        self._last_scan_time = time.time()
+        self._snapshot = self._scan()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _scan(self):
+        snapshot = {}
+        for file_path in file_sys_manip.iter_file_paths(self.root_dir_path):
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue
+            snapshot[file_path] = (stat.st_size, stat.st_mtime)
+        return snapshot
+
+    def read(self, timeout=None):
+        """
+        Waits for the next scan (at most timeout seconds) and returns the paths of the files that changed since the
+        previous one, see InotifyWatcher.read
+        """
+        wait = max(0, self._last_scan_time + self.interval - time.time())
+        if timeout is not None and timeout < wait:
+            time.sleep(timeout)
+            return set()
+        time.sleep(wait)
+        self._last_scan_time = time.time()
+        snapshot = self._scan()
+        touched = set(path for path, entry in snapshot.iteritems() if self._snapshot.get(path) != entry)
+        touched.update(path for path in self._snapshot if path not in snapshot)
+        self._snapshot = snapshot
+        return touched
+
+    def close(self):
+        self._snapshot = {}
+
+
+#--------------------
+# Tests
+#--------------------
+class FileWatchTests(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = os.path.abspath(file_sys_manip.generate_unique_path("test_dir"))
+        os.mkdir(self.test_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_polling_watcher(self):
+        file_path = os.path.join(self.test_dir, 'file.txt')
+        file_sys_manip.touch(file_path)
+        with PollingWatcher(self.test_dir, 0) as watcher:
+            self.assertEqual(set(), watcher.read())
+            with open(file_path, 'w') as f:
+                f.write('changed')
+            self.assertEqual({file_path}, watcher.read())
+            os.remove(file_path)
+            self.assertEqual({file_path}, watcher.read())
+
+    @unittest.skipIf(not is_inotify_available(), "inotify is not available")
+    def test_inotify_watcher(self):
+        with InotifyWatcher(self.test_dir) as watcher:
+            self.assertEqual(set(), watcher.read(0))
+            sub_dir_path = os.path.join(self.test_dir, 'sub_dir')
+            os.mkdir(sub_dir_path)
+            self.assertEqual({sub_dir_path}, watcher.read(1))
+            # New directories are watched as they appear
+            self.assertEqual(2, watcher.get_watch_count())
+            file_path = os.path.join(sub_dir_path, 'file.txt')
+            with open(file_path, 'w') as f:
+                f.write('created')
+            self.assertEqual({file_path}, watcher.read(1))
+
+            # Moving a directory within the tree keeps its watches, under the new paths
+            os.mkdir(os.path.join(sub_dir_path, 'nested'))
+            watcher.read(1)
+            moved_dir_path = os.path.join(self.test_dir, 'moved')
+            os.rename(sub_dir_path, moved_dir_path)
+            self.assertEqual({sub_dir_path, moved_dir_path}, watcher.read(1))
+            self.assertEqual(3, watcher.get_watch_count())
+            file_path = os.path.join(moved_dir_path, 'nested', 'file.txt')
+            file_sys_manip.touch(file_path)
+            self.assertEqual({file_path}, watcher.read(1))
+            # Moving it out of the tree drops them
+            outside_dir_path = self.test_dir + '_outside'
+            os.rename(moved_dir_path, outside_dir_path)
+            try:
+                self.assertEqual({moved_dir_path}, watcher.read(1))
+                self.assertEqual(1, watcher.get_watch_count())
+                file_sys_manip.touch(os.path.join(outside_dir_path, 'file.txt'))
+                self.assertEqual(set(), watcher.read(0.1))
+            finally:
+                shutil.rmtree(outside_dir_path)
+            os.mkdir(sub_dir_path)
+        self.assertRaises(WatchLimitExceeded, lambda: InotifyWatcher(self.test_dir, max_watches=1))
+        self.assertTrue(isinstance(create_watcher(self.test_dir, max_watches=1), PollingWatcher))
@@ -3,6 +3,8 @@ __author__ = 'trollinger'
 import unittest
 import util
 import shutil
+import StringIO
+import datetime
 import file_sys_manip
 from backup import *
 
@@ -27,11 +29,53 @@ class BackupTests(unittest.TestCase):
             ArgumentException,
             lambda: command_line_backup(['file_name', '-o', 'output_file'])
         )
+        # Missing number of workers
+        self.assertRaises(
+            ArgumentException,
+            lambda: command_line_backup(['file_name', '-i', self.test_dir_path, '-w'])
+        )
         # Normal usage
         output_dir_path = os.path.dirname(self.test_dir_path)
         output_file_path = command_line_backup(['file_name', '-i', self.test_dir_path, '-o', output_dir_path])
         self.assertTrue(os.path.isfile(output_file_path))
-        os.remove(output_file_path)
+        remove_backup(output_file_path)
+        # Chunk store
+        self.file_creator.create_files_from_dict({'a.txt': 'a'}, self.test_dir_path)
+        store_path = file_sys_manip.generate_unique_path("test_store")
+        snapshot_path = command_line_backup(['file_name', '-i', self.test_dir_path, '-o', store_path, '-s'])
+        self.assertTrue(os.path.isfile(snapshot_path))
+        self.assertTrue(chunk_store.is_store(store_path))
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            command_line_backup(['file_name', '-i', self.test_dir_path, '-o', store_path, '-s', '--keep-last', '1'])
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertTrue("Pruned 1 old backups." in output)
+        # Listing and restoring the store's snapshots
+        restore_dir_path = os.path.join(self.test_dir_path, 'restored')
+        sys.stdout = StringIO.StringIO()
+        try:
+            snapshot_names = command_line_list([LIST_COMMAND, store_path])
+            self.assertEqual(1, len(snapshot_names))
+            self.assertTrue(snapshot_names[0] in sys.stdout.getvalue())
+            command_line_restore([RESTORE_COMMAND, store_path, snapshot_names[0], restore_dir_path])
+            self.assertRaises(ArgumentException,
+                              lambda: command_line_restore([RESTORE_COMMAND, store_path, 'missing', restore_dir_path]))
+            self.assertRaises(ArgumentException,
+                              lambda: command_line_restore([RESTORE_COMMAND, store_path, restore_dir_path]))
+        finally:
+            sys.stdout = stdout
+        with open(os.path.join(restore_dir_path, 'a.txt'), 'r') as f:
+            self.assertEqual('a', f.read())
+        self.assertRaises(ArgumentException, lambda: command_line_list([LIST_COMMAND, self.test_dir_path]))
+        shutil.rmtree(store_path)
+        # Parallel compression
+        output_file_path = command_line_backup(
+            ['file_name', '-i', self.test_dir_path, '-o', output_dir_path, '-w', '2'])
+        self.assertTrue(os.path.isfile(output_file_path))
+        remove_backup(output_file_path)
 
     def test_backup(self):
         output_dir_path = self.test_dir_path
@@ -48,10 +92,334 @@ class BackupTests(unittest.TestCase):
         # Backup a directory
         backup_file_path = backup(self.test_dir_path, output_dir_path)
         self.assertTrue(os.path.exists(backup_file_path))
-        os.remove(backup_file_path)
+        remove_backup(backup_file_path)
         # Backup a file
         file_path = file_sys_manip.generate_unique_path(os.path.join(self.test_dir_path, "will_be_backed_up"))
         file_sys_manip.touch(file_path)
         backup_file_path = backup(file_path, output_dir_path)
         self.assertTrue(os.path.exists(backup_file_path))
-        os.remove(backup_file_path)
+        remove_backup(backup_file_path)
+
+    def test_incremental_backup(self):
+        input_dir_path = os.path.join(self.test_dir_path, 'input')
+        output_dir_path = os.path.join(self.test_dir_path, 'output')
+        os.makedirs(os.path.join(input_dir_path, 'sub'))
+        os.mkdir(output_dir_path)
+        self.file_creator.create_files_from_dict({
+            'unchanged.txt': 'unchanged',
+            'changed.txt': 'original',
+            os.path.join('sub', 'deleted.txt'): 'deleted',
+        }, input_dir_path)
+        # The first incremental backup contains every file
+        base_path = backup(input_dir_path, output_dir_path, incremental=True)
+        with zipfile.ZipFile(base_path, 'r') as z:
+            self.assertEqual(
+                {'unchanged.txt', 'changed.txt', 'sub/deleted.txt', INCREMENT_MEMBER_NAME},
+                set(z.namelist()))
+
+        with open(os.path.join(input_dir_path, 'changed.txt'), 'w') as f:
+            f.write('changed contents')
+        os.remove(os.path.join(input_dir_path, 'sub', 'deleted.txt'))
+        with open(os.path.join(input_dir_path, 'sub', 'added.txt'), 'w') as f:
+            f.write('added')
+        # Later ones only contain what changed
+        increment_path = backup(input_dir_path, output_dir_path, incremental=True)
+        with zipfile.ZipFile(increment_path, 'r') as z:
+            self.assertEqual({'changed.txt', 'sub/added.txt', INCREMENT_MEMBER_NAME}, set(z.namelist()))
+        self.assertEqual([base_path, increment_path], get_increment_chain(increment_path))
+
+        # Restoring the increment rebuilds the whole snapshot
+        restore_dir_path = os.path.join(self.test_dir_path, 'restored')
+        restore(increment_path, restore_dir_path)
+        restored = {}
+        for root, dirs, files in os.walk(restore_dir_path):
+            for f in files:
+                with open(os.path.join(root, f), 'r') as restored_file:
+                    restored[os.path.relpath(os.path.join(root, f), restore_dir_path)] = restored_file.read()
+        self.assertEqual({
+            'unchanged.txt': 'unchanged',
+            'changed.txt': 'changed contents',
+            os.path.join('sub', 'added.txt'): 'added',
+        }, restored)
+
+    def test_restore(self):
+        input_dir_path = os.path.join(self.test_dir_path, 'input')
+        output_dir_path = os.path.join(self.test_dir_path, 'output')
+        restore_dir_path = os.path.join(self.test_dir_path, 'restored')
+        os.mkdir(output_dir_path)
+        self.file_creator.materialize_tree({
+            'a.txt': 'a', 'b.log': 'b', 'sub': {'c.txt': 'c', 'deleted.txt': 'deleted'}}, input_dir_path)
+        os.chmod(os.path.join(input_dir_path, 'a.txt'), 0o600)
+        os.utime(os.path.join(input_dir_path, 'a.txt'), (1000000000, 1000000000))
+        base_path = backup(input_dir_path, output_dir_path, incremental=True)
+        with open(os.path.join(input_dir_path, 'sub', 'c.txt'), 'w') as f:
+            f.write('c changed')
+        os.remove(os.path.join(input_dir_path, 'sub', 'deleted.txt'))
+        increment_path = backup(input_dir_path, output_dir_path, incremental=True)
+
+        stats = restore(base_path, restore_dir_path, include=['*.txt'])
+        self.assertEqual({'restored': 3, 'skipped': 0, 'deleted': 0}, stats)
+        self.assertFalse(os.path.exists(os.path.join(restore_dir_path, 'b.log')))
+        a_path = os.path.join(restore_dir_path, 'a.txt')
+        self.assertEqual(0o600, os.stat(a_path).st_mode & 0o7777)
+        self.assertTrue(abs(os.path.getmtime(a_path) - 1000000000) < 2)
+
+        stats = restore(increment_path, restore_dir_path, workers=2, skip_identical='mtime')
+        self.assertEqual({'restored': 2, 'skipped': 1, 'deleted': 1}, stats)
+        with open(os.path.join(restore_dir_path, 'sub', 'c.txt'), 'r') as f:
+            self.assertEqual('c changed', f.read())
+        self.assertEqual(['c.txt'], os.listdir(os.path.join(restore_dir_path, 'sub')))
+        stats = restore(increment_path, restore_dir_path, skip_identical='crc')
+        self.assertEqual({'restored': 0, 'skipped': 3, 'deleted': 0}, stats)
+
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            stats = command_line_restore([RESTORE_COMMAND, '-w', '2', '--include', 'sub/*', increment_path,
+                                          os.path.join(self.test_dir_path, 'restored_sub')])
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(1, stats['restored'])
+        self.assertRaises(ArgumentException, lambda: command_line_restore([RESTORE_COMMAND, increment_path]))
+
+    def test_watch_backup(self):
+        input_dir_path = os.path.join(self.test_dir_path, 'input')
+        output_dir_path = os.path.join(self.test_dir_path, 'output')
+        os.mkdir(output_dir_path)
+        self.file_creator.materialize_tree({'a.txt': 'a', 'sub': {'b.txt': 'b', 'c.txt': 'c'}}, input_dir_path)
+        base_path = incremental_backup(input_dir_path, output_dir_path)
+        watcher = file_watch.PollingWatcher(input_dir_path, 0)
+        with open(os.path.join(input_dir_path, 'a.txt'), 'w') as f:
+            f.write('a changed')
+        shutil.rmtree(os.path.join(input_dir_path, 'sub'))
+        backup_paths = []
+        metrics = watch_backup(input_dir_path, output_dir_path, debounce=0, watcher=watcher,
+                               on_batch=lambda backup_path, metrics: backup_paths.append(backup_path), max_batches=1)
+        watcher.close()
+        self.assertEqual(1, metrics.batches)
+        self.assertEqual(3, metrics.max_queue_depth)
+        with zipfile.ZipFile(backup_paths[0], 'r') as z:
+            self.assertEqual({'a.txt', INCREMENT_MEMBER_NAME}, set(z.namelist()))
+            self.assertEqual(['sub/b.txt', 'sub/c.txt'], json.loads(z.read(INCREMENT_MEMBER_NAME))['deleted'])
+        self.assertEqual([base_path, backup_paths[0]], get_increment_chain(backup_paths[0]))
+        # Touched paths which did not really change don't produce an archive
+        self.assertEqual(None, incremental_backup(
+            input_dir_path, output_dir_path, changed_paths=[os.path.join(input_dir_path, 'a.txt')]))
+
+        # A watcher which overflows before reporting anything makes the whole tree be rescanned
+        class ExhaustedWatcher(object):
+            exhausted = True
+
+            def read(self, timeout=None):
+                return []
+
+            def close(self):
+                pass
+        with open(os.path.join(input_dir_path, 'a.txt'), 'w') as f:
+            f.write('a changed again')
+        backup_paths = []
+        metrics = watch_backup(input_dir_path, output_dir_path, debounce=0, watcher=ExhaustedWatcher(),
+                               on_batch=lambda backup_path, metrics: backup_paths.append(backup_path), max_batches=1)
+        self.assertEqual(1, metrics.batches)
+        with zipfile.ZipFile(backup_paths[0], 'r') as z:
+            self.assertEqual('a changed again', z.read('a.txt'))
+
+    def test_backup_compression_policy(self):
+        input_dir_path = os.path.join(self.test_dir_path, 'input')
+        output_dir_path = os.path.join(self.test_dir_path, 'output')
+        os.mkdir(output_dir_path)
+        self.file_creator.materialize_tree({'a.log': 'log line\n' * 100, 'b.txt': 'text\n' * 100}, input_dir_path)
+        instrumentation.enable()
+        try:
+            output_file_path = command_line_backup(['file_name', '-i', input_dir_path, '-o', output_dir_path,
+                                                    '--incremental', '--compress', '*.log=stored'])
+            counters = instrumentation.get_stats().counters
+        finally:
+            instrumentation.disable()
+            instrumentation.reset()
+        with zipfile.ZipFile(output_file_path, 'r') as z:
+            self.assertEqual(zipfile.ZIP_STORED, z.getinfo('a.log').compress_type)
+            self.assertEqual(zipfile.ZIP_DEFLATED, z.getinfo('b.txt').compress_type)
+        self.assertEqual(0, counters['saved_bytes:*.log'])
+        self.assertTrue(counters['saved_bytes:' + file_sys_manip.DEFAULT_RULE] > 0)
+        for compress_args in (['--compress'], ['--compress', '*.log'], ['--compress', '*.log=zip'],
+                              ['--compress', '*.log=deflate:x'], ['--compress', '*.log=stored', '-s']):
+            self.assertRaises(ArgumentException, lambda: command_line_backup(
+                ['file_name', '-i', input_dir_path, '-o', output_dir_path] + compress_args))
+
+    def test_incremental_backup_change_cache(self):
+        input_dir_path = os.path.join(self.test_dir_path, 'input')
+        output_dir_path = os.path.join(self.test_dir_path, 'output')
+        os.mkdir(output_dir_path)
+        self.file_creator.materialize_tree(
+            {'touched.txt': 'touched', 'deleted.txt': 'deleted', 'sub': {'changed.txt': 'original'}}, input_dir_path)
+        # The tree's own cache, as left by e.g. file_search, is never archived
+        with change_cache.ChangeCache(input_dir_path) as cache:
+            cache.update()
+            cache.save()
+        tree_members = {'touched.txt', 'deleted.txt', 'sub/changed.txt'}
+        # Full backups name their members after the absolute paths of the files
+        member_prefix = os.path.abspath(input_dir_path).lstrip(os.sep).replace(os.sep, '/') + '/'
+        with zipfile.ZipFile(backup(input_dir_path, output_dir_path), 'r') as z:
+            self.assertEqual(set(member_prefix + name for name in tree_members), set(z.namelist()))
+        with tarfile.open(backup(input_dir_path, output_dir_path, container='tar'), 'r') as tar:
+            self.assertEqual(set(member_prefix + name for name in tree_members),
+                             set(member.name for member in tar.getmembers() if member.isfile()))
+        store_path = os.path.join(self.test_dir_path, 'store')
+        backup(input_dir_path, store_path, store=True)
+        snapshot_name = chunk_store.list_snapshots(store_path)[-1]
+        self.assertEqual(tree_members, set(chunk_store.read_snapshot(store_path, snapshot_name)['files']))
+
+        base_path = backup(input_dir_path, output_dir_path, incremental=True)
+        with zipfile.ZipFile(base_path, 'r') as z:
+            self.assertEqual(tree_members | {INCREMENT_MEMBER_NAME}, set(z.namelist()))
+        self.assertTrue(os.path.isfile(get_change_cache_path(input_dir_path, output_dir_path)))
+
+        touched_path = os.path.join(input_dir_path, 'touched.txt')
+        os.utime(touched_path, (os.path.getatime(touched_path), os.path.getmtime(touched_path) + 10))
+        os.remove(os.path.join(input_dir_path, 'deleted.txt'))
+        with open(os.path.join(input_dir_path, 'sub', 'changed.txt'), 'w') as f:
+            f.write('changed contents')
+        increment_path = backup(input_dir_path, output_dir_path, incremental=True)
+        with zipfile.ZipFile(increment_path, 'r') as z:
+            # A file whose modification time changed but whose contents did not is not archived again
+            self.assertEqual({'sub/changed.txt', INCREMENT_MEMBER_NAME}, set(z.namelist()))
+            self.assertEqual(['deleted.txt'], json.loads(z.read(INCREMENT_MEMBER_NAME))['deleted'])
+        self.assertEqual([base_path, increment_path], get_increment_chain(increment_path))
+
+    def test_verify(self):
+        input_dir_path = os.path.join(self.test_dir_path, 'input')
+        output_dir_path = os.path.join(self.test_dir_path, 'output')
+        os.mkdir(output_dir_path)
+        self.file_creator.materialize_tree({'a.txt': 'a', 'sub': {'b.txt': 'b' * 1000}}, input_dir_path)
+        self.assertIsNone(read_checksums(backup(input_dir_path, output_dir_path)))
+        archive_paths = [backup(input_dir_path, output_dir_path, checksums=True),
+                         backup(input_dir_path, output_dir_path, container='tar.gz', checksums=True)]
+        for archive_path in archive_paths:
+            self.assertTrue(os.path.isfile(get_checksums_path(archive_path)))
+            self.assertEqual(2, len(read_checksums(archive_path)['members']))
+        for workers in (None, 2):
+            results = verify(archive_paths, workers)
+            self.assertFalse(any(any(problems.itervalues()) for problems in results.itervalues()))
+
+        # Replace the zip's contents behind its manifest's back
+        zip_path = archive_paths[0]
+        with zipfile.ZipFile(zip_path, 'r') as z:
+            names = sorted(z.namelist())
+        with zipfile.ZipFile(zip_path, 'w') as z:
+            z.writestr(names[0], 'tampered')
+            z.writestr('extra.txt', 'extra')
+        problems = verify([zip_path])[zip_path]
+        self.assertEqual([names[0]], problems['mismatched'])
+        self.assertEqual([names[1]], problems['missing'])
+        self.assertEqual(['extra.txt'], problems['unexpected'])
+
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            self.assertFalse(command_line_verify([VERIFY_COMMAND, '-w', '2'] + archive_paths))
+            self.assertTrue(command_line_verify([VERIFY_COMMAND, archive_paths[1]]))
+        finally:
+            sys.stdout = stdout
+        self.assertRaises(ArgumentException, lambda: command_line_verify([VERIFY_COMMAND]))
+
+    def test_parse_backup_file_name(self):
+        created = datetime.datetime(2016, 3, 4, 5, 6, 7)
+        self.assertEqual(('src', created, 'zip'), parse_backup_file_name('src_2016_03_04_05_06_07.zip'))
+        # Unpadded names of older backups, and uniqueness suffixes
+        self.assertEqual(('my_src', created, 'zip'), parse_backup_file_name('my_src_2016_3_4_5_6_7_2.zip'))
+        self.assertEqual(('src', created, 'tar.gz'), parse_backup_file_name('src_2016_03_04_05_06_07.tar_1.gz'))
+        self.assertEqual(None, parse_backup_file_name('src_2016_03_04_05_06_07.zip' + CHECKSUMS_EXTENSION))
+        self.assertEqual(None, parse_backup_file_name('src' + MANIFEST_EXTENSION))
+        output_file_path = get_output_file_path('/some/src', self.test_dir_path)
+        self.assertEqual('src', parse_backup_file_name(os.path.basename(output_file_path))[0])
+        self.assertEqual(len('src_YYYY_MM_DD_hh_mm_ss.zip'), len(os.path.basename(output_file_path)))
+
+    def test_select_backups_to_prune(self):
+        entries = [CatalogEntry('b{}_{}'.format(day, hour), 'src', datetime.datetime(2016, 1, day, hour), None)
+                   for day in xrange(1, 32) for hour in (1, 2)]
+        to_prune = select_backups_to_prune(entries, keep_last=3)
+        self.assertEqual(len(entries) - 3, len(to_prune))
+        self.assertEqual(entries[0], to_prune[0])
+        kept = set(entries) - set(select_backups_to_prune(entries, keep_daily=7, keep_weekly=2, keep_monthly=1))
+        # The newest backup of each of the last 7 days, plus that of the previous ISO week
+        self.assertEqual(8, len(kept))
+        self.assertTrue(all(entry.created.hour == 2 for entry in kept))
+        # Parents of kept incremental backups are kept
+        chain = [CatalogEntry('base', 'src', datetime.datetime(2015, 1, 1), None),
+                 CatalogEntry('increment', 'src', datetime.datetime(2015, 1, 2), 'base'),
+                 CatalogEntry('latest', 'src', datetime.datetime(2015, 1, 3), 'increment'),
+                 CatalogEntry('unrelated', 'src', datetime.datetime(2014, 1, 1), None)]
+        self.assertEqual([chain[3]], select_backups_to_prune(chain, keep_last=1))
+
+    def test_prune_backups(self):
+        output_dir_path = os.path.join(self.test_dir_path, 'output')
+        os.mkdir(output_dir_path)
+        file_names = ['src_2016_1_{}_0_0_0.zip'.format(day) for day in xrange(1, 10)] + \
+                     ['other_2016_01_{:02}_00_00_00.zip'.format(day) for day in xrange(1, 10)] + ['unrelated.txt']
+        for file_name in file_names:
+            file_sys_manip.touch(os.path.join(output_dir_path, file_name))
+        self.assertEqual(12, len(prune_backups(output_dir_path, keep_last=2, keep_daily=3, dry_run=True)))
+        pruned = prune_backups(output_dir_path, keep_last=2, source='src')
+        self.assertEqual(7, len(pruned))
+        self.assertFalse(any(os.path.exists(path) for path in pruned))
+        with BackupCatalog(output_dir_path) as catalog:
+            self.assertEqual(['src_2016_1_8_0_0_0.zip', 'src_2016_1_9_0_0_0.zip'],
+                             [entry.file_name for entry in catalog.list_backups('src')])
+        self.assertEqual(9 + 2 + 1 + 1, len(os.listdir(output_dir_path)))
+
+        # Backups written later are added to the catalog, and pruned from the command line
+        input_dir_path = os.path.join(self.test_dir_path, 'src')
+        os.mkdir(input_dir_path)
+        file_sys_manip.touch(os.path.join(input_dir_path, 'file.txt'))
+        output_file_path = command_line_backup(
+            ['file_name', '-i', input_dir_path, '-o', output_dir_path, '--keep-monthly', '1'])
+        with BackupCatalog(output_dir_path) as catalog:
+            self.assertEqual([os.path.basename(output_file_path)],
+                             [entry.file_name for entry in catalog.list_backups('src')])
+            self.assertEqual(9, len(catalog.list_backups('other')))
+
+        # Adding a backup doesn't list the directory, nor hide what changed behind the catalog's back before it
+        file_sys_manip.touch(os.path.join(output_dir_path, 'other_2017_01_01_00_00_00.zip'))
+        output_file_path = backup(input_dir_path, output_dir_path)
+        with BackupCatalog(output_dir_path, sync=False) as catalog:
+            self.assertEqual(9, len(catalog.list_backups('other')))
+            self.assertEqual(2, len(catalog.list_backups('src')))
+            catalog.sync()
+            self.assertEqual(10, len(catalog.list_backups('other')))
+
+    def test_backup_to_stream(self):
+        self.file_creator.create_files_from_dict({'streamed.txt': 'streamed contents'}, self.test_dir_path)
+        file_path = os.path.join(self.test_dir_path, 'streamed.txt')
+        stream = StringIO.StringIO()
+        backup_to_stream(self.test_dir_path, stream)
+        with zipfile.ZipFile(stream, 'r') as z:
+            self.assertEqual('streamed contents', z.read(z.namelist()[0]))
+        for container in ('tar', 'tar.gz', 'tar.bz2'):
+            stream = StringIO.StringIO()
+            backup_to_stream(self.test_dir_path, stream, container)
+            stream.seek(0)
+            with tarfile.open(fileobj=stream, mode='r:*') as tar:
+                self.assertEqual('streamed contents', tar.extractfile(file_path.lstrip('/')).read())
+        self.assertRaises(ArgumentException, lambda: backup_to_stream(self.test_dir_path, stream, 'rar'))
+
+        # Containers can be written to files too
+        backup_file_path = backup(self.test_dir_path, os.path.dirname(self.test_dir_path), container='tar.gz')
+        self.assertTrue(backup_file_path.endswith('.tar.gz'))
+        self.assertTrue(tarfile.is_tarfile(backup_file_path))
+        remove_backup(backup_file_path)
+
+    def test_command_line_backup_to_stdout(self):
+        self.file_creator.create_files_from_dict({'streamed.txt': 'streamed contents'}, self.test_dir_path)
+        stdout = sys.stdout
+        stderr = sys.stderr
+        sys.stdout = StringIO.StringIO()
+        sys.stderr = StringIO.StringIO()
+        try:
+            command_line_backup(['file_name', '-i', self.test_dir_path, '-o', '-'])
+            stream = sys.stdout
+        finally:
+            sys.stdout = stdout
+            sys.stderr = stderr
+        with zipfile.ZipFile(stream, 'r') as z:
+            self.assertEqual('streamed contents', z.read(z.namelist()[0]))
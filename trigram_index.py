@@ -0,0 +1,404 @@
+"""
+A persistent trigram index of the files in one or more directory trees. Queries use the index to narrow the files
+which could possibly match before verifying them with file_search's matchers, so repeated searches over the same tree
+only read the few files that contain every trigram of the query.
+"""
+
+import unittest
+import os
+import array
+import shutil
+import time
+import sre_parse
+import sre_constants
+import file_sys_manip
+import file_search
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+# Files larger than this are not indexed; they are always treated as candidates
+MAX_INDEXED_FILE_SIZE = 16 * 1024 * 1024
+# Neither are files with more distinct trigrams than this (compressed or random data), nor binary files, told apart by
+# a NUL byte in their first BINARY_SNIFF_SIZE bytes; their trigrams would cost more memory than they save reads
+MAX_FILE_TRIGRAMS = 256 * 1024
+BINARY_SNIFF_SIZE = 8 * 1024
+TRIGRAM_READ_SIZE = 64 * 1024
+INDEX_VERSION = 2
+
+
+class TrigramIndex(object):
+    """
+    Trigram index persisted to a single file. Call update to (re-)index the trees, save to write the index back, and
+    search_text/search_pattern to query it. The file holds a version followed by one pickled record per change to a
+    file's entry, so saving only appends what changed; it is rewritten whole once most of its records are outdated.
+    """
+
+    def __init__(self, index_path):
+        """
+        Loads the index at the given path, an empty index is used if there is no such file
+        :type index_path: str
+        :param index_path: path of the file the index is persisted to
+        """
+        self.index_path = index_path
+        # { file_path: (size, mtime, array of trigram codes (see _get_trigram_code), or None if the file is not
+        # indexed) }
+        self._files = {}
+        # { trigram code: set of file paths }, built from _files on first use
+        self._postings = None
+        # Paths whose entries changed since the index was loaded or last saved
+        self._changed_paths = set()
+        # Number of records in the index file, and its size up to the end of the last complete one; None if the file
+        # can't be appended to
+        self._record_count = 0
+        self._index_size = None
+        self.last_update_stats = None
+        self.last_query_stats = None
+        if os.path.isfile(index_path):
+            self._load()
+
+    def _load(self):
+        with open(self.index_path, 'rb') as f:
+            try:
+                if pickle.load(f) != INDEX_VERSION:
+                    return
+            except Exception:
+                return
+            while True:
+                self._index_size = f.tell()
+                try:
+                    file_path, record = pickle.load(f)
+                except Exception:
+                    # End of the file, or of what an interrupted save got to write; the next save overwrites the rest
+                    break
+                self._record_count += 1
+                if record is None:
+                    self._files.pop(file_path, None)
+                else:
+                    size, mtime, packed_trigrams = record
+                    trigrams = None
+                    if packed_trigrams is not None:
+                        trigrams = array.array('I')
+                        trigrams.fromstring(packed_trigrams)
+                    self._files[file_path] = (size, mtime, trigrams)
+
+    def save(self):
+        """
+        Writes the changes since the index was loaded or last saved to its index_path. When the file would hold more
+        outdated records than current ones it is rewritten instead, replacing the previous file only once the new one
+        is complete.
+        """
+        if (self._index_size is not None and os.path.isfile(self.index_path) and
+                self._record_count + len(self._changed_paths) <= 2 * len(self._files)):
+            with open(self.index_path, 'r+b') as f:
+                f.seek(self._index_size)
+                f.truncate()
+                for file_path in self._changed_paths:
+                    self._dump_record(f, file_path)
+                self._index_size = f.tell()
+            self._record_count += len(self._changed_paths)
+        else:
+            temp_path = self.index_path + '.tmp'
+            with open(temp_path, 'wb') as f:
+                pickle.dump(INDEX_VERSION, f, pickle.HIGHEST_PROTOCOL)
+                for file_path in self._files:
+                    self._dump_record(f, file_path)
+                self._index_size = f.tell()
+            if os.name == 'nt' and os.path.exists(self.index_path):
+                # Windows won't rename over an existing file; elsewhere rename replaces it in one step, so readers
+                # never find the index missing
+                os.remove(self.index_path)
+            os.rename(temp_path, self.index_path)
+            self._record_count = len(self._files)
+        self._changed_paths = set()
+
+    def _dump_record(self, f, file_path):
+        entry = self._files.get(file_path)
+        record = None
+        if entry is not None:
+            # Arrays pickle as lists of ints, their bytes are far smaller and faster to load
+            record = (entry[0], entry[1], None if entry[2] is None else entry[2].tostring())
+        pickle.dump((file_path, record), f, pickle.HIGHEST_PROTOCOL)
+
+    def update(self, dir_paths, extensions=None, excluded_dir_paths=None):
+        """
+        Brings the index up to date with the given directory trees, only reading files whose size or modification time
+        changed since they were last indexed. Files no longer in the trees are dropped.
+        :param dir_paths: directory paths to index, as accepted by file_sys_manip.get_file_paths
+        :param extensions: set of extensions of the files to index, None indexes every file
+        :param excluded_dir_paths: directory paths to leave out, as accepted by file_sys_manip.get_file_paths
+        :rtype dict
+        :return: dict with the keys 'added', 'updated', 'removed', 'unchanged' (file counts) and 'seconds'
+        """
+        start_time = time.time()
+        stats = {'added': 0, 'updated': 0, 'removed': 0, 'unchanged': 0}
+        seen = set()
+        for file_path in file_sys_manip.iter_file_paths(dir_paths, extensions, excluded_dir_paths):
+            seen.add(file_path)
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue
+            entry = self._files.get(file_path)
+            if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime:
+                stats['unchanged'] += 1
+                continue
+            stats['added' if entry is None else 'updated'] += 1
+            self._set_entry(file_path, (stat.st_size, stat.st_mtime, _get_file_trigrams(file_path, stat.st_size)))
+        for file_path in set(self._files) - seen:
+            stats['removed'] += 1
+            self._set_entry(file_path, None)
+        stats['seconds'] = time.time() - start_time
+        self.last_update_stats = stats
+        return stats
+
+    def _set_entry(self, file_path, entry):
+        self._changed_paths.add(file_path)
+        old_entry = self._files.pop(file_path, None)
+        if entry is not None:
+            self._files[file_path] = entry
+        if self._postings is None:
+            return
+        if old_entry is not None:
+            for trigram in old_entry[2] or ():
+                paths = self._postings[trigram]
+                paths.discard(file_path)
+                if not paths:
+                    del self._postings[trigram]
+        if entry is not None:
+            self._add_postings(file_path, entry)
+
+    def _add_postings(self, file_path, entry):
+        for trigram in entry[2] or ():
+            paths = self._postings.get(trigram)
+            if paths is None:
+                paths = self._postings[trigram] = set()
+            paths.add(file_path)
+
+    def get_file_paths(self):
+        """
+        Returns the set of every indexed file path
+        """
+        return set(self._files)
+
+    def get_candidates(self, required_strings):
+        """
+        Returns the set of indexed file paths which contain every trigram of every given string
+        :type required_strings: list
+        :param required_strings: strings a file must contain to be a candidate
+        :rtype set
+        :return: the set of candidate file paths
+        """
+        trigrams = set()
+        for string in required_strings:
+            if isinstance(string, unicode):
+                # Only plain ASCII is sure to be stored as the same bytes whatever the file's encoding
+                try:
+                    string = string.encode('ascii')
+                except UnicodeEncodeError:
+                    continue
+            trigrams.update(_get_trigram_code(trigram) for trigram in _get_trigrams(string))
+        if not trigrams:
+            return set(self._files)
+        if self._postings is None:
+            self._postings = {}
+            for file_path, entry in self._files.iteritems():
+                self._add_postings(file_path, entry)
+        # Intersect the rarest trigrams first so the working set shrinks as fast as possible
+        postings = sorted((self._postings.get(trigram, set()) for trigram in trigrams), key=len)
+        candidates = set(postings[0])
+        for paths in postings[1:]:
+            if not candidates:
+                break
+            candidates &= paths
+        candidates.update(file_path for file_path, entry in self._files.iteritems() if entry[2] is None)
+        return candidates
+
+    def search_text(self, text):
+        """
+        Returns the set of indexed file paths in which the given text is found (see file_search.is_text_in_file)
+        :type text: str
+        :param text: text to search for
+        :rtype set
+        :return: the set of matching file paths
+        """
+        return self._search([text], lambda file_path: file_search.is_text_in_file(text, file_path))
+
+    def search_pattern(self, pattern):
+        """
+        Returns the set of indexed file paths in which the given regular expression is found (see
+        file_search.is_pattern_in_file). Only the literal runs the pattern requires are used to narrow the candidates.
+        :type pattern: str
+        :param pattern: regular expression to search for
+        :rtype set
+        :return: the set of matching file paths
+        """
+        return self._search(
+            get_required_literals(pattern), lambda file_path: file_search.is_pattern_in_file(pattern, file_path))
+
+    def _search(self, required_strings, is_match):
+        start_time = time.time()
+        candidates = self.get_candidates(required_strings)
+        candidate_time = time.time()
+        matches = set()
+        for file_path in candidates:
+            try:
+                if is_match(file_path):
+                    matches.add(file_path)
+            except (IOError, OSError):
+                pass
+        end_time = time.time()
+        self.last_query_stats = {
+            'files': len(self._files),
+            'candidates': len(candidates),
+            'matches': len(matches),
+            'index_seconds': candidate_time - start_time,
+            'verify_seconds': end_time - candidate_time,
+            'seconds': end_time - start_time,
+        }
+        return matches
+
+
+def _get_trigrams(data):
+    return frozenset(data[i:i + 3] for i in xrange(len(data) - 2))
+
+
+def _get_trigram_code(trigram):
+    return (ord(trigram[0]) << 16) | (ord(trigram[1]) << 8) | ord(trigram[2])
+
+
+def _get_file_trigrams(file_path, size):
+    """
+    Returns the array of the codes of the distinct trigrams in a file, None if it is not to be indexed
+    """
+    if size > MAX_INDEXED_FILE_SIZE:
+        return None
+    trigrams = set()
+    try:
+        with open(file_path, 'rb') as f:
+            data = f.read(TRIGRAM_READ_SIZE)
+            if '\0' in data[:BINARY_SNIFF_SIZE]:
+                return None
+            while data:
+                trigrams.update(data[i:i + 3] for i in xrange(len(data) - 2))
+                if len(trigrams) > MAX_FILE_TRIGRAMS:
+                    return None
+                block = f.read(TRIGRAM_READ_SIZE)
+                # Keep the last two bytes, the trigrams spanning two reads
+                data = data[-2:] + block if block else ''
+    except IOError:
+        return None
+    return array.array('I', (_get_trigram_code(trigram) for trigram in trigrams))
+
+
+def get_required_literals(pattern):
+    """
+    Returns literal strings which any match of the given regular expression must contain, an empty list if none could
+    be worked out (e.g. the pattern alternates at its top level or ignores case)
+    :type pattern: str
+    :param pattern: regular expression
+    :rtype list
+    :return: list of strings
+    """
+    try:
+        parsed = sre_parse.parse(pattern)
+    except (sre_constants.error, OverflowError):
+        return []
+    if parsed.pattern.flags & sre_constants.SRE_FLAG_IGNORECASE:
+        return []
+    literals = []
+    run = []
+    for op, argument in parsed:
+        if op == sre_constants.LITERAL:
+            run.append(chr(argument) if argument < 256 else unichr(argument))
+            continue
+        if op == sre_constants.BRANCH:
+            return []
+        if len(run) >= 3:
+            literals.append(''.join(run))
+        run = []
+    if len(run) >= 3:
+        literals.append(''.join(run))
+    return literals
+
+
+#--------------------
+# Tests
+#--------------------
+class TrigramIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = file_sys_manip.generate_unique_path("test_dir")
+        os.makedirs(os.path.join(self.test_dir, 'tree'))
+        self.tree_dir = os.path.join(self.test_dir, 'tree')
+        self.index_path = os.path.join(self.test_dir, 'index.pickle')
+        self.file_creator = file_sys_manip.FileCreator()
+        self.file_creator.create_files_from_dict({
+            'droids.txt': "These are not the droids you're looking for.",
+            'move_along.txt': "Move along.",
+        }, self.tree_dir)
+        self.droids_path = os.path.join(self.tree_dir, 'droids.txt')
+        self.move_along_path = os.path.join(self.tree_dir, 'move_along.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_get_required_literals(self):
+        self.assertEqual(['droids', ' looking'], get_required_literals(r"droids\s+\w+ looking"))
+        self.assertEqual([], get_required_literals(r"droids|along"))
+        self.assertEqual([], get_required_literals(r"(?i)droids"))
+
+    def test_search(self):
+        index = TrigramIndex(self.index_path)
+        self.assertEqual(2, index.update(self.tree_dir)['added'])
+        self.assertEqual({self.droids_path}, index.search_text("droids"))
+        self.assertEqual(1, index.last_query_stats['candidates'])
+        self.assertEqual({self.move_along_path}, index.search_pattern(r"^Move\s+al"))
+        self.assertEqual(set(), index.search_text("not in any file"))
+        self.assertEqual({self.droids_path, self.move_along_path}, index.search_pattern(r"o(n|o)"))
+
+    def test_update(self):
+        index = TrigramIndex(self.index_path)
+        index.update(self.tree_dir)
+        index.save()
+
+        with open(self.move_along_path, 'w') as f:
+            f.write("Move along, droids.")
+        os.remove(self.droids_path)
+        # The saved index is reloaded, and only the changed file is read again
+        index = TrigramIndex(self.index_path)
+        stats = index.update(self.tree_dir)
+        self.assertEqual((0, 1, 1, 0), (stats['added'], stats['updated'], stats['removed'], stats['unchanged']))
+        self.assertEqual({self.move_along_path}, index.search_text("droids"))
+        self.assertEqual({self.move_along_path}, index.get_file_paths())
+        index.save()
+        with open(self.index_path, 'rb') as f:
+            saved = f.read()
+        # What an interrupted save left behind is ignored, and only the changes are appended in its place
+        with open(self.index_path, 'ab') as f:
+            f.write('\x80\x02(')
+        index = TrigramIndex(self.index_path)
+        self.assertEqual({self.move_along_path}, index.search_text("droids"))
+        self.file_creator.create_files_from_dict({'new.txt': "New droids."}, self.tree_dir)
+        index.update(self.tree_dir)
+        index.save()
+        with open(self.index_path, 'rb') as f:
+            appended = f.read()
+        self.assertTrue(appended.startswith(saved))
+        index = TrigramIndex(self.index_path)
+        self.assertEqual({self.move_along_path, os.path.join(self.tree_dir, 'new.txt')}, index.search_text("droids"))
+
+    def test_unindexed_files(self):
+        self.file_creator.create_files_from_dict({
+            'binary.bin': "\0droids",
+            'random.bin': ''.join(chr(i % 256) + chr(i // 256 % 256) + chr(i // 65536) for i in xrange(300000)),
+        }, self.tree_dir)
+        index = TrigramIndex(self.index_path)
+        index.update(self.tree_dir)
+        # Files which are not indexed are always candidates, so they are still searched
+        binary_path = os.path.join(self.tree_dir, 'binary.bin')
+        random_path = os.path.join(self.tree_dir, 'random.bin')
+        self.assertEqual({self.droids_path, binary_path, random_path}, index.get_candidates(["droids"]))
+        self.assertEqual({self.droids_path, binary_path}, index.search_text("droids"))
@@ -1,4 +1,20 @@
 import unittest
+import collections
+import numbers
+import re
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class _Missing(object):
+    def __repr__(self):
+        return '<missing>'
+
+# Stands for the value of a key a record doesn't have
+_MISSING = _Missing()
 
 
 class type_validator:
@@ -6,13 +22,211 @@ class type_validator:
     A function decorator, runs input through type validation before passing it on the the original function; returns
         False if the type does not match that which was expected (defined in dict 'types' class member variable)
         type_validator.types expected format: { func_name : expected_type }
+        The expected type is looked up once, the first time it is needed, so it may be added to the types after the
+        function is decorated. New code should prefer composing the declarative validators below, e.g.
+        all_of(is_type(float), func).
     """
     def __init__(self, func):
         self.func = func
         self.types = type_validator.types
+        self.type = None
 
     def __call__(self, value):
-        return self.func(value) and isinstance(value, self.types[self.func.func_code.co_name])
+        return self.func(value) and isinstance(value, self.type or self._resolve_type())
+
+    def _resolve_type(self):
+        self.type = self.types[self.func.func_code.co_name]
+        return self.type
+
+
+#--------------------
+# Declarative validators
+#--------------------
+# Each of these builds a plain function taking a value and returning True if it is valid, False otherwise, ready to be
+# used in a Validator's validation_funcs_dict. Everything they need is bound when they are built, so a call does no
+# global or attribute lookups beyond the checks themselves.
+def is_type(*types, **kwargs):
+    """
+    Returns a validator accepting instances of the given types
+    @param types: the accepted types
+    @param kwargs: exact=True only accepts the exact types, not subclasses (e.g. rejects True for is_type(int))
+    """
+    types = tuple(types)
+    if kwargs.get('exact', False):
+        type_set = frozenset(types)
+
+        def validate(value, _type=type):
+            return _type(value) in type_set
+    else:
+        def validate(value, _isinstance=isinstance):
+            return _isinstance(value, types)
+    return validate
+
+
+def in_range(minimum=None, maximum=None, exclusive=False):
+    """
+    Returns a validator accepting values between minimum and maximum, inclusively unless exclusive is True; a bound of
+        None is not checked. Values that aren't numbers are invalid (Python 2 would otherwise happily compare e.g.
+        strings with numbers). The validator is also vectorized (see Validator.validate_many).
+    """
+    def validate(value, _isinstance=isinstance, _number=numbers.Number):
+        if not _isinstance(value, _number):
+            return False
+        try:
+            if exclusive:
+                return (minimum is None or value > minimum) and (maximum is None or value < maximum)
+            return (minimum is None or value >= minimum) and (maximum is None or value <= maximum)
+        except TypeError:
+            return False
+
+    def validate_array(values):
+        valid = numpy.ones(values.shape, dtype=bool)
+        if minimum is not None:
+            valid &= values > minimum if exclusive else values >= minimum
+        if maximum is not None:
+            valid &= values < maximum if exclusive else values <= maximum
+        return valid
+    validate.vectorized = validate_array
+    return validate
+
+
+def matches(pattern, flags=0):
+    """
+    Returns a validator accepting strings which the regular expression fully matches
+    """
+    match = re.compile('(?:{})\\Z'.format(pattern), flags).match
+
+    def validate(value, _isinstance=isinstance, _basestring=basestring):
+        return _isinstance(value, _basestring) and match(value) is not None
+    return validate
+
+
+def one_of(values):
+    """
+    Returns a validator accepting only the given values
+    """
+    try:
+        allowed = frozenset(values)
+    except TypeError:
+        # Unhashable values can only be compared one by one
+        allowed = tuple(values)
+
+    def validate(value):
+        try:
+            return value in allowed
+        except TypeError:
+            return False
+    return validate
+
+
+def has_length(minimum=None, maximum=None):
+    """
+    Returns a validator accepting values whose length is between minimum and maximum inclusively; a bound of None is
+        not checked. Values without a length are invalid.
+    """
+    def validate(value, _len=len):
+        try:
+            length = _len(value)
+        except TypeError:
+            return False
+        return (minimum is None or length >= minimum) and (maximum is None or length <= maximum)
+    return validate
+
+
+def list_of(item_validator):
+    """
+    Returns a validator accepting lists and tuples whose every item item_validator accepts
+    """
+    def validate(value, _isinstance=isinstance, _sequence_types=(list, tuple)):
+        if not _isinstance(value, _sequence_types):
+            return False
+        for item in value:
+            if not item_validator(item):
+                return False
+        return True
+    return validate
+
+
+def dict_of(key_validator, value_validator):
+    """
+    Returns a validator accepting dicts whose every key key_validator accepts and every value value_validator accepts
+    """
+    def validate(value, _isinstance=isinstance, _dict=dict):
+        if not _isinstance(value, _dict):
+            return False
+        for key, item in value.iteritems():
+            if not key_validator(key) or not value_validator(item):
+                return False
+        return True
+    return validate
+
+
+def has_fields(field_validators, allow_extra=True):
+    """
+    Returns a validator accepting dicts which have every key of field_validators, each value being accepted by its
+        validator. Wrap a validator with optional to also accept the field being absent.
+    @type field_validators: dict
+    @param field_validators: { key: validator }
+    @type allow_extra: bool
+    @param allow_extra: if False, dicts with keys field_validators lacks are invalid
+    """
+    fields = tuple(field_validators.items())
+    optional_keys = frozenset(key for key, validator in fields if getattr(validator, 'optional', False))
+    known_keys = frozenset(field_validators)
+
+    def validate(value, _isinstance=isinstance, _dict=dict, _missing=_MISSING):
+        if not _isinstance(value, _dict):
+            return False
+        get = value.get
+        for key, validator in fields:
+            item = get(key, _missing)
+            if item is _missing:
+                if key not in optional_keys:
+                    return False
+            elif not validator(item):
+                return False
+        return allow_extra or known_keys.issuperset(value)
+    return validate
+
+
+def optional(validator):
+    """
+    Returns a validator accepting None as well as whatever the given validator accepts; has_fields also lets fields
+        validated by it be absent
+    """
+    def validate(value):
+        return value is None or validator(value)
+    validate.optional = True
+    return validate
+
+
+def all_of(*validators):
+    """
+    Returns a validator accepting values every one of the given validators accepts, checked in order. It is vectorized
+        (see Validator.validate_many) if all of them are.
+    """
+    if len(validators) == 1:
+        return validators[0]
+    if len(validators) == 2:
+        first, second = validators
+
+        def validate(value):
+            return first(value) and second(value)
+    else:
+        def validate(value):
+            for validator in validators:
+                if not validator(value):
+                    return False
+            return True
+    vectorized_validators = [getattr(validator, 'vectorized', None) for validator in validators]
+    if None not in vectorized_validators:
+        def validate_array(values):
+            valid = numpy.ones(values.shape, dtype=bool)
+            for vectorized in vectorized_validators:
+                valid &= numpy.asarray(vectorized(values), dtype=bool)
+            return valid
+        validate.vectorized = validate_array
+    return validate
 
 
 class Validator(object):
@@ -50,10 +264,155 @@ class Validator(object):
         except KeyError:
             raise Validator.UndefinedKey("No validation function defined for '{}'".format(key))
 
+    def _get_func(self, key):
+        try:
+            return self._validation_funcs_dict[key]
+        except KeyError:
+            raise Validator.UndefinedKey("No validation function defined for '{}'".format(key))
+
+    def compile(self, keys=None):
+        """
+        Returns a function specialized for validating records (dicts) with the given keys. The per key lookups are done
+            once, here, and the generated function checks each key with straight-line code, so validating a record
+            costs little more than calling the validation functions themselves.
+        @type keys: list or unknown
+        @param keys: the keys every record must have, all keys of validation_funcs_dict if None
+        @return: function(record) returning the list of the keys whose values are missing or invalid, empty if the
+            record is valid
+        """
+        if keys is None:
+            keys = list(self._validation_funcs_dict)
+        namespace = {'_missing': _MISSING, '_type': type, '_always_valid_types': frozenset(self.always_valid_types)}
+        lines = ['def validate_record(record):', '    errors = []', '    get = record.get']
+        for index, key in enumerate(keys):
+            # Keys and functions are bound as globals of the generated function, so keys need not be identifiers
+            namespace['key_{}'.format(index)] = key
+            namespace['func_{}'.format(index)] = self._get_func(key)
+            lines.append('    value = get(key_{}, _missing)'.format(index))
+            if self.always_valid_types:
+                lines.append('    if value is _missing or (_type(value) not in _always_valid_types and '
+                             'not func_{}(value)):'.format(index))
+            else:
+                lines.append('    if value is _missing or not func_{}(value):'.format(index))
+            lines.append('        errors.append(key_{})'.format(index))
+        lines.append('    return errors')
+        exec compile('\n'.join(lines), '<compiled validator>', 'exec') in namespace
+        return namespace['validate_record']
+
+    def validate_record(self, record):
+        """
+        Validates every value of a record
+        @type record: dict
+        @param record: { key: value }, each value validated by the function of its key
+        @rtype ValidationReport
+        @return: the report of the record's invalid values
+        """
+        report = ValidationReport()
+        for key, val in record.iteritems():
+            if type(val) not in self.always_valid_types and not self._get_func(key)(val):
+                report.errors.append((key, None, val))
+        report.checked = len(record)
+        return report
+
+    def validate_records(self, records, keys=None):
+        """
+        Validates many records with a single function compiled for their keys (see compile)
+        @type records: iterable
+        @param records: dicts to validate
+        @type keys: list or unknown
+        @param keys: the keys every record must have, all keys of validation_funcs_dict if None
+        @rtype ValidationReport
+        @return: the report of the missing and invalid values, each error's index being that of its record
+        """
+        if keys is None:
+            keys = list(self._validation_funcs_dict)
+        validate_record = self.compile(keys)
+        report = ValidationReport()
+        errors = report.errors
+        index = -1
+        for index, record in enumerate(records):
+            for key in validate_record(record):
+                errors.append((key, index, record.get(key, _MISSING)))
+        report.checked = (index + 1) * len(keys)
+        return report
+
+    def validate_many(self, key, values):
+        """
+        Validates a batch (column) of values with the function of a single key. Homogeneous NumPy arrays are
+            validated in one vectorized call when the function has a 'vectorized' attribute (a function taking an
+            array and returning an array of bools).
+        @type key: str
+        @param key: name of the function to use to validate the values
+        @type values: list or numpy.ndarray
+        @param values: the values to validate
+        @rtype ValidationReport
+        @return: the report of the invalid values, each error's index being that of its value
+        """
+        func = self._get_func(key)
+        report = ValidationReport()
+        report.checked = len(values)
+        if numpy is not None and isinstance(values, numpy.ndarray):
+            if values.dtype.type in self.always_valid_types:
+                return report
+            vectorized = getattr(func, 'vectorized', None)
+            if vectorized is not None:
+                for index in numpy.flatnonzero(~numpy.asarray(vectorized(values), dtype=bool)):
+                    report.errors.append((key, int(index), values[index]))
+                return report
+            # Iterating a list of Python scalars is much cheaper than iterating the array itself
+            values = values.tolist()
+        always_valid_types = self.always_valid_types
+        errors = report.errors
+        for index, val in enumerate(values):
+            if type(val) not in always_valid_types and not func(val):
+                errors.append((key, index, val))
+        return report
+
+    def validate_columns(self, columns):
+        """
+        Validates a batch of columns, see validate_many
+        @type columns: dict
+        @param columns: { key: values }
+        @rtype ValidationReport
+        @return: the report of every column's invalid values
+        """
+        report = ValidationReport()
+        for key, values in columns.iteritems():
+            column_report = self.validate_many(key, values)
+            report.errors.extend(column_report.errors)
+            report.checked += column_report.checked
+        return report
+
     class UndefinedKey(Exception):
         pass
 
 
+class ValidationReport(object):
+    """
+    The outcome of validating a batch of values
+    """
+    def __init__(self):
+        # [ (key, index, value) ], index being None for single records and value _MISSING for keys a record lacks
+        self.errors = []
+        # Number of values checked
+        self.checked = 0
+
+    def is_valid(self):
+        """
+        Returns True if no invalid value was found, False otherwise
+        """
+        return not self.errors
+
+    def __len__(self):
+        return len(self.errors)
+
+    def count_by_key(self):
+        """
+        Returns { key: number of invalid values }
+        """
+        return dict(collections.Counter(key for key, index, value in self.errors))
+
+
 #--------------------
 # Tests
 #--------------------
@@ -76,6 +435,75 @@ class ValidationTests(unittest.TestCase):
         type_validator.types = {}
         self.assertTrue(self.type_validator_func(1.1))
 
+        # Types may be added after the function is decorated
+        @type_validator
+        def late_validator(value):
+            return True
+        type_validator.types["late_validator"] = int
+        self.assertTrue(late_validator(1))
+        self.assertFalse(late_validator(1.0))
+
+
+class DeclarativeValidatorTests(unittest.TestCase):
+    def test_is_type(self):
+        self.assertTrue(is_type(int)(1))
+        self.assertTrue(is_type(int, float)(1.5))
+        self.assertTrue(is_type(int)(True))
+        self.assertFalse(is_type(int, exact=True)(True))
+        self.assertFalse(is_type(int)("1"))
+
+    def test_in_range(self):
+        self.assertTrue(in_range(0, 10)(10))
+        self.assertFalse(in_range(0, 10, exclusive=True)(10))
+        self.assertTrue(in_range(minimum=0)(1e9))
+        self.assertFalse(in_range(maximum=0)(1))
+        self.assertFalse(in_range(minimum=0)("abc"))
+        self.assertFalse(in_range(maximum=0)(None))
+        # Combining vectorized validators keeps them vectorized
+        self.assertTrue(hasattr(all_of(in_range(0, 10), in_range(minimum=1)), 'vectorized'))
+        self.assertFalse(hasattr(all_of(in_range(0, 10), is_type(int)), 'vectorized'))
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_in_range_vectorized(self):
+        validator = Validator({"x": in_range(0, 10)})
+        report = validator.validate_many("x", numpy.array([-1, 0, 5, 11]))
+        self.assertEqual([0, 3], [index for key, index, value in report.errors])
+        combined = all_of(in_range(0, 10), in_range(maximum=5, exclusive=True), in_range(minimum=1))
+        report = Validator({"x": combined}).validate_many("x", numpy.array([-1, 0, 1, 4, 5]))
+        self.assertEqual([0, 1, 4], [index for key, index, value in report.errors])
+
+    def test_matches(self):
+        self.assertTrue(matches(r"[a-z]+")("abc"))
+        self.assertFalse(matches(r"[a-z]+")("abc1"))
+        self.assertFalse(matches(r"a|b")("ab"))
+        self.assertFalse(matches(r"[a-z]+")(1))
+
+    def test_one_of_and_has_length(self):
+        self.assertTrue(one_of(["a", "b"])("a"))
+        self.assertFalse(one_of(["a", "b"])(["a"]))
+        self.assertTrue(one_of([[1], [2]])([2]))
+        self.assertTrue(has_length(1, 2)("ab"))
+        self.assertFalse(has_length(1, 2)("abc"))
+        self.assertFalse(has_length(1)(5))
+
+    def test_nested(self):
+        validate = has_fields({
+            "name": all_of(is_type(str), has_length(1)),
+            "ports": list_of(all_of(is_type(int), in_range(1, 65535))),
+            "labels": optional(dict_of(is_type(str), is_type(str))),
+        }, allow_extra=False)
+        self.assertTrue(validate({"name": "web", "ports": [80, 443]}))
+        self.assertTrue(validate({"name": "web", "ports": [], "labels": {"tier": "front"}}))
+        self.assertTrue(validate({"name": "web", "ports": [], "labels": None}))
+        self.assertFalse(validate({"name": "web", "ports": [0]}))
+        self.assertFalse(validate({"name": "", "ports": []}))
+        self.assertFalse(validate({"ports": []}))
+        self.assertFalse(validate({"name": "web", "ports": [], "extra": 1}))
+        self.assertFalse(validate({"name": "web", "ports": [], "labels": {"tier": 1}}))
+
+        validator = Validator({"service": validate})
+        self.assertTrue(validator.is_valid("service", {"name": "web", "ports": [80]}))
+
 
 class ValidatorTests(unittest.TestCase):
     def setUp(self):
@@ -88,4 +516,42 @@ class ValidatorTests(unittest.TestCase):
         self.assertFalse(self.validator.is_valid("x", "5"))
 
     def test_is_valid_missing_key(self):
-        self.assertRaises(Validator.UndefinedKey, self.validator.is_valid, "y", 5)
\ No newline at end of file
+        self.assertRaises(Validator.UndefinedKey, self.validator.is_valid, "y", 5)
+
+    def test_compile(self):
+        validator = Validator({"x": lambda x: type(x) is int, 1: lambda y: y > 0}, always_valid_types={float})
+        validate_record = validator.compile()
+        self.assertEqual([], validate_record({"x": 5, 1: 2}))
+        self.assertEqual(["x"], validate_record({"x": "5", 1: 2.0}))
+        self.assertEqual([1], validate_record({"x": 5.0, 1: -1}))
+        self.assertEqual(["x"], validate_record({1: 1}))
+        self.assertRaises(Validator.UndefinedKey, validator.compile, ["y"])
+
+    def test_validate_record(self):
+        self.assertTrue(self.validator.validate_record({"x": 5}).is_valid())
+        report = self.validator.validate_record({"x": "5"})
+        self.assertEqual([("x", None, "5")], report.errors)
+        self.assertRaises(Validator.UndefinedKey, self.validator.validate_record, {"y": 5})
+
+    def test_validate_records(self):
+        report = self.validator.validate_records([{"x": 1}, {"x": "2"}, {}, {"x": 3}])
+        self.assertEqual([("x", 1, "2"), ("x", 2, _MISSING)], report.errors)
+        self.assertEqual({"x": 2}, report.count_by_key())
+
+    def test_validate_many(self):
+        report = self.validator.validate_many("x", [1, "2", 3, None])
+        self.assertEqual([("x", 1, "2"), ("x", 3, None)], report.errors)
+        self.assertEqual(4, report.checked)
+        report = self.validator.validate_columns({"x": [1, 2]})
+        self.assertTrue(report.is_valid())
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_validate_many_vectorized(self):
+        def positive(value):
+            return value > 0
+        positive.vectorized = lambda values: values > 0
+        validator = Validator({"x": positive})
+        report = validator.validate_many("x", numpy.array([1, -2, 3, -4]))
+        self.assertEqual([1, 3], [index for key, index, value in report.errors])
+        # Arrays without a vectorized function are validated value by value
+        self.assertEqual(1, len(self.validator.validate_many("x", numpy.array([1, "2"], dtype=object))))